@@ -0,0 +1,179 @@
+#!/usr/bin/python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	benchmark_unique_name.py
+
+	DESCRIPTION:
+	Times the scan, name, rename and copy paths of unique_name_for_copy.py
+	on synthetic cards made with create_test_files.py. Each size gets a
+	fresh card in a temporary folder, which is removed afterwards.
+
+	HISTORY:
+	10/18/26 -RH
+	Initial creation
+
+	10/18/26 -RH
+	The copy phase reports how many files were copied and how many were
+	skipped as duplicates next to its time.
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import argparse,os,sys,time,json,shutil,tempfile
+
+import create_test_files
+import unique_name_for_copy
+from unique_name_for_copy import CameraFile, MoveCameraFiles, RenamePlanner
+
+################################################################################
+# CONSTANT
+################################################################################
+DEFAULT_COUNTS	= "10,1000,100000"
+PHASES		= ('generate', 'scan', 'name', 'plan', 'rename', 'copy')
+
+################################################################################
+# CLASSES
+################################################################################
+class QuietOutput(object):
+	"""QuietOutput - the script prints a line or two per file, keep that out of the timings"""
+
+	def __enter__(self):
+		self.stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+
+	def __exit__(self, *exc):
+		sys.stdout.close()
+		sys.stdout = self.stdout
+
+
+class Benchmark(object):
+	"""Benchmark - runs every phase for one file count on a fresh card"""
+
+	def __init__(self, args, count):
+		self.args = args
+		self.count = count
+		self.results = dict((phase, []) for phase in PHASES)
+		self.copied = []
+		self.skipped = []
+
+	def script_args(self, source, dest):
+		# What the unique name script would get from its command line
+		return argparse.Namespace(source=source, dest=dest, inplace=False, jobs=self.args.jobs,
+			no_journal=self.args.no_journal, no_dedup=self.args.no_dedup, verify=False,
+			time_source='mtime', profiles=None, dry_run=False, undo=False, summary=None, log_files=False)
+
+	def timed(self, phase, call):
+		start = time.time()
+		result = call()
+		self.results[phase].append(time.time() - start)
+		return result
+
+	def run_once(self, work):
+		card = os.path.join(work, "card")
+		flat = os.path.join(work, "flat")
+		dest = os.path.join(work, "dest")
+		os.makedirs(dest)
+		sizes = [create_test_files.parse_size(s) for s in self.args.size.split(",")]
+
+		self.timed('generate', lambda: create_test_files.create_test_files(card, self.count, sizes,
+			self.args.profile, dcim=True, with_header=self.args.mp4_header))
+		create_test_files.create_test_files(flat, self.count, [0], self.args.profile)
+
+		script_args = self.script_args(card, dest)
+		cf = CameraFile(script_args, [])
+		clips = self.timed('scan', lambda: list(cf.walk(card)))
+
+		# Start cold, the name cache would hide the formatting cost on later rounds
+		CameraFile._formatted_cache.clear()
+		self.timed('name', lambda: [cf.clip_name(clip.path, clip, clip.stat) for clip in clips])
+
+		names = os.listdir(flat)
+		flat_cf = CameraFile(script_args, names)
+		flat_cf.is_mov_file()
+		planner = RenamePlanner(flat, names)
+		for clip in flat_cf.movie_files:
+			path = os.path.join(flat, clip.name)
+			planner.add(clip.name, flat_cf.clip_name(path, clip), clip.sidecar_targets)
+		plan = self.timed('plan', planner.plan)
+		self.timed('rename', lambda: planner.apply(plan))
+
+		if self.count <= self.args.max_copy:
+			with QuietOutput():
+				stats = self.timed('copy', MoveCameraFiles(script_args).move_files_with_final_name)
+			# Skipped clips cost next to nothing, a rate without these counts means little
+			self.copied.append(stats.files_copied)
+			self.skipped.append(stats.files_skipped)
+
+	def run(self):
+		for i in range(self.args.repeat):
+			work = tempfile.mkdtemp(prefix="uniquename-bench-", dir=self.args.work)
+			try:
+				self.run_once(work)
+			finally:
+				shutil.rmtree(work)
+		return self.summary()
+
+	def summary(self):
+		summary = {'count': self.count}
+		for (phase, times) in self.results.items():
+			if times:
+				times = sorted(times)
+				summary[phase] = {'best': round(times[0], 4), 'median': round(times[len(times) // 2], 4),
+					'files_per_second': round(self.count / times[0], 1) if times[0] > 0 else None}
+		if self.copied:
+			summary['copy']['copied'] = min(self.copied)
+			summary['copy']['skipped'] = max(self.skipped)
+		return summary
+
+################################################################################
+# FUNCTIONS
+################################################################################
+def print_header():
+	print("{0:>8} ".format("files") + "".join("{0:>12}".format(phase) for phase in PHASES)
+		+ "{0:>9}{1:>9}".format("copied", "skipped"))
+
+def print_row(summary):
+	row = "{0:>8} ".format(summary['count'])
+	for phase in PHASES:
+		if phase in summary:
+			row += "{0:>11.3f}s".format(summary[phase]['best'])
+		else:
+			row += "{0:>12}".format("-")
+	if 'copy' in summary:
+		row += "{0:>9}{1:>9}".format(summary['copy']['copied'], summary['copy']['skipped'])
+	print(row)
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description = "Benchmark the unique name script on synthetic camera cards")
+	parser.add_argument('-c', '--counts',	default=DEFAULT_COUNTS, help = "Comma separated clip counts to run")
+	parser.add_argument('-s', '--size',	default="0", help = "Clip sizes used in turn, comma separated, like 0,64K,4G")
+	parser.add_argument('-p', '--profile',	choices=sorted(create_test_files.PROFILES), default='gopro', help = "Camera the clips look like")
+	parser.add_argument('-r', '--repeat',	type=int, default=3, help = "Runs per count, the best and median are reported")
+	parser.add_argument('-j', '--jobs',	type=int, default=unique_name_for_copy.DEFAULT_JOBS, help = "Copy threads")
+	parser.add_argument('--max-copy',	type=int, default=100000, help = "Skip the copy phase above this many clips")
+	parser.add_argument('--mp4-header',	action="store_true", help = "Give clips a minimal MP4 header")
+	parser.add_argument('--no-journal',	action="store_true", help = "Copy without the ingest journal")
+	parser.add_argument('--no-dedup',	action="store_true", help = "Copy without the dedup index")
+	parser.add_argument('--work',		default=None, help = "Folder for the temporary cards, the system temp folder by default")
+	parser.add_argument('--json',		default=None, help = "Also write the results as JSON to this file")
+	args = parser.parse_args()
+
+	summaries = []
+	print_header()
+	for count in [int(c) for c in args.counts.split(",")]:
+		summaries.append(Benchmark(args, count).run())
+		print_row(summaries[-1])
+
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(summaries, f, indent=2, sort_keys=True)
@@ -7,35 +7,136 @@
         create_test_files.py
 
         DESCRIPTION:
-	A script to quickly generate the test files required for 
+	A script to quickly generate the test files required for
 	the unique file name script
 
         HISTORY:
         06/09/17 -RH
         Initial creation
 
+	10/18/26 -RH
+	Files get their times from os.utime instead of a sleep between each
+	one, so big sets take seconds. Added file counts and sizes, camera
+	profiles, DCIM folder layouts and minimal MP4 headers for the
+	benchmark script.
+
+	10/18/26 -RH
+	Clips start and end with bytes seeded from their path instead of
+	being all zeros, so the dedup index doesn't skip them as copies of
+	each other.
+
 ################################################################################
 """
 
 ################################################################################
 # IMPORT
 ################################################################################
-import argparse,os,time
+import argparse,os,time,struct,hashlib
 
 ################################################################################
 # CONSTANT
 ################################################################################
 test_folder_count = 30
 
-# Find our arguments
-parser = argparse.ArgumentParser(description = "Script to create a bunch of test files for the unique file script")
-parser.add_argument('-t', '--target',   default="target", help = "The path to the source folder")
-args = parser.parse_args()
-
-# Create a bunch of test files in the target folder
-for i in range(0, test_folder_count):
-	os.chdir(args.target)
-	test_name_format = "Test{0}File{0}.MOV".format(i)
-	with open(test_name_format, 'a'):
-		os.utime(test_name_format, None)
-		time.sleep(1)
+MP4_EPOCH_OFFSET = 2082844800		# Seconds from 1904-01-01 (QuickTime epoch) to 1970-01-01
+DCIM_FOLDER_SIZE = 999			# Cameras start a new DCIM folder every 999 clips
+CONTENT_BLOCK_SIZE = 64 * 1024		# Seeded bytes at each end of a clip, what the dedup prefilter reads
+
+# Name format, DCIM folder format and sidecar extensions of each camera
+PROFILES = {
+	'bullet':	("Test{0}File{0}.MOV", "{0}BULLET", []),
+	'gopro':	("GOPR{0:04d}.MP4", "{0}GOPRO", [".THM", ".LRV"]),
+	'drift':	("DRIFT{0:04d}.mp4", "{0}DRIFT", ["_thm.mp4"]),
+}
+
+################################################################################
+# FUNCTIONS
+################################################################################
+def parse_size(size):
+	# 512, 64K, 10M, 4G
+	units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+	size = size.strip().upper()
+	if size and size[-1] in units:
+		return int(float(size[:-1]) * units[size[-1]])
+	return int(size)
+
+def mp4_header(created, size):
+	"""
+	mp4_header: ftyp, moov/mvhd with the creation time and the header of an mdat
+		that runs to the end of a file of size bytes
+	"""
+	qt_time = int(created) + MP4_EPOCH_OFFSET
+	mvhd_body = struct.pack(">B3xIIII", 0, qt_time, qt_time, 1000, 0) + b'\0' * 80
+	mvhd = struct.pack(">I4s", 8 + len(mvhd_body), b'mvhd') + mvhd_body
+	moov = struct.pack(">I4s", 8 + len(mvhd), b'moov') + mvhd
+	ftyp = struct.pack(">I4s4sI", 16, b'ftyp', b'isom', 0)
+	header = ftyp + moov
+	mdat_size = max(8, size - len(header))
+	return header + struct.pack(">I4s", mdat_size, b'mdat')
+
+def seeded_bytes(seed, length):
+	# The same bytes for the same seed, different bytes for every other seed
+	block = hashlib.sha1(seed).digest()
+	return (block * (length // len(block) + 1))[:length]
+
+def write_test_file(path, size, created, with_header=False):
+	with open(path, 'wb') as f:
+		if with_header:
+			f.write(mp4_header(created, size))
+		# Seeded bytes at both ends so no two clips have the same content, the
+		# middle is sparse so a 4G clip still costs next to nothing to make
+		head = min(size, CONTENT_BLOCK_SIZE) - f.tell()
+		if head > 0:
+			f.write(seeded_bytes(path, head))
+		tail = min(size - f.tell(), CONTENT_BLOCK_SIZE)
+		if tail > 0:
+			f.seek(size - tail)
+			f.write(seeded_bytes(path + ":tail", tail))
+	os.utime(path, (created, created))
+
+def create_test_files(target, count=test_folder_count, sizes=(0,), profile='bullet', dcim=False,
+		with_header=False, start=None, interval=1):
+	"""
+	create_test_files: Makes count clips in target, each interval seconds after the
+		last. Sizes are used in turn. Returns the clip paths
+	"""
+	(name_format, folder_format, sidecars) = PROFILES[profile]
+	if start is None:
+		start = int(time.time()) - count * interval
+	paths = []
+	for i in range(0, count):
+		folder = target
+		if dcim:
+			folder = os.path.join(target, "DCIM", folder_format.format(100 + i // DCIM_FOLDER_SIZE))
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+
+		test_name_format = name_format.format(i)
+		path = os.path.join(folder, test_name_format)
+		created = start + i * interval
+		write_test_file(path, sizes[i % len(sizes)], created, with_header)
+		stem = os.path.splitext(path)[0]
+		for sidecar in sidecars:
+			write_test_file(stem + sidecar, 1024, created)
+		paths.append(path)
+	return paths
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+if __name__ == "__main__":
+
+	# Find our arguments
+	parser = argparse.ArgumentParser(description = "Script to create a bunch of test files for the unique file script")
+	parser.add_argument('-t', '--target',   default="target", help = "The path to the source folder")
+	parser.add_argument('-c', '--count',	type=int, default=test_folder_count, help = "Number of clips to create")
+	parser.add_argument('-s', '--size',	default="0", help = "Clip sizes used in turn, comma separated, like 0,64K,4G")
+	parser.add_argument('-p', '--profile',	choices=sorted(PROFILES), default='bullet', help = "Camera the clips look like")
+	parser.add_argument('--dcim',		action="store_true", help = "Put the clips in DCIM/100XXX folders like a camera card")
+	parser.add_argument('--mp4-header',	action="store_true", help = "Start each clip with a minimal MP4 header holding its creation time")
+	parser.add_argument('--interval',	type=int, default=1, help = "Seconds between the times of each clip")
+	args = parser.parse_args()
+
+	# Create a bunch of test files in the target folder
+	create_test_files(args.target, args.count, [parse_size(s) for s in args.size.split(",")], args.profile,
+		args.dcim, args.mp4_header, interval=args.interval)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+"""
+################################################################################
+# Copyright (c) 2017 Robert Hill. All rights reserved.
+################################################################################
+	NAME:
+	ospi_simulator.py
+
+	DESCRIPTION:
+	A local stand-in for OpenSprinkler controllers and a benchmark of
+	sprinklerdetector.py against them. Each simulated controller serves
+	/js, /jc, /ja and /jp under /c/<number>/ from a flow trace, either scripted
+	(idle, a schedule, household use, sensor blips, a slow leak or a burst
+	pipe) or recorded (a CSV, or a .flow history from the detector).
+
+	The monitors run on a simulated clock, so hours of checks take
+	seconds, and the benchmark reports how long each leak took to alert,
+	the alerts raised where there was no leak, and how many polls a
+	second the detector managed over HTTP.
+
+	Serve only, for trying the detector by hand:
+	ospi_simulator.py --serve --port 8080 --scenarios leak
+	sprinklerdetector.py -c http://127.0.0.1:8080/c/0,pw
+
+	HISTORY:
+	10/18/26 -RH
+	Initial creation
+
+################################################################################
+"""
+
+################################################################################
+# IMPORT
+################################################################################
+import argparse, bisect, heapq, json, logging, random, sys, threading, time, Queue
+import BaseHTTPServer, SocketServer
+
+import sprinklerdetector
+from sprinklerdetector import ControllerMonitor, OSPIController, SimulatedClock, FlowSeriesStore
+
+################################################################################
+# CONSTANT
+################################################################################
+SCENARIOS	= ('idle', 'schedule', 'usage', 'blip', 'leak', 'burst')
+LEAK_SCENARIOS	= ('leak', 'burst')			# Scenarios that should end in an alert
+DEFAULT_DURATION = 6 * 3600				# Simulated seconds per run
+STATIONS	= 8					# Stations on each simulated controller
+SCHEDULE_EVERY	= 8 * 3600				# Seconds between the simulated programs
+SCHEDULE_RUN	= 1200					# Seconds each station waters for
+SCHEDULE_FLOW	= 30					# Flow while a station waters
+USAGE_FLOW	= 12					# Flow of a hose or tap left on for a few minutes
+BLIP_FLOW	= 4					# Flow of a sensor glitch
+LEAK_FLOW	= 6					# Flow of a slow leak
+BURST_FLOW	= 80					# Flow of a broken pipe
+
+################################################################################
+# CLASSES
+################################################################################
+class FlowTrace(object):
+	"""FlowTrace - flow and running stations over time, as steps (seconds from the start, flow, stations)"""
+
+	def __init__(self, steps, leak_start=None):
+		self.steps = sorted(steps)
+		self.offsets = [step[0] for step in self.steps]
+		self.leak_start = leak_start		# Seconds in where a leak starts, None when there isn't one
+
+	def at(self, offset):
+		i = bisect.bisect_right(self.offsets, offset) - 1
+		if i < 0:
+			return (0, ())
+		return self.steps[i][1:]
+
+	@classmethod
+	def from_csv(cls, path):
+		# seconds,flow[,station;station...]
+		steps = []
+		with open(path) as f:
+			for line in f:
+				fields = line.strip().split(",")
+				if not fields[0] or fields[0].startswith("#"):
+					continue
+				stations = tuple(int(s) for s in fields[2].split(";") if s) if len(fields) > 2 else ()
+				steps.append((float(fields[0]), float(fields[1]), stations))
+		return cls(steps)
+
+	@classmethod
+	def from_flow_file(cls, path):
+		# The raw history the detector keeps, see FlowSeriesStore
+		record = FlowSeriesStore.RECORD
+		steps = []
+		with open(path, 'rb') as f:
+			data = f.read()
+		for i in range(len(data) // record.size):
+			(when, flow, mask) = record.unpack_from(data, i * record.size)
+			stations = tuple(bit + 1 for bit in range(32) if mask & (1 << bit))
+			steps.append((when, flow, stations))
+		if steps:
+			first = steps[0][0]
+			steps = [(when - first, flow, stations) for (when, flow, stations) in steps]
+		return cls(steps)
+
+	@classmethod
+	def load(cls, path):
+		if path.endswith(".flow"):
+			return cls.from_flow_file(path)
+		return cls.from_csv(path)
+
+	@classmethod
+	def scripted(cls, scenario, duration, rng):
+		"""
+		scripted: Makes a trace of duration seconds for one of SCENARIOS
+		"""
+		steps = [(0, 0, ())]
+		leak_start = None
+		if scenario == 'schedule':
+			for start in range(3600, duration, SCHEDULE_EVERY):
+				for station in (1, 2, 3):
+					steps.append((start + (station - 1) * SCHEDULE_RUN, SCHEDULE_FLOW, (station,)))
+				steps.append((start + 3 * SCHEDULE_RUN, 0, ()))
+		elif scenario in ('usage', 'blip'):
+			(flow, lengths) = (USAGE_FLOW, (60, 240)) if scenario == 'usage' else (BLIP_FLOW, (30, 30))
+			for i in range(3):
+				start = rng.randint(0, duration - 300)
+				steps.append((start, flow, ()))
+				steps.append((start + rng.randint(*lengths), 0, ()))
+		elif scenario in LEAK_SCENARIOS:
+			leak_start = rng.randint(duration // 4, duration // 2)
+			steps.append((leak_start, LEAK_FLOW if scenario == 'leak' else BURST_FLOW, ()))
+		elif scenario != 'idle':
+			raise ValueError("unknown scenario {0}".format(scenario))
+		# Events can overlap, the later step wins
+		return cls(sorted(steps, key=lambda step: step[0]), leak_start)
+
+class SimulatedController(object):
+	"""SimulatedController - answers like an OpenSprinkler would, from a trace read at the clock's time"""
+
+	def __init__(self, name, scenario, trace, clock, start, stations=STATIONS):
+		self.name = name
+		self.scenario = scenario
+		self.trace = trace
+		self.clock = clock
+		self.start = start
+		self.stations = stations
+		self.requests = 0
+
+	def reading(self):
+		return self.trace.at(self.clock.time() - self.start)
+
+	def js(self):
+		(flow, running) = self.reading()
+		return {"sn": [1 if i + 1 in running else 0 for i in range(self.stations)], "nstations": self.stations}
+
+	def jc(self):
+		(flow, running) = self.reading()
+		return {"devt": int(self.clock.time()), "nbrd": 1, "en": 1, "rd": 0, "flcrt": flow, "flwrt": 30}
+
+	def ja(self):
+		return {"settings": self.jc(), "status": self.js()}
+
+	def jp(self):
+		# Scripted schedules run from the trace, not from programs
+		return {"nprogs": 0, "nboards": 1, "mnp": 40, "mnst": 4, "pnsize": 32, "pd": []}
+
+class SimulatorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""SimulatorHandler - /c/<number>/<command>, or /<command> for the first controller"""
+
+	protocol_version = "HTTP/1.1"
+	# Buffer the status line, headers and body and send them as one write. Unbuffered
+	# they go out as small writes and keep-alive requests stall on delayed ACKs
+	wbufsize = -1
+
+	def do_GET(self):
+		parts = self.path.split("?")[0].strip("/").split("/")
+		number = 0
+		if len(parts) == 3 and parts[0] == "c" and parts[1].isdigit():
+			number = int(parts[1])
+			parts = parts[2:]
+		controllers = self.server.controllers
+		if len(parts) != 1 or parts[0] not in ("js", "jc", "ja", "jp") or number >= len(controllers):
+			self.reply(404, {"result": 404})
+			return
+		controller = controllers[number]
+		controller.requests += 1
+		self.reply(200, getattr(controller, parts[0])())
+
+	def reply(self, status, body):
+		data = json.dumps(body)
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+		self.wfile.flush()
+
+	def log_message(self, *args):
+		pass
+
+class SimulatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""SimulatorServer - every simulated controller behind one local port"""
+
+	daemon_threads = True
+	request_queue_size = 128
+
+	def __init__(self, controllers, port=0):
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), SimulatorHandler)
+		self.controllers = controllers
+		self._thread = None
+
+	def address(self, number):
+		return "http://127.0.0.1:{0}/c/{1}".format(self.server_address[1], number)
+
+	def start(self):
+		self._thread = threading.Thread(target=self.serve_forever, name="simulator")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+class RecordingNotifier(object):
+	"""RecordingNotifier - takes the detector's alerts in place of OSPINotifier, with the simulated time they were raised"""
+
+	def __init__(self, clock):
+		self.clock = clock
+		self.alerts = []
+		self._lock = threading.Lock()
+
+	def notify(self, controller, level, message):
+		with self._lock:
+			self.alerts.append((self.clock.time(), controller, level))
+		return True
+
+	def close(self, timeout=None):
+		pass
+
+class Simulation(object):
+	"""Simulation - polls every simulated controller over HTTP on the simulated clock and scores the alerts"""
+
+	def __init__(self, args):
+		self.args = args
+		self.clock = SimulatedClock(start=1800000000)
+		self.notifier = RecordingNotifier(self.clock)
+		self.polls = 0
+		self.controllers = make_controllers(args, self.clock)
+		self.server = SimulatorServer(self.controllers, args.port)
+
+	def monitors(self):
+		monitors = []
+		for (i, controller) in enumerate(self.controllers):
+			ospi = OSPIController(self.server.address(i), "simulated", controller.name, self.args.ja)
+			monitors.append(ControllerMonitor(ospi, self.args.interval, clock=self.clock, adaptive=self.args.adaptive))
+		return monitors
+
+	def run(self):
+		"""
+		run: Polls until the simulated duration is up, returns the results
+		"""
+		sprinklerdetector.NOTIFIER = self.notifier
+		sprinklerdetector.CONNECTION_POOL.max_idle = self.args.workers
+		self.server.start()
+		due = Queue.Queue()
+		done = Queue.Queue()
+		workers = [threading.Thread(target=self._worker, args=(due, done)) for i in range(self.args.workers)]
+		for t in workers:
+			t.daemon = True
+			t.start()
+
+		end = self.clock.time() + self.args.duration
+		schedule = [(self.clock.time(), i, monitor) for (i, monitor) in enumerate(self.monitors())]
+		heapq.heapify(schedule)
+		started = time.time()
+		try:
+			while schedule and schedule[0][0] < end:
+				# Everything due at the same moment is polled at once, like the daemon would
+				when = schedule[0][0]
+				self.clock.set(when)
+				batch = 0
+				while schedule and schedule[0][0] <= when:
+					due.put(heapq.heappop(schedule)[1:])
+					batch += 1
+				for i in range(batch):
+					(position, monitor, delay) = done.get()
+					heapq.heappush(schedule, (when + delay, position, monitor))
+				self.polls += batch
+		finally:
+			wall = time.time() - started
+			for t in workers:
+				due.put(None)
+			for t in workers:
+				t.join()
+			# Hang up the keep-alive connections so the server threads finish
+			sprinklerdetector.CONNECTION_POOL.close()
+			self.server.stop()
+		return self.results(wall)
+
+	def _worker(self, due, done):
+		while True:
+			item = due.get()
+			if item is None:
+				break
+			(position, monitor) = item
+			try:
+				delay = monitor.poll()
+			except Exception as e:
+				sprinklerdetector.log.error("Simulation:_worker: poll of {0} failed with {1}".format(monitor.controller.name,e))
+				delay = monitor.interval
+			done.put((position, monitor, delay))
+
+	def results(self, wall):
+		first_alert = {}
+		for (when, name, level) in sorted(self.notifier.alerts):
+			first_alert.setdefault(name, when)
+
+		scenarios = {}
+		for controller in self.controllers:
+			result = scenarios.setdefault(controller.scenario, {'controllers': 0, 'alerted': 0, 'false_alerts': 0, 'latencies': []})
+			result['controllers'] += 1
+			alerted = first_alert.get(controller.name)
+			if alerted is None:
+				continue
+			result['alerted'] += 1
+			leak_start = controller.trace.leak_start
+			if leak_start is None or alerted < controller.start + leak_start:
+				result['false_alerts'] += 1
+			else:
+				result['latencies'].append(alerted - controller.start - leak_start)
+
+		for result in scenarios.values():
+			latencies = sorted(result.pop('latencies'))
+			result['false_positive_rate'] = round(result['false_alerts'] / float(result['controllers']), 3)
+			if latencies:
+				result['latency_median'] = latencies[len(latencies) // 2]
+				result['latency_max'] = latencies[-1]
+
+		return {'controllers': len(self.controllers), 'duration': self.args.duration, 'polls': self.polls,
+			'requests': sum(c.requests for c in self.controllers), 'alerts': len(self.notifier.alerts),
+			'wall_seconds': round(wall, 3), 'polls_per_second': round(self.polls / wall, 1) if wall > 0 else None,
+			'scenarios': scenarios}
+
+################################################################################
+# FUNCTIONS
+################################################################################
+def print_results(results):
+	print("{0} controllers, {1}s simulated in {2}s, {3} polls ({4}/s), {5} requests, {6} alerts".format(
+		results['controllers'], results['duration'], results['wall_seconds'], results['polls'],
+		results['polls_per_second'], results['requests'], results['alerts']))
+	print("{0:>10} {1:>12} {2:>8} {3:>13} {4:>10} {5:>15} {6:>12}".format(
+		"scenario", "controllers", "alerted", "false alerts", "fp rate", "median latency", "max latency"))
+	for (scenario, result) in sorted(results['scenarios'].items()):
+		print("{0:>10} {1:>12} {2:>8} {3:>13} {4:>10} {5:>15} {6:>12}".format(scenario, result['controllers'],
+			result['alerted'], result['false_alerts'], result['false_positive_rate'],
+			result.get('latency_median', "-"), result.get('latency_max', "-")))
+
+def make_controllers(args, clock):
+	# The scenarios in turn, or the recorded trace on all of them
+	rng = random.Random(args.seed)
+	scenarios = args.scenarios.split(",")
+	recorded = FlowTrace.load(args.trace) if args.trace else None
+	controllers = []
+	for i in range(args.controllers):
+		scenario = "recorded" if recorded else scenarios[i % len(scenarios)]
+		trace = recorded or FlowTrace.scripted(scenario, args.duration, rng)
+		controllers.append(SimulatedController("sim{0}".format(i), scenario, trace, clock, clock.time()))
+	return controllers
+
+def serve(args):
+	# Just the stand-in, on real time so the detector can be pointed at it by hand
+	controllers = make_controllers(args, sprinklerdetector.CLOCK)
+	server = SimulatorServer(controllers, args.port)
+	for i in range(min(len(controllers), 10)):
+		print("{0} {1}".format(server.address(i), controllers[i].scenario))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.server_close()
+
+################################################################################
+# RUN AS SCRIPT
+################################################################################
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description = "Simulated OpenSprinkler controllers, and a benchmark of the sprinkler detector against them")
+	parser.add_argument('-n', '--controllers', type=int, default=60, help = "Simulated controllers")
+	parser.add_argument('-s', '--scenarios', default=",".join(SCENARIOS), help = "Comma separated scenarios, given to the controllers in turn")
+	parser.add_argument('-t', '--trace',	default=None, help = "Replay this CSV (seconds,flow,station;station) or .flow history on every controller instead")
+	parser.add_argument('--duration',	type=int, default=DEFAULT_DURATION, help = "Simulated seconds to run")
+	parser.add_argument('-i', '--interval',	type=int, default=sprinklerdetector.POLL_INTERVAL, help = "Seconds between checks of each controller")
+	parser.add_argument('-w', '--workers',	type=int, default=sprinklerdetector.POLL_WORKERS, help = "Controllers polled at the same time")
+	parser.add_argument('--ja',		action="store_true", help = "Poll /ja instead of /js and /jc")
+	parser.add_argument('--adaptive',	action="store_true", help = "Back off the polls and verify with fast samples, like the detector's --adaptive")
+	parser.add_argument('--seed',		type=int, default=1, help = "Seed for the scripted traces")
+	parser.add_argument('--port',		type=int, default=0, help = "Port to serve on, any free one by default")
+	parser.add_argument('--serve',		action="store_true", help = "Only serve the controllers, in real time, until interrupted")
+	parser.add_argument('--debug',		action="store_true", help = "Keep the detector's debug log, it slows the polls down")
+	parser.add_argument('--json',		default=None, help = "Also write the results as JSON to this file")
+	args = parser.parse_args()
+
+	if not args.debug:
+		sprinklerdetector.log.setLevel(logging.ERROR)
+
+	if args.serve:
+		serve(args)
+		sys.exit(0)
+
+	results = Simulation(args).run()
+	print_results(results)
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
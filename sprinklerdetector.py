@@ -20,13 +20,77 @@
 	03/27/17 -RH
 	Initial developtment
 
+	10/18/26 -RH
+	Added a daemon mode (--daemon). One long running process polls one or
+	more controllers on a schedule, runs the verify passes as a state
+	machine instead of sleeping, and stops cleanly on SIGTERM. Fixed the
+	running stations list and the warning count in the verify passes.
+
+	10/18/26 -RH
+	Queries go through a keep-alive connection pool with timeouts and
+	retries. A status check fetches /js and /jc at the same time, or just
+	/ja on firmware that has it (--ja).
+
+	10/18/26 -RH
+	Added fleet mode (--fleet). Controllers come from a JSON file, each
+	with its own interval, and polls run on a pool of worker threads so
+	a slow or unreachable site doesn't hold up the rest.
+
+	10/18/26 -RH
+	Every reading is kept in a small binary history per controller, with
+	hourly rollups. Flow with no station running is compared against the
+	usual unscheduled flow for that weekday and hour, so regular use no
+	longer starts a verify on its own.
+
+	10/18/26 -RH
+	The verify passes feed a streaming leak detector (smoothed flow, a
+	CUSUM of flow over the usual, and how long flow has gone on). Alert
+	levels rise as soon as a rule says so and fall back with hysteresis,
+	each new level is sent once, and the verify ends on the first zero
+	reading or at EMERGENCY instead of always running every pass.
+
+	10/18/26 -RH
+	Alerts go through a background notification queue so a slow mail
+	server can't hold up polling. Email keeps one SMTP session open
+	between alerts, and webhooks (--webhook) or a local command
+	(--command) can be added. Failed sends are retried with backoff, and
+	repeats are dropped per controller and level.
+
+	10/18/26 -RH
+	Monitors and verifies take their time from a clock object, so
+	ospi_simulator.py can run them against simulated controllers at any
+	speed instead of waiting out the real verify interval.
+
+	10/18/26 -RH
+	Added metrics: request latency per endpoint, poll results, the flow
+	and alert level of each controller and time spent verifying. They
+	are served as Prometheus text (--metrics-port) or written as a JSON
+	snapshot (--metrics-file). The log line on every property get and set
+	is off unless --trace is given.
+
+	10/18/26 -RH
+	Polling can adapt to what the controller is doing (--adaptive). After
+	two hours of zero flow the checks back off, up to
+	ADAPTIVE_MAX_INTERVAL, and a verify starts sampling
+	VERIFY_FAST_INTERVAL seconds apart, easing off to VERIFY_INTERVAL
+	over the same window the fixed passes covered. Program start and end
+	times are read from /jp so a backed off check still lands just after
+	each run starts and stops. The detector rules weigh readings by the
+	time between them so faster sampling doesn't make them any jumpier.
+	It's off by default, a leak that starts during a backed off check is
+	found later than on the fixed cadence. No alert is raised until the
+	flow has been seen on LEAK_CONFIRM_SAMPLES readings in a row, one
+	spike isn't a leak, so every verify takes its first sample
+	VERIFY_FAST_INTERVAL seconds in to confirm the reading that started it.
+
 ################################################################################
 """
 
 ################################################################################
 # IMPORT
 ################################################################################
-import os, logging, sys,  urllib2, json, time, smtplib
+import os, logging, json, time, smtplib, argparse, signal, heapq, threading, httplib, socket, urlparse, Queue, struct, mmap, re
+import urllib2, subprocess, collections, BaseHTTPServer, SocketServer, datetime
 from email.mime.multipart import MIMEMultipart
 from email.MIMEText import MIMEText
 
@@ -41,6 +105,61 @@ PASS 	= "email password for server"		# Passwrd for email notification
 USER	= "youremail@address.com"		# User name for email notification
 RECP	= ['john@email.com','doe@email.com']	# List of users to send email to
 SENDER	= 'senderaddy@email.com'		# The sender of the message
+SMTP_HOST = 'smtp.gmail.com'			# Mail server
+SMTP_PORT = 587					# Mail server port
+SMTP_STARTTLS = True				# Encrypt the session before logging in
+SMTP_LOGIN = True				# Log in with USER and PASS
+
+# NOTIFY GLOBALS
+NOTIFY_QUEUE_SIZE = 1000			# Alerts waiting to be sent before new ones are dropped
+NOTIFY_RETRIES	= 3				# Retries of a failed send
+NOTIFY_BACKOFF	= 2.0				# Seconds before the first retry, doubled each time
+NOTIFY_DEDUP_WINDOW = 3600			# Seconds the same alert for a controller isn't sent again
+NOTIFY_RATE_LIMIT = 6				# Most alerts of one level per controller in NOTIFY_RATE_WINDOW
+NOTIFY_RATE_WINDOW = 3600			# Seconds the rate limit counts over
+NOTIFY_IDLE	= 60				# Seconds without alerts before the SMTP session is closed
+
+# SCHEDULE GLOBALS
+POLL_INTERVAL	= 300				# Seconds between checks in daemon mode
+VERIFY_INTERVAL	= 90				# Seconds between the verify passes
+VERIFY_PASSES	= 5				# Verify passes before the warning level is reported
+VERIFY_FAST_INTERVAL = 15			# Seconds to the first adaptive verify sample, doubled up to VERIFY_INTERVAL
+ADAPTIVE_IDLE_AFTER = 2 * 3600			# Seconds of zero flow before the checks back off
+ADAPTIVE_MAX_INTERVAL = 600			# Longest backed off check
+ADAPTIVE_EVENT_DELAY = 60			# Seconds after a program starts or ends to check on it
+ADAPTIVE_SCHEDULE_REFRESH = 6 * 3600		# Seconds between reads of the programs from /jp
+
+# HTTP GLOBALS
+HTTP_TIMEOUT	= 10				# Seconds before a controller request gives up
+HTTP_RETRIES	= 2				# Retries of a failed request
+HTTP_BACKOFF	= 1.0				# Seconds before the first retry, doubled each time
+HTTP_MAX_IDLE	= 2				# Idle connections kept per controller
+
+# HISTORY GLOBALS
+DATA_DIR	= os.path.expanduser("~/.sprinklerdetector")	# Flow history, one set of files per controller
+BASELINE_WEEKS	= 4				# Weeks of hourly rollups the baselines are built from
+BASELINE_MIN_SAMPLES = 30			# Readings a weekday/hour needs before its baseline is used
+BASELINE_SIGMA	= 3.0				# Standard deviations over the usual flow that count as unusual
+BASELINE_MARGIN	= 1.0				# Flow over the usual that is never unusual, for quiet hours
+
+# DETECTION GLOBALS
+LEAK_EWMA_ALPHA	= 0.3				# Weight of the newest reading in the smoothed flow
+LEAK_FLOW_STEP	= 20.0				# Smoothed flow over the usual for each alert level
+LEAK_CUSUM_SLACK = 1.0				# Flow over the usual the CUSUM lets go
+LEAK_CUSUM_STEP	= 40.0				# CUSUM total for each alert level
+LEAK_SUSTAINED_STEP = 150			# Seconds of unbroken flow for each alert level
+LEAK_HYSTERESIS	= 0.5				# How far under a level's score before it is cleared
+LEAK_STOP_SAMPLES = 1				# Zero readings in a row that mean the flow has stopped
+LEAK_CONFIRM_SAMPLES = 2			# Readings in a row with flow before any alert, one spike isn't a leak
+LEAK_SAMPLE_SECONDS = 90			# Sample spacing the EWMA weight and CUSUM slack are given for
+
+# METRICS GLOBALS
+METRICS_INTERVAL = 60				# Seconds between JSON snapshots
+LATENCY_BUCKETS	= (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)	# Request latency histogram, seconds
+TRACE_ACCESS	= False				# Log every property get and set, only for chasing a bug
+
+# FLEET GLOBALS
+POLL_WORKERS	= 16				# Most controllers polled at the same time
 
 ################################################################################
 # LOGGING
@@ -62,80 +181,697 @@ class ExecuteScript(object):
 	"""ExecuteScript - run the script"""
 
 	@classmethod
-	def run(self):
+	def run(self, controller=None, data_dir=None, adaptive=False):
+		# One check, and the verify passes if the flow looks wrong. For CRON.
+		monitor = ControllerMonitor(controller or OSPIController(), data_dir=data_dir, adaptive=adaptive)
+		wait = monitor.poll()
+		while monitor.state == ControllerMonitor.VERIFYING:
+			monitor.clock.sleep(wait)
+			wait = monitor.poll()
+
+	@classmethod
+	def run_daemon(self, controllers, interval, workers=POLL_WORKERS, data_dir=None, adaptive=False):
+		monitors = [ControllerMonitor(controller, controller.interval or interval, data_dir, adaptive=adaptive) for controller in controllers]
+		OSPIDaemon(monitors, workers).run()
+
+	@classmethod
+	def load_fleet(self, path):
+		"""
+		load_fleet: Reads a fleet file, returns (controllers, workers)
+
+		{"workers": 8,
+		 "controllers": [{"name": "north", "address": "http://10.0.1.5:8080",
+				"password": "<md5>", "interval": 300, "ja": true}]}
+		"""
+		with open(path) as f:
+			fleet = json.load(f)
+		controllers = [OSPIController(entry["address"], entry.get("password"), entry.get("name"),
+			entry.get("ja", False), entry.get("interval")) for entry in fleet["controllers"]]
+		log.debug("ExecuteScript:load_fleet: {0} controllers from {1}".format(len(controllers),path))
+		return (controllers, fleet.get("workers", POLL_WORKERS))
+
+class OSPIController(object):
+	"""OSPIController - where a controller is and how to log in to it"""
+
+	def __init__(self, address=None, password=None, name=None, use_ja=False, interval=None):
+		self.address = address or OSPI
+		self.password = password or MD5PASS
+		self.name = name or self.address
+		self.use_ja = use_ja		# Firmware 2.1.9+ answers /ja with everything in one reply
+		self.interval = interval	# Seconds between checks, None for the daemon's default
+
+	@classmethod
+	def from_argument(cls, argument, use_ja=False):
+		# address,md5password from the command line
+		(address, sep, password) = argument.partition(",")
+		return cls(address, password or None, use_ja=use_ja)
 
-		# Is the schedule running? 
+	def url(self, command):
+		return "{0}/{1}?pw={2}".format(self.address,command,self.password)
+
+class Clock(object):
+	"""Clock - where the monitors get the time from, the real one"""
+
+	def time(self):
+		return time.time()
+
+	def sleep(self, seconds):
+		time.sleep(seconds)
+
+class SimulatedClock(Clock):
+	"""SimulatedClock - a clock that only moves when told to, sleeping moves it straight on"""
+
+	def __init__(self, start=None):
+		self.now = time.time() if start is None else start
+		self._lock = threading.Lock()
+
+	def time(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.advance(seconds)
+
+	def advance(self, seconds):
+		with self._lock:
+			self.now += max(0, seconds)
+
+	def set(self, when):
+		with self._lock:
+			self.now = max(self.now, when)
+
+class ControllerMonitor(object):
+	"""ControllerMonitor - the checks for one controller as a state machine, each poll does one step"""
+
+	IDLE		= "idle"
+	VERIFYING	= "verifying"
+
+	def __init__(self, controller, interval=POLL_INTERVAL, data_dir=None, clock=None, adaptive=False):
+		self.controller = controller
+		self.interval = interval
+		self.clock = clock or CLOCK
+		self.adaptive = adaptive
+		self.state = self.IDLE
+		self.verify = None
+		self.history = None
+		if data_dir:
+			self.history = FlowSeriesStore(data_dir, controller.name)
+		self.quiet_since = None			# When the flow was last seen go to zero
+		self.backoff = interval
+		self.schedule = None
+		self.schedule_read = None
+
+	def idle_delay(self, ospiprop):
+		"""
+		idle_delay: Seconds to the next check when nothing needs a closer look. Backs off
+			once the flow has been zero a while, but never past the next program start or end
+		"""
+		if not self.adaptive:
+			return self.interval
+		now = self.clock.time()
+		if not ospiprop.sampled:
+			# Couldn't read it, that says nothing about whether it's quiet
+			delay = self.interval
+		elif ospiprop.flow_value or ospiprop.stations_running != None:
+			self.quiet_since = None
+			delay = self.interval
+		else:
+			if self.quiet_since is None:
+				self.quiet_since = now
+				self.backoff = self.interval
+			delay = self.interval
+			if now - self.quiet_since >= ADAPTIVE_IDLE_AFTER:
+				self.backoff = min(self.backoff * 2, max(ADAPTIVE_MAX_INTERVAL, self.interval))
+				delay = self.backoff
+
+		if delay <= self.interval:
+			return delay
+		# Backed off, don't sleep through a program starting or a valve that should have closed
+		self.read_schedule(now)
+		if self.schedule is not None:
+			event = self.schedule.next_event(now)
+			if event is not None and event + ADAPTIVE_EVENT_DELAY - now < delay:
+				delay = max(1, event + ADAPTIVE_EVENT_DELAY - now)
+				log.debug("ControllerMonitor:idle_delay: {0} next check lines up with a program at {1}".format(self.controller.name,time.ctime(event)))
+		return delay
+
+	def read_schedule(self, now):
+		# /jp now and then, the programs hardly ever change
+		if self.schedule_read is not None and now - self.schedule_read < ADAPTIVE_SCHEDULE_REFRESH:
+			return
+		self.schedule_read = now
+		cg = CGIQuery()
+		cg.cgi_query = self.controller.url("jp")
+		if cg.cgi_query is not None:
+			try:
+				self.schedule = ProgramSchedule.from_jp(cg.cgi_query)
+			except (KeyError, IndexError, TypeError, ValueError) as e:
+				log.error("ControllerMonitor:read_schedule: {0} programs not understood, {1}".format(self.controller.name,e))
+				self.schedule = None
+
+	def record(self, ospiprop):
+		labels = {"controller": self.controller.name}
+		METRICS.inc("ospi_polls_total", dict(labels, result="ok" if ospiprop.sampled else "failed"))
+		if ospiprop.flow_value is not None:
+			METRICS.set("ospi_flow", labels, ospiprop.flow_value)
+		if self.history is not None and ospiprop.sampled:
+			self.history.append(self.clock.time(), ospiprop.flow_value, ospiprop.stations_running)
+
+	def flow_is_unusual(self, ospiprop):
+		# Without history any flow at all is unusual, like it always was
+		if self.history is None:
+			return bool(ospiprop.flow_value)
+		return self.history.is_unusual(self.clock.time(), ospiprop.flow_value)
+
+	def poll(self):
+		"""
+		poll: Runs one check and returns the seconds until the next one is due
+		"""
+		if self.state == self.VERIFYING:
+			more = self.verify.verify_step()
+			self.record(self.verify.ospiprop)
+			METRICS.set("ospi_alert_level", {"controller": self.controller.name}, self.verify.detector.level)
+			if more:
+				return self.verify.poll_interval
+			ospiprop = self.verify.ospiprop
+			log.debug("ControllerMonitor:poll: {0} verify finished".format(self.controller.name))
+			METRICS.inc("ospi_verify_seconds_total", {"controller": self.controller.name}, self.clock.time() - self.verify.started)
+			METRICS.set("ospi_alert_level", {"controller": self.controller.name}, LeakDetector.NONE)
+			self.state = self.IDLE
+			self.verify = None
+			return self.idle_delay(ospiprop)
+
+		# Is the schedule running? Stations and flow come back together
 		ospiprop = OSPIProperties()
-		cospi = CheckOSPIStatus(ospiprop)
-		cospi.check_stations_running()
-		log.debug("ExecuteScript:run: stations running {0}".format(ospiprop.stations_running))
+		cospi = CheckOSPIStatus(ospiprop, self.controller)
+		cospi.check_status()
+		self.record(ospiprop)
+		log.debug("ControllerMonitor:poll: {0} stations running {1}".format(self.controller.name,ospiprop.stations_running))
+
+		if not ospiprop.sampled:
+			# Without both stations and flow we can't tell a leak from a schedule
+			log.debug("ControllerMonitor:poll: {0} poll failed, no sample".format(self.controller.name))
+			return self.idle_delay(ospiprop)
 
 		if ospiprop.stations_running != None:
 			# We're done if there's currently scheduled activity
-			log.debug("ExecuteScript:run: exiting, schedule is running")
-			sys.exit(0)
-	
+			log.debug("ControllerMonitor:poll: {0} schedule is running".format(self.controller.name))
+			return self.idle_delay(ospiprop)
+
 		# Check the flow control
-		cospi.check_flow_control_running()
-		
-		if ospiprop.flow_value == 0:
-			# We're done if there's currently scheduled activity
-			log.debug("ExecuteScript:run: exiting, flow is currently ZERO")
-			sys.exit(0)
+		if not self.flow_is_unusual(ospiprop):
+			# Flow is ZERO or what it usually is now, or we couldn't read it
+			log.debug("ControllerMonitor:poll: {0} flow {1} is not unusual".format(self.controller.name,ospiprop.flow_value))
+			return self.idle_delay(ospiprop)
+
+		# Heavy lifting section, run over the next polls
+		log.debug("ControllerMonitor:poll: CAUTION! {0} has no Scheudled Activity but the Flow Control is reading {1}".format(self.controller.name,ospiprop.flow_value))
+		baseline = self.history.baseline(self.clock.time()) if self.history is not None else None
+		self.quiet_since = None
+		# The first sample comes soon, the reading that started this can't alert on its own
+		self.verify = OSPIWaitAndVerify(ospiprop, self.controller, LeakDetector.default(baseline), self.clock, VERIFY_FAST_INTERVAL, self.adaptive)
+		METRICS.inc("ospi_verifies_total", {"controller": self.controller.name})
+		self.state = self.VERIFYING
+		return self.verify.poll_interval
+
+class ProgramSchedule(object):
+	"""
+	ProgramSchedule - when the controller's programs run, from /jp. Each program is
+	[flag, days0, days1, [start times], [station durations], name]. Sunrise and sunset
+	starts are left out, a check lined up with them isn't worth the guessing
+	"""
+
+	ENABLED		= 0x01
+	TYPE_MASK	= 0x30			# Flag bits 4-5, 0 is days of the week, 3 every days1 days
+	TYPE_INTERVAL	= 0x30
+	FIXED_STARTS	= 0x40			# Flag bit 6, otherwise start times are first, repeats, minutes between
+	START_SPECIAL	= 0xE000		# Disabled, sunset and sunrise start time bits
+	DURATION_SPECIAL = 65534		# Durations from here up are sunrise to sunset
+
+	def __init__(self, programs):
+		self.programs = programs
+
+	@classmethod
+	def from_jp(cls, jp):
+		return cls([program[:5] for program in jp.get("pd", []) if program[0] & cls.ENABLED])
+
+	def runs_on(self, program, day_start):
+		(flag, days0, days1) = program[:3]
+		day = datetime.date.fromtimestamp(day_start)
+		if flag & self.TYPE_MASK == self.TYPE_INTERVAL:
+			return days1 > 0 and (day.toordinal() - datetime.date(1970, 1, 1).toordinal()) % days1 == days0
+		return bool(days0 & (1 << day.weekday()))
+
+	def start_minutes(self, program):
+		(flag, starts) = (program[0], program[3])
+		if flag & self.FIXED_STARTS:
+			return [start for start in starts if start >= 0 and not start & self.START_SPECIAL]
+		(first, repeats, every) = starts[:3]
+		if first < 0 or first & self.START_SPECIAL:
+			return []
+		return [first + i * every for i in range(repeats + 1) if first + i * every < 1440]
+
+	def events(self, day_start):
+		"""
+		events: Start and end times of every run on the day starting at day_start
+		"""
+		events = []
+		for program in self.programs:
+			if not self.runs_on(program, day_start):
+				continue
+			length = sum(d for d in program[4] if d < self.DURATION_SPECIAL)
+			for minutes in self.start_minutes(program):
+				start = day_start + minutes * 60
+				events.extend((start, start + length))
+		return events
+
+	def next_event(self, now):
+		today = time.mktime(time.localtime(now)[:3] + (0, 0, 0, 0, 0, -1))
+		for day_start in (today, time.mktime(time.localtime(today + 36 * 3600)[:3] + (0, 0, 0, 0, 0, -1))):
+			upcoming = [event for event in self.events(day_start) if event > now]
+			if upcoming:
+				return min(upcoming)
+		return None
+
+class FlowSeriesStore(object):
+	"""
+	FlowSeriesStore - append only history of one controller's readings. Raw readings are
+	fixed size records (time, flow, running stations bitmask), complete hours of
+	unscheduled flow are rolled up into a second file. Both are read through mmap
+	and searched by time with a bisect, so a query never reads the whole history
+	"""
+
+	RECORD = struct.Struct("<IfI")		# time, flow, running stations bitmask (12 bytes)
+	ROLLUP = struct.Struct("<IIddf")	# hour, readings, sum, sum of squares, max (28 bytes)
+	TIME = struct.Struct("<I")		# Both record types start with their time
+
+	def __init__(self, directory, name):
+		safe_name = re.sub(r'[^A-Za-z0-9._-]+', '_', name)
+		self.raw_path = os.path.join(directory, safe_name + ".flow")
+		self.rollup_path = os.path.join(directory, safe_name + ".hourly")
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._baselines = None
+		self._baselines_hour = None
+
+	def append(self, when, flow, stations=None):
+		mask = 0
+		for station in stations or ():
+			# Stations past 32 share the top bit, we only need to know something ran
+			mask |= 1 << min(station - 1, 31)
+		with open(self.raw_path, 'ab') as f:
+			f.write(self.RECORD.pack(int(when), float(flow or 0), mask))
+
+	def readings(self, start=0, end=None):
+		"""
+		readings: Returns the (time, flow, mask) readings from start up to end
+		"""
+		return self._read(self.raw_path, self.RECORD, start, end)
+
+	def rollups(self, start=0, end=None):
+		"""
+		rollups: Returns the (hour, readings, sum, sum of squares, max) rollups from start up to end
+		"""
+		return self._read(self.rollup_path, self.ROLLUP, start, end)
+
+	def update_rollups(self, now=None):
+		"""
+		update_rollups: Rolls up the complete hours since the last rollup. Readings taken
+			while a station ran are left out, they're not what the baseline is about
+		"""
+		current_hour = int(now or time.time()) // 3600 * 3600
+		last = self._last_time(self.rollup_path, self.ROLLUP)
+		start = 0 if last is None else last + 3600
+		if start >= current_hour:
+			return 0
+
+		buckets = {}
+		for (when, flow, mask) in self.readings(start, current_hour):
+			if mask:
+				continue
+			hour = when // 3600 * 3600
+			bucket = buckets.setdefault(hour, [0, 0.0, 0.0, 0.0])
+			bucket[0] += 1
+			bucket[1] += flow
+			bucket[2] += flow * flow
+			bucket[3] = max(bucket[3], flow)
+		# An empty marker for the last hour, so the next update starts after it
+		buckets.setdefault(current_hour - 3600, [0, 0.0, 0.0, 0.0])
+
+		with open(self.rollup_path, 'ab') as f:
+			for hour in sorted(buckets):
+				if hour >= start:
+					(count, total, squares, peak) = buckets[hour]
+					f.write(self.ROLLUP.pack(hour, count, total, squares, peak))
+		log.debug("FlowSeriesStore:update_rollups: {0} hours rolled up into {1}".format(len(buckets),self.rollup_path))
+		return len(buckets)
+
+	def baseline(self, when):
+		"""
+		baseline: Returns (mean, standard deviation, readings) of unscheduled flow for the
+			weekday and hour of when, or for the hour of day when that weekday hasn't
+			got enough readings yet. None without enough history
+		"""
+		hour = int(when) // 3600 * 3600
+		if self._baselines_hour != hour:
+			self.update_rollups(when)
+			self._baselines = self._build_baselines(when)
+			self._baselines_hour = hour
+
+		(by_weekday, by_hour) = self._baselines
+		local = time.localtime(when)
+		for bucket in (by_weekday.get((local.tm_wday, local.tm_hour)), by_hour.get(local.tm_hour)):
+			if bucket and bucket[0] >= BASELINE_MIN_SAMPLES:
+				(count, total, squares) = bucket
+				mean = total / count
+				deviation = max(0.0, squares / count - mean * mean) ** 0.5
+				return (mean, deviation, count)
+		return None
+
+	def is_unusual(self, when, flow):
+		"""
+		is_unusual: True when flow is well over the usual unscheduled flow for when
+		"""
+		if not flow:
+			return False
+		baseline = self.baseline(when)
+		if baseline is None:
+			return True
+		(mean, deviation, count) = baseline
+		limit = mean + BASELINE_SIGMA * deviation + BASELINE_MARGIN
+		log.debug("FlowSeriesStore:is_unusual: flow {0}, usual {1:.2f} +/- {2:.2f}, limit {3:.2f}".format(flow,mean,deviation,limit))
+		return flow > limit
+
+	def _build_baselines(self, when):
+		by_weekday = {}
+		by_hour = {}
+		for (hour, count, total, squares, peak) in self.rollups(int(when) - BASELINE_WEEKS * 7 * 86400):
+			if count == 0:
+				continue
+			local = time.localtime(hour)
+			for (buckets, key) in ((by_weekday, (local.tm_wday, local.tm_hour)), (by_hour, local.tm_hour)):
+				bucket = buckets.setdefault(key, [0, 0.0, 0.0])
+				bucket[0] += count
+				bucket[1] += total
+				bucket[2] += squares
+		return (by_weekday, by_hour)
+
+	def _map(self, path):
+		# Read only map of path, None when it's missing or empty
+		try:
+			f = open(path, 'rb')
+		except IOError:
+			return None
+		with f:
+			if os.fstat(f.fileno()).st_size == 0:
+				return None
+			return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def _bisect(self, data, record, when):
+		# Index of the first record at or after when, records are in time order
+		low = 0
+		high = len(data) // record.size
+		while low < high:
+			middle = (low + high) // 2
+			if self.TIME.unpack_from(data, middle * record.size)[0] < when:
+				low = middle + 1
+			else:
+				high = middle
+		return low
+
+	def _read(self, path, record, start, end):
+		data = self._map(path)
+		if data is None:
+			return []
+		try:
+			first = self._bisect(data, record, start)
+			last = len(data) // record.size if end is None else self._bisect(data, record, end)
+			return [record.unpack_from(data, i * record.size) for i in range(first, last)]
+		finally:
+			data.close()
+
+	def _last_time(self, path, record):
+		data = self._map(path)
+		if data is None:
+			return None
+		try:
+			count = len(data) // record.size
+			if count == 0:
+				return None
+			return self.TIME.unpack_from(data, (count - 1) * record.size)[0]
+		finally:
+			data.close()
+
+class OSPIDaemon(object):
+	"""OSPIDaemon - keeps one process running and hands each monitor to a worker thread when it is due"""
+
+	def __init__(self, monitors, workers=POLL_WORKERS):
+		self.monitors = monitors
+		self.workers = max(1, min(workers, len(monitors)))
+		self._stop = threading.Event()
+		self._schedule = []
+		self._due = Queue.Queue()
+		self._done = Queue.Queue()
+		self._threads = []
+
+	def stop(self, signum=None, frame=None):
+		log.info("OSPIDaemon:stop: received signal {0}, stopping".format(signum))
+		self._stop.set()
+
+	def run(self):
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+
+		for i in range(self.workers):
+			t = threading.Thread(target=self._worker, name="poll-{0}".format(i))
+			t.daemon = True
+			t.start()
+			self._threads.append(t)
+
+		# Heap of (due time, position, monitor), position keeps the order stable. A
+		# monitor is off the heap while a worker has it, so its polls never overlap
+		now = time.time()
+		for (position, monitor) in enumerate(self.monitors):
+			heapq.heappush(self._schedule, (now, position, monitor))
+		log.info("OSPIDaemon:run: watching {0} controllers with {1} workers".format(len(self.monitors),self.workers))
+
+		while not self._stop.is_set():
+			while self._schedule and self._schedule[0][0] <= time.time():
+				(due, position, monitor) = heapq.heappop(self._schedule)
+				self._due.put((position, monitor))
+
+			wait = 1.0
+			if self._schedule:
+				wait = min(wait, max(0, self._schedule[0][0] - time.time()))
+			try:
+				# Short waits so SIGTERM is noticed quickly
+				(position, monitor, delay) = self._done.get(timeout=wait)
+			except Queue.Empty:
+				continue
+			heapq.heappush(self._schedule, (time.time() + delay, position, monitor))
+
+		for t in self._threads:
+			self._due.put(None)
+		# A worker in the middle of a request finishes it first, up to the HTTP timeout
+		deadline = time.time() + HTTP_TIMEOUT
+		for t in self._threads:
+			t.join(max(0, deadline - time.time()))
+		log.info("OSPIDaemon:run: stopped")
+
+	def _worker(self):
+		while True:
+			item = self._due.get()
+			if item is None:
+				break
+			(position, monitor) = item
+			try:
+				delay = monitor.poll()
+			except Exception as e:
+				# One bad controller or reply shouldn't stop the others
+				log.error("OSPIDaemon:_worker: poll of {0} failed with {1}".format(monitor.controller.name,e))
+				delay = monitor.interval
+			self._done.put((position, monitor, delay))
+
+class FlowRule(object):
+	"""FlowRule - one streaming test of the flow, update() scores each reading where 1.0 is WARNING, 2.0 CAUTION and 3.0 EMERGENCY"""
+
+	def __init__(self, expected=0.0, spread=0.0):
+		self.expected = expected		# Usual unscheduled flow right now, from the history
+		self.spread = spread			# and its standard deviation
+		self.last = None
+
+	def update(self, when, flow):
+		raise NotImplementedError
+
+	def weight(self, when):
+		# How many LEAK_SAMPLE_SECONDS this reading stands for, so the score doesn't depend on how often we sample
+		(last, self.last) = (self.last, when)
+		if last is None:
+			return 1.0
+		return max(0.0, when - last) / float(LEAK_SAMPLE_SECONDS)
+
+class EWMARule(FlowRule):
+	"""EWMARule - how far the smoothed flow is over the usual"""
+
+	def __init__(self, expected=0.0, spread=0.0, alpha=LEAK_EWMA_ALPHA, step=LEAK_FLOW_STEP):
+		super(EWMARule, self).__init__(expected, spread)
+		self.alpha = alpha
+		self.step = step
+		self.average = None
+
+	def update(self, when, flow):
+		weight = self.weight(when)
+		if self.average is None:
+			self.average = float(flow)
 		else:
-			# Heavy lifting section
-			ospiwait = OSPIWaitAndVerify(ospiprop)
-			ospiwait.verify_flow_activity()
-			
-			log.debug("ExecuteScript:run: CAUTION! There's no Scheudled Activity but the Flow Control is reading {0}".format(ospiprop.flow_value))
+			self.average += (1 - (1 - self.alpha) ** weight) * (flow - self.average)
+		return max(0.0, self.average - self.expected) / self.step
+
+class CUSUMRule(FlowRule):
+	"""CUSUMRule - adds up the flow over the usual, catches a small leak that never looks big"""
+
+	def __init__(self, expected=0.0, spread=0.0, slack=LEAK_CUSUM_SLACK, step=LEAK_CUSUM_STEP):
+		super(CUSUMRule, self).__init__(expected, spread)
+		self.slack = slack + spread
+		self.step = step
+		self.total = 0.0
+
+	def update(self, when, flow):
+		self.total = max(0.0, self.total + (flow - self.expected - self.slack) * self.weight(when))
+		return self.total / self.step
+
+class SustainedFlowRule(FlowRule):
+	"""SustainedFlowRule - how long the flow has gone on without a break"""
+
+	def __init__(self, expected=0.0, spread=0.0, step=LEAK_SUSTAINED_STEP):
+		super(SustainedFlowRule, self).__init__(expected, spread)
+		self.step = step
+		self.since = None
+
+	def update(self, when, flow):
+		if not flow:
+			self.since = None
+			return 0.0
+		if self.since is None:
+			self.since = when
+		return (when - self.since) / float(self.step)
+
+class LeakDetector(object):
+	"""LeakDetector - runs the rules over each reading and turns the highest score into an alert level"""
+
+	NONE		= 0
+	WARNING		= 1
+	CAUTION		= 2
+	EMERGENCY	= 3
+	LEVEL_NAMES	= {NONE: "NONE", WARNING: "WARNING", CAUTION: "CAUTION", EMERGENCY: "EMERGENCY"}
+
+	def __init__(self, rules, hysteresis=LEAK_HYSTERESIS, stop_samples=LEAK_STOP_SAMPLES, confirm_samples=LEAK_CONFIRM_SAMPLES):
+		self.rules = rules
+		self.hysteresis = hysteresis
+		self.stop_samples = stop_samples
+		self.confirm_samples = confirm_samples
+		self.level = self.NONE
+		self.score = 0.0
+		self.zero_samples = 0
+		self.flow_samples = 0
+
+	@classmethod
+	def default(cls, baseline=None):
+		# baseline is (mean, standard deviation, readings) from FlowSeriesStore.baseline
+		(expected, spread) = baseline[:2] if baseline else (0.0, 0.0)
+		return cls([EWMARule(expected, spread), CUSUMRule(expected, spread), SustainedFlowRule(expected, spread)])
+
+	@property
+	def stopped(self):
+		return self.zero_samples >= self.stop_samples
+
+	def update(self, when, flow):
+		"""
+		update: Scores one reading and returns the alert level. A level is reached as soon as
+			the score gets to it, once the flow has kept up for confirm_samples readings, and
+			only cleared once the score is hysteresis under it
+		"""
+		if flow is None:
+			# Couldn't read it, nothing to learn from this one
+			return self.level
+		self.zero_samples = 0 if flow else self.zero_samples + 1
+		self.flow_samples = self.flow_samples + 1 if flow else 0
+		self.score = max(rule.update(when, flow) for rule in self.rules)
+		while self.flow_samples >= self.confirm_samples and self.level < self.EMERGENCY and self.score >= self.level + 1:
+			self.level += 1
+		while self.level > self.NONE and self.score < self.level - self.hysteresis:
+			self.level -= 1
+		log.debug("LeakDetector:update: flow {0} score {1:.2f} level {2}".format(flow,self.score,self.LEVEL_NAMES[self.level]))
+		return self.level
 
 class OSPIWaitAndVerify(object):
 	"""OSPIWaitAndVerify - Flow control showed a positive feed, however scheuduled activity was Zero"""
 
-	def __init__(self, ospiprop):
+	def __init__(self, ospiprop, controller=None, detector=None, clock=None, poll_interval=VERIFY_INTERVAL, ease_off=True):
 		self.ospiprop = ospiprop
-		self.flow_value = self.ospiprop.flow_value	# Sets initial value, we'll use to compare with later value
-		self.pass_count = 5
-		self.warning_level = 0
+		self.controller = controller or OSPIController()
+		self.clock = clock or CLOCK
+		self.started = self.clock.time()
+		self.detector = detector or LeakDetector.default()
+		self.deadline = self.started + VERIFY_PASSES * VERIFY_INTERVAL	# The window the passes cover, however often we sample
+		self.poll_interval = poll_interval
+		self.ease_off = ease_off		# Double the sampling interval each pass, otherwise back to the VERIFY_INTERVAL passes
+		self.warning_level = LeakDetector.NONE	# Highest level we've sent
+		# The reading that started the verify counts, but never alerts on its own
+		self.detector.update(self.clock.time(), self.ospiprop.flow_value)
 
 	def verify_flow_activity(self):
 		# Each pass we'll see if the flow control changes, and if scheduled activity starts
-		while self.pass_count != 0:
-			# Check if scheduled activity started
-			cospi = CheckOSPIStatus(self.ospiprop)
-			cospi.check_stations_running()
-			cospi.check_flow_control_running()
-			log.debug("OSPIWaitAndVerify:verify_flow_activity: stations running is {0} and flow control is {1}".format(self.ospiprop.stations_running,self.ospiprop.flow_value))
-			
-			if self.ospiprop.stations_running != None:
-				# Scheduled activity started, we're done
-				sys.exit(0)
-
-			if self.ospiprop.flow_value == 0:
-				# Flow control is now Zero
-				sys.exit(0)
-			elif self.flow_value != self.ospiprop.flow_value:
-				self.warning += 1
-
-			self.pass_count -= 1
-			time.sleep(90)
-
-		# Check the warning level
-		if self.warning_level > 0:
-			# Need to notify the user that there's a problem
-			ospiemail = OSPIEmail()
-			if self.warning_level == 1:
-				# Message via email? 
-				ospiemail.send_email_message("WARNING LEVEL EVENT")
-				log.debug("OSPIWaitAndVerify:verify_flow_activity: WARNING level")
-			if self.warning_level > 2 and self.warning_level < 4:
-				# Message via email and text?
-				ospiemail.send_email_message("CAUTION LEVEL EVENT")
-				log.debug("OSPIWaitAndVerify:verify_flow_activity: CAUTION level")
-			if self.warning_level == 5:
-				# Message via email, text and ?? 
-				ospiemail.send_email_message("EMERGENCY LEVEL EVENT")
-				log.debug("OSPIWaitAndVerify:verify_flow_activity: EMERGENCY level")
+		while self.verify_step():
+			self.clock.sleep(self.poll_interval)
+
+	def verify_step(self):
+		"""
+		verify_step: One pass, returns True while more passes are needed
+		"""
+		# Check if scheduled activity started. Fresh properties each pass, a controller that
+		# stopped answering leaves them empty instead of repeating the last reading
+		self.ospiprop = OSPIProperties()
+		cospi = CheckOSPIStatus(self.ospiprop, self.controller)
+		cospi.check_status()
+		log.debug("OSPIWaitAndVerify:verify_flow_activity: stations running is {0} and flow control is {1}".format(self.ospiprop.stations_running,self.ospiprop.flow_value))
+		
+		if self.ospiprop.stations_running != None:
+			# Scheduled activity started, we're done
+			return False
+
+		# A failed poll is no sample, the detector keeps its level and we try again next pass.
+		# Flow without the stations is failed too, a schedule may have started
+		flow = self.ospiprop.flow_value if self.ospiprop.sampled else None
+		level = self.detector.update(self.clock.time(), flow)
+		if self.detector.stopped:
+			# Flow control is now Zero
+			return False
+
+		if self.escalate(level):
+			# Nothing left to find out
+			return False
+
+		# Sample fast at first and ease off to VERIFY_INTERVAL, ending on the deadline. Without
+		# easing off the passes land where the fixed ones always did
+		if self.ease_off:
+			next_interval = self.poll_interval * 2
+		else:
+			next_interval = VERIFY_INTERVAL - (self.clock.time() - self.started) % VERIFY_INTERVAL
+		self.poll_interval = min(next_interval, VERIFY_INTERVAL, self.deadline - self.clock.time())
+		return self.poll_interval > 0
+
+	def escalate(self, level):
+		# Each level is sent once, a level that clears and comes back isn't news. True at EMERGENCY
+		if level > self.warning_level:
+			self.warning_level = level
+			self.notify()
+		return level == LeakDetector.EMERGENCY
+
+	def notify(self):
+		# Need to notify the user that there's a problem
+		name = LeakDetector.LEVEL_NAMES[self.warning_level]
+		NOTIFIER.notify(self.controller.name, name, "{0} LEVEL EVENT".format(name))
+		log.debug("OSPIWaitAndVerify:verify_flow_activity: {0} level".format(name))
 
 class OSPIProperties(object):
 	"""OSPIProperties - Keep track of the properites we set for the run script"""
@@ -143,116 +879,642 @@ class OSPIProperties(object):
 	def __init__(self):
 		self._flow_value = None
 		self._stations_running = None
+		self.stations_known = False		# stations_running is None both for none running and for /js failing
+
+	@property
+	def sampled(self):
+		# Flow and stations both came back, a poll missing either one is no sample
+		return self._flow_value is not None and self.stations_known
 
 	@property
 	def flow_value(self):
-		log.debug("OSPIProperties:flow_value: flow value is {0}".format(self._flow_value))
+		if TRACE_ACCESS:
+			log.debug("OSPIProperties:flow_value: flow value is {0}".format(self._flow_value))
 		return self._flow_value
 
 	@flow_value.setter
 	def flow_value(self, value):
 		self._flow_value = value
-		log.debug("OSPIProperties:flow_value: setting new flow value {0}".format(self._flow_value))
+		if TRACE_ACCESS:
+			log.debug("OSPIProperties:flow_value: setting new flow value {0}".format(self._flow_value))
 
 	@property
 	def stations_running(self):
-		log.debug("OSPIProperties:stations_running: stations running {0}".format(self._stations_running))
+		if TRACE_ACCESS:
+			log.debug("OSPIProperties:stations_running: stations running {0}".format(self._stations_running))
 		return self._stations_running
 
 	@stations_running.setter	
 	def stations_running(self, stations):
 		self._stations_running = stations
-		log.debug("OSPIProperties:stations_running: setting stations running {0}".format(self._stations_running))
+		if TRACE_ACCESS:
+			log.debug("OSPIProperties:stations_running: setting stations running {0}".format(self._stations_running))
 
 
 class CheckOSPIStatus(object):
 	"""CheckOSPIStatus - checks various values in the JSON output for information"""
 
-	def __init__(self, ospiprop):
+	def __init__(self, ospiprop, controller=None, pool=None):
 		self.ospiprop = ospiprop
+		self.controller = controller or OSPIController()
+		self.pool = pool or CONNECTION_POOL
+
+	def check_status(self):
+		"""
+		check_status: Fills in stations running and flow value with one round of requests
+		"""
+		if self.controller.use_ja:
+			cg = CGIQuery(self.pool)
+			cg.cgi_query = self.controller.url("ja")
+			all_status = cg.cgi_query
+			if all_status is not None:
+				self.read_stations(all_status["status"])
+				self.read_flow(all_status["settings"])
+				return
+			if cg.status == 404:
+				# Older firmware, don't ask again
+				log.error("CheckOSPIStatus:check_status: {0} has no /ja, using /js and /jc".format(self.controller.name))
+				self.controller.use_ja = False
+			else:
+				return
+
+		# /jc on its own thread while we do /js, the controller answers both at once
+		cg_flow = CGIQuery(self.pool)
+		flow_thread = threading.Thread(target=cg_flow.run_query, args=(self.controller.url("jc"),))
+		flow_thread.start()
+		self.check_stations_running()
+		flow_thread.join()
+		if cg_flow.cgi_query is not None:
+			self.read_flow(cg_flow.cgi_query)
 
 	def check_stations_running(self):
-		cg = CGIQuery()
-		cg.cgi_query= "{0}/js?pw={1}".format(OSPI,MD5PASS)
+		cg = CGIQuery(self.pool)
+		cg.cgi_query= self.controller.url("js")
 		stations_active = cg.cgi_query
-		log.debug("CheckOSPIStatus:check_stations_running: CGIQuery return {0}".format(stations_active))
+		if TRACE_ACCESS:
+			log.debug("CheckOSPIStatus:check_stations_running: CGIQuery return {0}".format(stations_active))
+		if stations_active is not None:
+			self.read_stations(stations_active)
+
+	def check_flow_control_running(self):
+		cg = CGIQuery(self.pool)
+		cg.cgi_query= self.controller.url("jc")
+		flow_control_active = cg.cgi_query
+		if TRACE_ACCESS:
+			log.debug("CheckOSPIStatus:check_flow_control_running: CGIQuery return {0}".format(flow_control_active))
+		if flow_control_active is not None:
+			self.read_flow(flow_control_active)
 
+	def read_stations(self, stations_active):
 		# Look for "sn" in the json output and read in the list
 		list_stations = stations_active["sn"]
 
 		station_count = 0
+		running = []
 		for station in list_stations:
 			station_count += 1
 			if station != 0:
 				log.debug("CheckOSPIStatus:check_stations_running: Station {0} is running".format(station_count))
-				self.ospiprop.stations_running.append(station_count)
+				running.append(station_count)
 				# We have a active scheduled run, terminate
+		self.ospiprop.stations_running = running or None
+		self.ospiprop.stations_known = True
 
-	def check_flow_control_running(self):
-		cg = CGIQuery()
-		cg.cgi_query= "{0}/jc?pw={1}".format(OSPI,MD5PASS)
-		flow_control_active = cg.cgi_query
-		log.debug("CheckOSPIStatus:check_flow_control_running: CGIQuery return {0}".format(flow_control_active))
-
+	def read_flow(self, flow_control_active):
 		# Look for "flcrt" in the json output and read in the value
 		flow_control_running = flow_control_active["flcrt"]
 		self.ospiprop.flow_value = flow_control_running
 
 
+class OSPIHTTPError(httplib.HTTPException):
+	"""OSPIHTTPError - the controller answered, but not with a 200"""
+
+	def __init__(self, status, reason):
+		httplib.HTTPException.__init__(self, "HTTP {0} {1}".format(status, reason))
+		self.status = status
+
+
+class OSPIConnectionPool(object):
+	"""OSPIConnectionPool - keep-alive HTTP connections to each controller, with timeouts and retries"""
+
+	def __init__(self, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, max_idle=HTTP_MAX_IDLE):
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.max_idle = max_idle
+		self._idle = {}
+		self._lock = threading.Lock()
+
+	def get_json(self, url):
+		"""
+		get_json: GETs url and returns the decoded JSON. Raises OSPIHTTPError,
+			httplib.HTTPException or socket.error once the retries are used up
+		"""
+		parts = urlparse.urlsplit(url)
+		key = (parts.scheme, parts.hostname, parts.port)
+		path = parts.path or "/"
+		endpoint = path.rsplit("/", 1)[-1]
+		if parts.query:
+			path += "?" + parts.query
+
+		attempt = 0
+		while True:
+			(conn, reused) = self._checkout(key)
+			started = time.time()
+			try:
+				conn.request("GET", path, headers={"Connection": "keep-alive"})
+				response = conn.getresponse()
+				body = response.read()
+			except (httplib.HTTPException, socket.error) as e:
+				conn.close()
+				METRICS.inc("ospi_requests_total", {"endpoint": endpoint, "result": "error"})
+				if reused:
+					# The controller dropped an idle connection, that's not a real failure
+					log.debug("OSPIConnectionPool:get_json: stale connection to {0}, reconnecting".format(parts.hostname))
+					continue
+				if attempt >= self.retries:
+					raise
+				delay = self.backoff * (2 ** attempt)
+				attempt += 1
+				log.error("OSPIConnectionPool:get_json: {0} failed with {1}, retry {2} in {3}s".format(parts.hostname,e,attempt,delay))
+				time.sleep(delay)
+				continue
+
+			METRICS.observe("ospi_request_seconds", {"endpoint": endpoint}, time.time() - started)
+			METRICS.inc("ospi_requests_total", {"endpoint": endpoint, "result": str(response.status)})
+			if response.will_close:
+				conn.close()
+			else:
+				self._checkin(key, conn)
+			if response.status != 200:
+				raise OSPIHTTPError(response.status, response.reason)
+			return json.loads(body)
+
+	def _checkout(self, key):
+		with self._lock:
+			idle = self._idle.get(key)
+			if idle:
+				return (idle.pop(), True)
+		(scheme, host, port) = key
+		if scheme == "https":
+			return (httplib.HTTPSConnection(host, port, timeout=self.timeout), False)
+		return (httplib.HTTPConnection(host, port, timeout=self.timeout), False)
+
+	def _checkin(self, key, conn):
+		with self._lock:
+			idle = self._idle.setdefault(key, [])
+			if len(idle) < self.max_idle:
+				idle.append(conn)
+				return
+		conn.close()
+
+	def close(self):
+		with self._lock:
+			for idle in self._idle.values():
+				for conn in idle:
+					conn.close()
+			self._idle = {}
+
+
 class CGIQuery(object):
 	"""CGIQuery - class to query the device and return it's status"""
 
-	def __init__(self):
+	def __init__(self, pool=None):
+		self.pool = pool or CONNECTION_POOL
 		self._query = None
 		self._query_return = None
+		self.status = None
 
 	@property
 	def cgi_query(self):
-		log.debug('CGIQuery:getter: returning query {0}'.format(self._query_return))
+		if TRACE_ACCESS:
+			log.debug('CGIQuery:getter: returning query {0}'.format(self._query_return))
 		return self._query_return
 
 	@cgi_query.setter
 	def cgi_query(self, query):
-		self._query = query
-		self.run_query()
-		log.debug('CGIQuery:setter: setting query to {0}'.format(self._query))
+		self.run_query(query)
+		if TRACE_ACCESS:
+			log.debug('CGIQuery:setter: setting query to {0}'.format(self._query))
 
-	def run_query(self):
+	def run_query(self, query=None):
+		if query is not None:
+			self._query = query
 		try:
-			response = urllib2.urlopen(self._query)
-			chk = json.load(response)
-			log.debug('CGIQuery:run_query: chk return {0}'.format(chk))
-			response.close()
+			chk = self.pool.get_json(self._query)
 			self._query_return = chk
-			log.debug('CGIQuery:run_query: query_return {0}'.format(self._query_return))
+			self.status = 200
+			if TRACE_ACCESS:
+				log.debug('CGIQuery:run_query: query_return {0}'.format(self._query_return))
 
-		except urllib2.URLError, e:
+		except OSPIHTTPError as e:
+			self.status = e.status
+			log.error('CGIQuery: Server returned {0}. Attempted: {1}'.format(e,self._query))
+		except (httplib.HTTPException, socket.error) as e:
 			log.error('CGIQuery: Could not connect to server, received error {0}. Attempted: {1}'.format(e,self._query))
-		except IndexError:
+		except ValueError:
 			log.error('CGIQuery: Response from CGI returned nothing. The DB probably does not know about this update')
 
+class OSPIMetrics(object):
+	"""
+	OSPIMetrics - counters, gauges and latency histograms, each keyed by name and labels.
+	Read out as Prometheus text or as a JSON snapshot
+	"""
+
+	HELP = {
+		"ospi_requests_total":		("counter", "Controller requests by endpoint and HTTP status, or error"),
+		"ospi_request_seconds":		("histogram", "Controller request latency by endpoint"),
+		"ospi_polls_total":		("counter", "Checks of each controller, failed when no flow could be read"),
+		"ospi_flow":			("gauge", "Last flow reading of each controller"),
+		"ospi_alert_level":		("gauge", "Leak detector level of each controller, 0 when not verifying"),
+		"ospi_verifies_total":		("counter", "Verifies started for each controller"),
+		"ospi_verify_seconds_total":	("counter", "Seconds spent verifying each controller"),
+		"ospi_notifications_total":	("counter", "Alerts by level, sent, failed or suppressed as a repeat"),
+	}
+
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		self.buckets = buckets
+		self._values = {}			# (name, labels) -> number, or [bucket counts, sum, count] for histograms
+		self._lock = threading.Lock()
+
+	def inc(self, name, labels=None, value=1):
+		key = (name, self._labels(labels))
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + value
+
+	def set(self, name, labels=None, value=0):
+		with self._lock:
+			self._values[(name, self._labels(labels))] = value
+
+	def observe(self, name, labels=None, value=0):
+		key = (name, self._labels(labels))
+		with self._lock:
+			histogram = self._values.get(key)
+			if histogram is None:
+				histogram = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+			for (i, bound) in enumerate(self.buckets):
+				if value <= bound:
+					histogram[0][i] += 1
+			histogram[1] += value
+			histogram[2] += 1
+
+	def snapshot(self):
+		"""
+		snapshot: Returns {name: [{"labels": {...}, "value": n}]}, histograms have buckets, sum and count instead
+		"""
+		snapshot = {}
+		with self._lock:
+			for ((name, labels), value) in sorted(self._values.items()):
+				entry = {"labels": dict(labels)}
+				if isinstance(value, list):
+					entry.update(buckets=dict(zip([str(b) for b in self.buckets], value[0])), sum=value[1], count=value[2])
+				else:
+					entry["value"] = value
+				snapshot.setdefault(name, []).append(entry)
+		return snapshot
+
+	def prometheus(self):
+		"""
+		prometheus: Returns the metrics in the Prometheus text format
+		"""
+		lines = []
+		with self._lock:
+			items = sorted(self._values.items())
+		named = None
+		for ((name, labels), value) in items:
+			if name != named:
+				(kind, text) = self.HELP.get(name, ("untyped", name))
+				lines.append("# HELP {0} {1}".format(name, text))
+				lines.append("# TYPE {0} {1}".format(name, kind))
+				named = name
+			if isinstance(value, list):
+				for (bound, count) in zip(self.buckets, value[0]):
+					lines.append("{0}_bucket{1} {2}".format(name, self._format(labels + (("le", str(bound)),)), count))
+				lines.append("{0}_bucket{1} {2}".format(name, self._format(labels + (("le", "+Inf"),)), value[2]))
+				lines.append("{0}_sum{1} {2}".format(name, self._format(labels), value[1]))
+				lines.append("{0}_count{1} {2}".format(name, self._format(labels), value[2]))
+			else:
+				lines.append("{0}{1} {2}".format(name, self._format(labels), value))
+		return "\n".join(lines) + "\n"
+
+	def write_snapshot(self, path):
+		# Through a temporary file, a reader never sees half a snapshot
+		temp = path + ".tmp"
+		with open(temp, 'w') as f:
+			json.dump({"time": int(time.time()), "metrics": self.snapshot()}, f, indent=2, sort_keys=True)
+		os.rename(temp, path)
+
+	def _labels(self, labels):
+		return tuple(sorted(labels.items())) if labels else ()
+
+	def _format(self, labels):
+		if not labels:
+			return ""
+		return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for (k, v) in labels) + "}"
+
+class OSPIMetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""OSPIMetricsHandler - /metrics as Prometheus text, /metrics.json as the snapshot"""
+
+	def do_GET(self):
+		if self.path == "/metrics":
+			(body, content_type) = (METRICS.prometheus(), "text/plain; version=0.0.4")
+		elif self.path == "/metrics.json":
+			(body, content_type) = (json.dumps(METRICS.snapshot(), sort_keys=True), "application/json")
+		else:
+			self.send_error(404)
+			return
+		self.send_response(200)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+class OSPIMetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""OSPIMetricsServer - serves the metrics on a local port from a background thread"""
+
+	daemon_threads = True
+
+	def __init__(self, port, address="127.0.0.1"):
+		BaseHTTPServer.HTTPServer.__init__(self, (address, port), OSPIMetricsHandler)
+		thread = threading.Thread(target=self.serve_forever, name="metrics")
+		thread.daemon = True
+		thread.start()
+
+class OSPIMetricsWriter(object):
+	"""OSPIMetricsWriter - writes a JSON snapshot every interval from a background thread, and once more on close"""
+
+	def __init__(self, path, interval=METRICS_INTERVAL):
+		self.path = path
+		self.interval = interval
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="metrics-writer")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def close(self):
+		self._stop.set()
+		self._thread.join()
+		METRICS.write_snapshot(self.path)
+
+	def _run(self):
+		while not self._stop.wait(self.interval):
+			try:
+				METRICS.write_snapshot(self.path)
+			except (IOError, OSError) as e:
+				log.error("OSPIMetricsWriter:_run: could not write {0}, {1}".format(self.path,e))
+
+class OSPIAlert(object):
+	"""OSPIAlert - one notification, for a controller at a level"""
+
+	def __init__(self, controller, level, message):
+		self.controller = controller
+		self.level = level
+		self.message = message
+		self.created = time.time()
+
+	@property
+	def key(self):
+		return (self.controller, self.level)
+
+	def as_dict(self):
+		return {"controller": self.controller, "level": self.level, "message": self.message, "time": int(self.created)}
+
 class OSPIEmail(object):
-	"""OSPIEmail - sends notifications"""
-	
+	"""OSPIEmail - sends notifications, keeping the SMTP session open between them"""
+
+	def __init__(self, host=SMTP_HOST, port=SMTP_PORT, starttls=SMTP_STARTTLS, login=SMTP_LOGIN):
+		self.host = host
+		self.port = port
+		self.starttls = starttls
+		self.login = login
+		self._server = None
+
+	def send(self, alert):
+		self.send_email_message("{0}\nController: {1}".format(alert.message,alert.controller))
+
 	def send_email_message(self, warning):
-		server = smtplib.SMTP('smtp.gmail.com:587')
-		server.starttls()
-		user = "{0}".format(USER)
-		passwd = "{0}".format(PASS)
-		server.login(user, passwd)
-		
 		message = MIMEText("FLOW CONTROL NOTIFICATION! \n{0}".format(warning))
 
 		message['Subject']	= "Sprinkler Alert"
 		message['From']		= SENDER
 		message['To']		= ", ".join(RECP)
 		log.debug('OSPIEmail:send_email_message: smtp variables sent {0}'.format(message))
-		server.sendmail(SENDER, RECP, message.as_string())
-		server.quit()
+		try:
+			self._session().sendmail(SENDER, RECP, message.as_string())
+		except (smtplib.SMTPServerDisconnected, socket.error):
+			# The server dropped an idle session, one more go on a new one
+			self.close()
+			self._session().sendmail(SENDER, RECP, message.as_string())
+
+	def close(self):
+		if self._server is not None:
+			try:
+				self._server.quit()
+			except (smtplib.SMTPException, socket.error):
+				pass
+			self._server = None
+
+	def _session(self):
+		if self._server is None:
+			server = smtplib.SMTP(self.host, self.port, timeout=HTTP_TIMEOUT)
+			if self.starttls:
+				server.starttls()
+			if self.login:
+				server.login("{0}".format(USER), "{0}".format(PASS))
+			self._server = server
+			log.debug("OSPIEmail:_session: connected to {0}:{1}".format(self.host,self.port))
+		return self._server
+
+class OSPIWebhook(object):
+	"""OSPIWebhook - POSTs each notification as JSON to a URL"""
+
+	def __init__(self, url):
+		self.url = url
+
+	def send(self, alert):
+		request = urllib2.Request(self.url, json.dumps(alert.as_dict()), {"Content-Type": "application/json"})
+		urllib2.urlopen(request, timeout=HTTP_TIMEOUT).close()
+
+	def close(self):
+		pass
+
+class OSPICommand(object):
+	"""OSPICommand - runs a local command for each notification, the alert is in OSPI_CONTROLLER, OSPI_LEVEL and OSPI_MESSAGE"""
+
+	def __init__(self, command):
+		self.command = command
+
+	def send(self, alert):
+		env = dict(os.environ, OSPI_CONTROLLER=alert.controller, OSPI_LEVEL=alert.level, OSPI_MESSAGE=alert.message)
+		status = subprocess.call(self.command, shell=True, env=env)
+		if status != 0:
+			raise OSError("{0} exited with {1}".format(self.command,status))
+
+	def close(self):
+		pass
+
+class OSPINotifier(object):
+	"""
+	OSPINotifier - queues notifications and sends them on a background thread, so the
+	checks never wait on a mail server. Repeats and floods of one alert are dropped
+	before they're queued
+	"""
+
+	def __init__(self, channels=None):
+		self.channels = channels if channels is not None else [OSPIEmail()]
+		self._queue = Queue.Queue(NOTIFY_QUEUE_SIZE)
+		self._lock = threading.Lock()
+		self._thread = None
+		self._last_sent = {}				# (controller, level, message) -> time queued
+		self._recent = collections.defaultdict(collections.deque)	# (controller, level) -> times queued
+
+	def notify(self, controller, level, message):
+		"""
+		notify: Queues an alert, returns False when it was dropped as a repeat or the queue is full
+		"""
+		alert = OSPIAlert(controller, level, message)
+		with self._lock:
+			if not self._allowed(alert):
+				METRICS.inc("ospi_notifications_total", {"level": level, "result": "suppressed"})
+				return False
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._worker, name="notifier")
+				self._thread.daemon = True
+				self._thread.start()
+		try:
+			self._queue.put_nowait(alert)
+		except Queue.Full:
+			log.error("OSPINotifier:notify: queue is full, dropped {0} {1} for {2}".format(level,message,controller))
+			return False
+		return True
+
+	def close(self, timeout=None):
+		# Sends what's queued, then stops the thread and closes the channels
+		with self._lock:
+			thread = self._thread
+			self._thread = None
+		if thread is not None:
+			self._queue.put(None)
+			thread.join(timeout)
+
+	def _allowed(self, alert):
+		now = alert.created
+		last = self._last_sent.get((alert.controller, alert.level, alert.message))
+		if last is not None and now - last < NOTIFY_DEDUP_WINDOW:
+			log.debug("OSPINotifier:_allowed: {0} {1} for {2} already sent".format(alert.level,alert.message,alert.controller))
+			return False
+		recent = self._recent[alert.key]
+		while recent and now - recent[0] >= NOTIFY_RATE_WINDOW:
+			recent.popleft()
+		if len(recent) >= NOTIFY_RATE_LIMIT:
+			log.debug("OSPINotifier:_allowed: {0} alerts for {1} over the rate limit".format(alert.level,alert.controller))
+			return False
+		recent.append(now)
+		self._last_sent[(alert.controller, alert.level, alert.message)] = now
+		return True
+
+	def _worker(self):
+		while True:
+			try:
+				alert = self._queue.get(timeout=NOTIFY_IDLE)
+			except Queue.Empty:
+				# Quiet for a while, don't hold sessions open
+				self._close_channels()
+				continue
+			if alert is None:
+				break
+			for channel in self.channels:
+				self._send(channel, alert)
+		self._close_channels()
+
+	def _send(self, channel, alert):
+		backoff = NOTIFY_BACKOFF
+		for attempt in range(NOTIFY_RETRIES + 1):
+			try:
+				channel.send(alert)
+				METRICS.inc("ospi_notifications_total", {"level": alert.level, "result": "sent"})
+				log.debug("OSPINotifier:_send: {0} sent {1} for {2}".format(type(channel).__name__,alert.level,alert.controller))
+				return True
+			except Exception as e:
+				log.error("OSPINotifier:_send: {0} failed with {1}, attempt {2}".format(type(channel).__name__,e,attempt + 1))
+				channel.close()
+				if attempt < NOTIFY_RETRIES:
+					time.sleep(backoff)
+					backoff *= 2
+		METRICS.inc("ospi_notifications_total", {"level": alert.level, "result": "failed"})
+		return False
+
+	def _close_channels(self):
+		for channel in self.channels:
+			channel.close()
+
+# Real time unless a monitor is given its own clock
+CLOCK = Clock()
+
+# One registry for the whole process
+METRICS = OSPIMetrics()
+
+# Shared by every query, so a long running process keeps its connections
+CONNECTION_POOL = OSPIConnectionPool()
+
+# Shared by every controller, so the repeat checks see the whole fleet
+NOTIFIER = OSPINotifier()
 
 ################################################################################
 # RUN AS SCRIPT
 ################################################################################
 
 if __name__ == "__main__":
-	ExecuteScript.run()
+
+	parser = argparse.ArgumentParser(description = "Check an OpenSprinkler for water flowing when no station is scheduled")
+	parser.add_argument('-d', '--daemon',	action="store_true", help = "Keep running and check on a schedule instead of once from CRON")
+	parser.add_argument('-i', '--interval',	type=int, default=POLL_INTERVAL, help = "Seconds between checks in daemon mode")
+	parser.add_argument('-c', '--controller', action="append", default=[], help = "address,md5password of a controller to watch, repeat for more. Defaults to OSPI and MD5PASS")
+	parser.add_argument('--ja',		action="store_true", help = "Read everything from /ja in one request, needs firmware 2.1.9 or later")
+	parser.add_argument('-f', '--fleet',	default=None, help = "JSON file of controllers to watch in daemon mode, see ExecuteScript.load_fleet")
+	parser.add_argument('--data-dir',	default=DATA_DIR, help = "Folder for the flow history and baselines")
+	parser.add_argument('--no-history',	action="store_true", help = "Don't keep a flow history, any flow with no station running is unusual")
+	parser.add_argument('--smtp-host',	default=SMTP_HOST, help = "Mail server for the alerts")
+	parser.add_argument('--smtp-port',	type=int, default=SMTP_PORT, help = "Mail server port")
+	parser.add_argument('--no-starttls',	action="store_true", help = "Don't encrypt the mail session, for a local test server")
+	parser.add_argument('--no-login',	action="store_true", help = "Don't log in to the mail server")
+	parser.add_argument('--no-email',	action="store_true", help = "Don't send alerts by email")
+	parser.add_argument('--webhook',	action="append", default=[], help = "URL each alert is POSTed to as JSON, repeat for more")
+	parser.add_argument('--command',	action="append", default=[], help = "Command run for each alert, repeat for more")
+	parser.add_argument('--metrics-port',	type=int, default=None, help = "Serve Prometheus metrics on this local port, at /metrics")
+	parser.add_argument('--metrics-file',	default=None, help = "Write a JSON snapshot of the metrics to this file")
+	parser.add_argument('--metrics-interval', type=int, default=METRICS_INTERVAL, help = "Seconds between metrics snapshots")
+	parser.add_argument('--trace',		action="store_true", help = "Log every property get and set, very chatty")
+	parser.add_argument('--adaptive',	action="store_true", help = "Back off the checks while the flow is quiet and verify with fast samples, fewer polls but later detection")
+	args = parser.parse_args()
+
+	TRACE_ACCESS = args.trace
+	if args.metrics_port is not None:
+		OSPIMetricsServer(args.metrics_port)
+	metrics_writer = OSPIMetricsWriter(args.metrics_file, args.metrics_interval) if args.metrics_file else None
+
+	channels = [OSPIWebhook(url) for url in args.webhook] + [OSPICommand(command) for command in args.command]
+	if not args.no_email:
+		channels.insert(0, OSPIEmail(args.smtp_host, args.smtp_port, not args.no_starttls, not args.no_login))
+	NOTIFIER.channels = channels
+
+	data_dir = None if args.no_history else args.data_dir
+
+	controllers = [OSPIController.from_argument(c, args.ja) for c in args.controller] or [OSPIController(use_ja=args.ja)]
+	try:
+		adaptive = args.adaptive
+		if args.fleet:
+			(controllers, workers) = ExecuteScript.load_fleet(args.fleet)
+			ExecuteScript.run_daemon(controllers, args.interval, workers, data_dir, adaptive)
+		elif args.daemon:
+			ExecuteScript.run_daemon(controllers, args.interval, data_dir=data_dir, adaptive=adaptive)
+		else:
+			ExecuteScript.run(controllers[0], data_dir, adaptive)
+	finally:
+		# Don't leave queued alerts behind
+		NOTIFIER.close()
+		if metrics_writer is not None:
+			metrics_writer.close()
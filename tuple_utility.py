@@ -21,6 +21,43 @@
 		disk volumes. It uses containers, like a lot of modern file
 		systems. 
 
+	10/18/26 -RH
+		Added a persistent index of the parsed versions (--index, on by
+		default). An unchanged directory answers from the index without
+		listing it, a changed one only parses the names that are new.
+
+	10/18/26 -RH
+		Names are parsed in bulk with one compiled pattern into integer
+		sort keys (a*10000 + b*100 + c), so the highest, the top N or a
+		sorted list come from one pass over an array. compare_tuples no
+		longer needs cmp.
+
+	10/18/26 -RH
+		Added version schemes (--scheme): apple (the 3 tuple .dmg default),
+		semver with pre-release ordering, a PEP 440 subset and build
+		numbers, plus auto for directories that mix them. The newer
+		schemes look at .dmg, .pkg, .zip and .tar.gz artifacts.
+
+	10/18/26 -RH
+		Added --scan for build server trees like product/branch/build/.
+		The roots are listed by a pool of threads, with scandir when it's
+		there, and the highest version of each product/branch group
+		(--group-depth) is printed as soon as its subtree is done.
+
+	10/18/26 -RH
+		Added a resident mode (--serve). The server keeps the parsed names
+		of each directory it's asked about in memory, follows them with
+		inotify (mtime polling where there is none) and answers over a
+		Unix socket. The script asks the server first (--socket) and only
+		scans by itself when none is running. The log file is only opened
+		when something is logged.
+
+	10/18/26 -RH
+		Added constraint queries, --prefix (highest 10.x, latest 12.4.x),
+		--between A B and --top N. They're answered from a VersionSet, the
+		parsed keys sorted once, with a bisect per query. The server keeps
+		one per directory until the directory changes.
+
 ################################################################################
 """
 
@@ -29,7 +66,43 @@
 ################################################################################
 
 # Common Imports
-import os,sys,argparse,logging,re
+import os,sys,stat,argparse,logging,re,json,time,hashlib,heapq,bisect,threading,Queue,socket,select,struct,signal,errno,SocketServer
+import ctypes,ctypes.util
+from array import array
+
+# scandir is in os from Python 3.5, the scandir package backports it, listdir does without
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+################################################################################
+# Constants
+################################################################################
+INDEX_DIR	= os.path.expanduser("~/.tuple_utility")	# Where the version indexes are kept, one per directory
+INDEX_VERSION	= 4				# Bump when the index layout changes, older ones are rebuilt
+
+# Artifacts the newer schemes look at, the version has to sit right before one of these
+ARTIFACT_EXTENSIONS = r'\.(?:dmg|pkg|zip|tar\.gz|tgz)$'
+
+# Release phases in the shared sort key, lowest first
+PHASE_DEV	= 0				# 1.0.dev1
+PHASE_PRE	= 1				# 1.0rc1, 1.0.0-beta.2
+PHASE_FINAL	= 2				# 1.0
+PHASE_POST	= 3				# 1.0.post1
+RELEASE_PAD	= [(0,) * (4 - n) for n in range(4)]	# Zeros that take a release to 4 tuples
+SCAN_THREADS	= 16				# Listings in flight at once, a network share is mostly round trips
+GROUP_DEPTH	= 2				# Folders under a scan root that make a group, product/branch
+SOCKET_PATH	= os.path.join(INDEX_DIR, "server.sock")	# Where the resident server listens, per user so no one else can bind it
+CLIENT_TIMEOUT	= 2.0				# Seconds the script waits on the server before scanning itself
+POLL_INTERVAL	= 1.0				# Seconds between mtime checks without inotify
+RECHECK_INTERVAL = 30.0				# Seconds between mtime checks of idle directories with inotify. Every
+						# query checks the mtime too, network shares send no inotify events
+MTIME_GRANULARITY = 2.0				# Seconds, coarsest directory mtime we expect (FAT/SMB). A listing
+						# taken within this of the mtime might miss a change in the same tick
 
 ################################################################################
 # Logging 
@@ -39,7 +112,8 @@ log = logging.getLogger('Utilities')
 log.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s', "%Y-%m-%d %H:%M:%S")
 
-logger1 = logging.FileHandler('/tmp/utilities.log')
+# Opened on the first record, a lookup answered by the server never touches it
+logger1 = logging.FileHandler('/tmp/utilities.log', delay=True)
 logger1.setLevel(logging.DEBUG)
 logger1.setFormatter(formatter)
 log.addHandler(logger1)
@@ -58,61 +132,117 @@ class ExecuteScript(object):
 			self.usage()
 			sys.exit(0)
 
-		tu = TupleUtility()
-		# Snapshot path folder
-		my_versions = os.listdir(self.args.path)
-		log.debug("ExecuteScript:return_highest_tuple_for_path: my_versions: {0}".format(my_versions))
-
-		# Check if the version passed in starts with a digit
-		for my_version in my_versions:
-			# This Regex matches a 3 tuple version
-			my_temp_match = re.search(r'\b(?<!\.)((?:\d{1,3}))(?:\.\d{1,2}){0,2}(?:\..mg)', my_version)
-			my_match = None
-			if my_temp_match is not None:	
-				my_match = my_temp_match.group()
-				log.debug("ExecuteScript:return_highest_tuple_for_path: my_temp_match : {0}".format(my_match))
-			else:
-				# Skip, regex found "none" type
-				continue
-	
-			log.debug("ExecuteScript:return_highest_tuple_for_path: my_match: {0}".format(my_match))
-
-			# Tuplize
-			my_tuple_version = tu.tuplize_version(my_match)
-			log.debug("ExecuteScript:return_highest_tuple_for_path: my_tuple_version: {0}".format(my_tuple_version))
-
-			if (my_tuple_version):
-				# Check if tuple is higher or lower than current "highest_version"
-				if tu.highest_version:
-					my_return = tu.compare_tuples(tu.highest_version, my_tuple_version)
-					# higher than current "Highest", set property to new version
-					if (my_return is -1):
-						# Normalize back to string
-						tu.highest_version = my_tuple_version
-						tu.highest_name = my_version
-						log.debug("ExecuteScript:return_highest_tuple_for_path: tu.highest_version: {0}, tu.highest_name {1}".format(my_tuple_version,my_version))
-				else:
-					# No highest version set
-					tu.highest_version = my_tuple_version
-					tu.highest_name = my_version
-					log.debug("ExecuteScript:return_highest_tuple_for_path: tu.highest_version: {0}, tu.highest_name {1}".format(my_tuple_version,my_version))
-			else:
-				# Not a valid tuple skip
-				continue
+		tu = TupleUtility(SCHEMES[self.args.scheme])
+		my_answer = None
+		if self.args.socket and not self.args.no_index:
+			my_answer = VersionClient(self.args.socket).query("highest", self.args.path, self.args.scheme)
+		if my_answer is not None:
+			(tu.highest_version, tu.highest_name) = (my_answer["version"], my_answer["name"])
+		else:
+			my_found = None
+			if not self.args.no_index:
+				try:
+					my_found = VersionIndex(self.args.path, self.args.index, tu.scheme).highest()
+				except UnicodeError as e:
+					# The index is only a shortcut, never a reason to fail
+					log.error("ExecuteScript:return_highest_tuple_for_path: index failed, listing instead, {0}".format(e))
+			if my_found is None:
+				# Snapshot path folder
+				my_versions = os.listdir(self.args.path)
+				log.debug("ExecuteScript:return_highest_tuple_for_path: {0} names".format(len(my_versions)))
+				my_found = tu.highest_of(my_versions)
+			(tu.highest_version, tu.highest_name) = my_found
 
 		# Return highest version
 		if not self.args.name:
-			my_join_version = '.'.join(map(str,tu.highest_version))
+			my_join_version = tu.scheme.format(tu.highest_version)
 			print my_join_version
 		else:
 			print tu.highest_name
+
+	def return_versions_for_path(self):
+		"""
+		return_versions_for_path: Answers --prefix, --top and --between, one version per line.
+			Exits 1 when nothing matches
+		"""
+		if (self.args.path == "path"):
+			self.usage()
+			sys.exit(0)
+
+		if self.args.between is not None:
+			my_request = {"query": "between", "low": self.args.between[0], "high": self.args.between[1]}
+		elif self.args.top is not None:
+			my_request = {"query": "top", "count": self.args.top, "prefix": self.args.prefix}
+		else:
+			my_request = {"query": "highest", "prefix": self.args.prefix}
+
+		tu = TupleUtility(SCHEMES[self.args.scheme])
+		my_answer = None
+		if self.args.socket and not self.args.no_index:
+			my_answer = VersionClient(self.args.socket).query(path=self.args.path, scheme=self.args.scheme, **my_request)
+		if my_answer is None:
+			my_set = None
+			if not self.args.no_index:
+				try:
+					my_index = VersionIndex(self.args.path, self.args.index, tu.scheme)
+					my_index.highest()
+					my_set = my_index.version_set()
+				except UnicodeError as e:
+					log.error("ExecuteScript:return_versions_for_path: index failed, listing instead, {0}".format(e))
+			if my_set is None:
+				my_set = tu.version_set(os.listdir(self.args.path))
+			try:
+				my_answer = my_set.answer(my_request)
+			except ValueError as e:
+				print >> sys.stderr, e
+				sys.exit(2)
+
+		if "versions" in my_answer:
+			my_found = my_answer["versions"]
+		else:
+			my_found = [(my_answer["version"], my_answer["name"])] if my_answer["name"] is not None else []
+		for (my_version, my_name) in my_found:
+			print my_name if self.args.name else tu.scheme.format(my_version)
+		if not my_found:
+			sys.exit(1)
+
+	def serve(self):
+		"""
+		serve: Runs the resident server until SIGTERM or ^C
+		"""
+		my_server = VersionServer(self.args.socket)
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+		log.info("ExecuteScript:serve: listening on {0}".format(self.args.socket))
+		try:
+			my_server.serve_forever()
+		except (KeyboardInterrupt, SystemExit):
+			pass
+		finally:
+			my_server.server_close()
+
+	def return_highest_tuple_per_group(self):
+		"""
+		return_highest_tuple_per_group: One line per group under the scan roots, printed as
+			each group's subtree is done
+		"""
+		my_scanner = ArtifactScanner(self.args.scan, SCHEMES[self.args.scheme], self.args.group_depth, self.args.threads)
+		for my_group in my_scanner.scan():
+			if my_group.highest_key is None:
+				continue
+			if not self.args.name:
+				my_found = my_scanner.scheme.format(my_scanner.scheme.decode(my_group.highest_key, my_group.highest_name))
+			else:
+				my_found = os.path.join(my_group.highest_folder, my_group.highest_name)
+			print "{0}\t{1}".format(my_group.path, my_found)
+			sys.stdout.flush()
 	
 class TupleUtility(object):
 	"""
 	TupleUtility: Class to encapsulate the tuple utility functions
 	"""
 
-	def __init__(self):
+	def __init__(self, scheme=None):
+		self.scheme = scheme or SCHEMES['apple']
 		self._highest_version = None
 		self._highest_name = None
 
@@ -137,6 +267,69 @@ class TupleUtility(object):
 
 
 	# FUNCTIONS	
+	def parse_name(self, name):
+		"""
+		parse_name: The version in a file name, as a tuple for the apple scheme, or None when
+			it doesn't have one
+		"""
+		my_key = self.scheme.key_of(name)
+		if my_key is None:
+			return None
+		return self.scheme.decode(my_key, name)
+
+	def decode_key(self, key):
+		"""
+		decode_key: Back to the tuple, trailing zero tuples dropped like tuplize_version does
+		"""
+		(a, rest) = divmod(key, 10000)
+		my_version = [a] + list(divmod(rest, 100))
+		while len(my_version) > 1 and my_version[-1] == 0:
+			my_version.pop()
+		return my_version
+
+	def parse_names(self, names):
+		"""
+		parse_names: Parses every name in one pass with the scheme. Returns (keys, names)
+			for the names that have a version
+		"""
+		(my_keys, my_names) = self.scheme.keys(names)
+		log.debug("TupleUtility:parse_names: {0} names with a {1} version".format(len(my_names),self.scheme.name))
+		return (my_keys, my_names)
+
+	def version_set(self, names):
+		"""
+		version_set: A VersionSet of names, for constraint queries
+		"""
+		(my_keys, my_names) = self.parse_names(names)
+		return VersionSet(self.scheme, my_keys, my_names)
+
+	def highest_of(self, names):
+		"""
+		highest_of: Returns (highest version, name) of names, (None, None) when none has a version.
+			The first of equal versions wins, as it always has
+		"""
+		(my_keys, my_names) = self.parse_names(names)
+		if not my_keys:
+			return (None, None)
+		i = max(xrange(len(my_keys)), key=my_keys.__getitem__)
+		return (self.scheme.decode(my_keys[i], my_names[i]), my_names[i])
+
+	def top_versions(self, names, count):
+		"""
+		top_versions: The count highest (version, name) of names, highest first
+		"""
+		(my_keys, my_names) = self.parse_names(names)
+		my_top = heapq.nlargest(count, xrange(len(my_keys)), key=my_keys.__getitem__)
+		return [(self.scheme.decode(my_keys[i], my_names[i]), my_names[i]) for i in my_top]
+
+	def sorted_versions(self, names, reverse=False):
+		"""
+		sorted_versions: Every (version, name) of names, lowest first unless reverse
+		"""
+		(my_keys, my_names) = self.parse_names(names)
+		my_order = sorted(xrange(len(my_keys)), key=my_keys.__getitem__, reverse=reverse)
+		return [(self.scheme.decode(my_keys[i], my_names[i]), my_names[i]) for i in my_order]
+
 	def tuplize_version(self, version):
 		"""
 		tuplize_version: A quick way to split the version out 
@@ -184,7 +377,7 @@ class TupleUtility(object):
 		"""
 
 		log.debug("TupleUtility:compareTuples: Subroutine entry with variables my_first_tuple:{0} and my_second_tuple:{1}".format(first_tuple,second_tuple))
-		my_cmp = cmp(first_tuple, second_tuple)
+		my_cmp = (first_tuple > second_tuple) - (first_tuple < second_tuple)
 		return my_cmp
 
 	def usage(self):
@@ -193,6 +386,962 @@ class TupleUtility(object):
 		print ("<default>			User wants output of just the version, like 123.4.5.")
 		print ("<optional> '-n' or '--name'	User wants output of name and version, like what was handed into the script ex. Build-123.4.5.dmg")
 
+class VersionScheme(object):
+	"""
+	VersionScheme: How versions are found in names and ordered. Every scheme except apple
+	gives the same kind of sort key, (epoch, release, phase, detail, build), so names parsed by
+	different schemes still sort against each other
+	"""
+	name = None
+	pattern = None				# Compiled, the version itself in group 'v'
+
+	def key(self, groups):
+		# The sort key from the pattern's groups
+		raise NotImplementedError
+
+	def key_of(self, name):
+		"""
+		key_of: The sort key of the version in name, None when it doesn't have one
+		"""
+		my_match = self.pattern.search(name)
+		if my_match is None:
+			return None
+		return self.key(my_match.groups())
+
+	def keys(self, names):
+		"""
+		keys: (keys, names) for the names that have a version
+		"""
+		my_keys = []
+		my_names = []
+		search = self.pattern.search
+		for name in names:
+			my_match = search(name)
+			if my_match is not None:
+				my_keys.append(self.key(my_match.groups()))
+				my_names.append(name)
+		return (my_keys, my_names)
+
+	def decode(self, key, name):
+		# The version as it's written in the name
+		return self.pattern.search(name).group('v')
+
+	def format(self, version):
+		return version
+
+	def load_key(self, value):
+		# JSON turned the key's tuples into lists, lists and tuples don't compare
+		if isinstance(value, list):
+			return tuple(self.load_key(v) for v in value)
+		return value
+
+	def parse(self, version):
+		"""
+		parse: The sort key of a version on its own, like 12.4 or 2.0.0-rc.1, read as the
+			name it would have
+		"""
+		my_key = self.key_of(version + ".dmg")
+		if my_key is None:
+			raise ValueError("not a version for the {0} scheme: {1}".format(self.name,version))
+		return my_key
+
+	def prefix_parts(self, prefix):
+		# 12.4, 12.4.x and 12.4.* are all the same prefix
+		try:
+			return [int(part) for part in re.sub(r'(\.[xX*])+$', '', prefix.strip()).split('.')]
+		except ValueError:
+			raise ValueError("not a version prefix: {0!r}".format(prefix))
+
+	def prefix_range(self, prefix):
+		"""
+		prefix_range: (low, high) keys around every version that starts with prefix, high not
+			included. Pre-releases of a matching release match too, other epochs don't
+		"""
+		my_parts = self.prefix_parts(prefix)
+		my_next = my_parts[:-1] + [my_parts[-1] + 1]
+		my_pad = [0] * (4 - len(my_parts))
+		# A bare (epoch, release) sorts below every key of that release
+		return ((0, tuple(my_parts + my_pad)), (0, tuple(my_next + my_pad)))
+
+	def sort_key(self, release, phase=PHASE_FINAL, detail=(), build=-1, epoch=0):
+		# Trailing zero tuples don't count, 1.2 is 1.2.0 is 1.2.0.0
+		my_release = tuple(release)
+		if my_release[-1] == 0:
+			my_count = len(my_release)
+			while my_count > 1 and my_release[my_count - 1] == 0:
+				my_count -= 1
+			my_release = my_release[:my_count]
+		if len(my_release) < 4:
+			my_release += RELEASE_PAD[len(my_release)]
+		return (epoch, my_release, phase, detail, build)
+
+class AppleScheme(VersionScheme):
+	"""
+	AppleScheme: 1 to 3 tuples up to 999.99.99 before a .dmg like extension, the original
+	rules. Keys are a*10000 + b*100 + c, packed in an array
+	"""
+	name = 'apple'
+	pattern = re.compile(r'\b(?<!\.)(?P<v>(\d{1,3})(?:\.(\d{1,2}))?(?:\.(\d{1,2}))?)\..mg')
+
+	def key(self, groups):
+		(v, a, b, c) = groups
+		return int(a) * 10000 + int(b or 0) * 100 + int(c or 0)
+
+	def keys(self, names):
+		my_keys = array('l')
+		my_names = []
+		search = self.pattern.search
+		for name in names:
+			my_match = search(name)
+			if my_match is not None:
+				(v, a, b, c) = my_match.groups()
+				my_keys.append(int(a) * 10000 + int(b or 0) * 100 + int(c or 0))
+				my_names.append(name)
+		return (my_keys, my_names)
+
+	def decode(self, key, name):
+		return TupleUtility().decode_key(key)
+
+	def format(self, version):
+		return '.'.join(map(str, version))
+
+	def prefix_range(self, prefix):
+		my_parts = self.prefix_parts(prefix)
+		if len(my_parts) > 3:
+			raise ValueError("not an apple version prefix: {0}".format(prefix))
+		my_weights = (10000, 100, 1)
+		my_low = sum(part * weight for (part, weight) in zip(my_parts, my_weights))
+		return (my_low, my_low + my_weights[len(my_parts) - 1])
+
+	def shared_key(self, groups):
+		# For auto, where it has to sort against the other schemes
+		(v, a, b, c) = groups
+		return self.sort_key((int(a), int(b or 0), int(c or 0)))
+
+class SemVerScheme(VersionScheme):
+	"""
+	SemVerScheme: MAJOR.MINOR.PATCH[-pre.release][+build]. A pre-release is lower than its
+	release, its identifiers compare numbers numerically, below words, and a shorter
+	list is lower. Build metadata doesn't count
+	"""
+	name = 'semver'
+	pattern = re.compile(r'(?<![A-Za-z\d.!+])v?(?P<v>(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*))?'
+		r'(?:\+[0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*)?)' + ARTIFACT_EXTENSIONS, re.I)
+
+	def key(self, groups):
+		(v, major, minor, patch, pre) = groups
+		my_release = (int(major), int(minor), int(patch))
+		if pre is None:
+			return self.sort_key(my_release)
+		my_detail = tuple((0, int(part), '') if part.isdigit() else (1, 0, part) for part in pre.split('.'))
+		return self.sort_key(my_release, PHASE_PRE, my_detail)
+
+class PEP440Scheme(VersionScheme):
+	"""
+	PEP440Scheme: [N!]N(.N)*[{a|b|rc}N][.postN][.devN], with the usual spellings (alpha,
+	beta, c, pre, preview, rev, r, - and _ separators). dev < pre-release < release < post
+	"""
+	name = 'pep440'
+	pattern = re.compile(r'(?<![A-Za-z\d.!+])v?(?P<v>(?:(\d+)!)?(\d+(?:\.\d+)*)'
+		r'(?:[-_.]?(alpha|beta|preview|pre|rc|a|b|c)[-_.]?(\d*))?'
+		r'(?:[-_.]?(?:post|rev|r)[-_.]?(\d*))?'
+		r'(?:[-_.]?(dev)[-_.]?(\d*))?)' + ARTIFACT_EXTENSIONS, re.I)
+	PRE_RANKS = {'a': 0, 'alpha': 0, 'b': 1, 'beta': 1, 'c': 2, 'rc': 2, 'pre': 2, 'preview': 2}
+
+	def key(self, groups):
+		(v, epoch, release, pre, pre_n, post_n, dev, dev_n) = groups
+		my_release = map(int, release.split('.'))
+		my_epoch = int(epoch or 0)
+		# Within a phase the dev releases come first, (0, n) before (1, 0) for none
+		my_dev = (0, int(dev_n or 0), '') if dev else (1, 0, '')
+		if pre:
+			return self.sort_key(my_release, PHASE_PRE, ((self.PRE_RANKS[pre.lower()], int(pre_n or 0), ''), my_dev), epoch=my_epoch)
+		if post_n is not None:
+			return self.sort_key(my_release, PHASE_POST, ((0, int(post_n or 0), ''), my_dev), epoch=my_epoch)
+		if dev:
+			return self.sort_key(my_release, PHASE_DEV, (my_dev,), epoch=my_epoch)
+		return self.sort_key(my_release, epoch=my_epoch)
+
+class BuildNumberScheme(VersionScheme):
+	"""
+	BuildNumberScheme: Up to 4 tuples with an optional build number, 1.2.3.4567, 1.2.3-build45,
+	1.2.3+45 or 1.2.3 (45). A build number sorts after the same version without one
+	"""
+	name = 'build'
+	pattern = re.compile(r'(?<![A-Za-z\d.!+])v?(?P<v>(\d+(?:\.\d+){0,3})'
+		r'(?:[-_ ]?build[-_ ]?(\d+)|\+(\d+)| ?\((\d+)\))?)' + ARTIFACT_EXTENSIONS, re.I)
+
+	def key(self, groups):
+		(v, release, build1, build2, build3) = groups
+		my_build = build1 or build2 or build3
+		return self.sort_key(map(int, release.split('.')), build=int(my_build) if my_build else -1)
+
+class AutoScheme(VersionScheme):
+	"""
+	AutoScheme: Each name by the first scheme that finds a version in it, build numbers,
+	semver, PEP 440 and then the apple rules. They share a sort key so a mixed
+	directory still has one order
+	"""
+	name = 'auto'
+
+	def __init__(self):
+		self.apple = AppleScheme()
+		self.schemes = [BuildNumberScheme(), SemVerScheme(), PEP440Scheme(), self.apple]
+
+	def match(self, name):
+		for my_scheme in self.schemes:
+			my_match = my_scheme.pattern.search(name)
+			if my_match is not None:
+				return (my_scheme, my_match)
+		return (None, None)
+
+	def scheme_key(self, scheme):
+		# Apple has its own keys, for auto it gives the shared kind
+		return self.apple.shared_key if scheme is self.apple else scheme.key
+
+	def key_of(self, name):
+		(my_scheme, my_match) = self.match(name)
+		if my_scheme is None:
+			return None
+		return self.scheme_key(my_scheme)(my_match.groups())
+
+	def keys(self, names):
+		"""
+		keys: A pass per scheme instead of every scheme per name. Each pass runs one pattern over
+			the names the schemes before it didn't take, most directories are done after the first
+		"""
+		names = list(names)
+		my_keys = [None] * len(names)
+		my_left = xrange(len(names))
+		for my_scheme in self.schemes:
+			search = my_scheme.pattern.search
+			key = self.scheme_key(my_scheme)
+			my_next = []
+			for i in my_left:
+				my_match = search(names[i])
+				if my_match is None:
+					my_next.append(i)
+				else:
+					my_keys[i] = key(my_match.groups())
+			if not my_next:
+				break
+			my_left = my_next
+		# Back in the order they came, the first of equal versions still wins
+		my_found = [i for i in xrange(len(names)) if my_keys[i] is not None]
+		return ([my_keys[i] for i in my_found], [names[i] for i in my_found])
+
+	def decode(self, key, name):
+		return self.match(name)[1].group('v')
+
+class VersionIndex(object):
+	"""
+	VersionIndex: The parsed version of every name in a directory. A small header file
+	holds the directory mtime and the highest, a second file every name and its key.
+	When the mtime hasn't moved the header is the answer, otherwise the names are read
+	and only the ones that came or went since the last listing are looked at. Names are
+	byte strings throughout, stored as latin-1 so any file name comes back as it was
+	"""
+
+	def __init__(self, path, index_dir=None, scheme=None):
+		# Byte string paths, so listdir gives byte string names
+		if isinstance(path, unicode):
+			path = path.encode('utf-8')
+		self.path = os.path.abspath(path)
+		self.scheme = scheme or SCHEMES['apple']
+		my_key = hashlib.sha1(self.path).hexdigest()
+		self.index_path = os.path.join(index_dir or INDEX_DIR, "{0}-{1}.json".format(my_key, self.scheme.name))
+		self.names_path = os.path.join(index_dir or INDEX_DIR, "{0}-{1}.names.json".format(my_key, self.scheme.name))
+		self.entries = {}			# name -> sort key, None when the name has no version
+		self.complete = False			# False until entries holds every name, a warm highest() skips them
+		self.mtime = None
+		self.trusted = False			# False when the last listing was too close to the mtime to rely on it
+		self.highest_key = None
+		self.highest_name = None
+		self._version_set = None
+
+	def read(self, path):
+		# Any damage, a half written file or names that won't decode, just means no index
+		try:
+			with open(path) as f:
+				my_index = json.load(f)
+			if my_index.get("version") != INDEX_VERSION or my_index.get("path") != self.path.decode('latin-1'):
+				return None
+			return my_index
+		except (IOError, ValueError, UnicodeError, AttributeError) as e:
+			log.debug("VersionIndex:read: no usable index at {0}, {1}".format(path,e))
+			return None
+
+	def write(self, path, index):
+		my_folder = os.path.dirname(path)
+		if not os.path.isdir(my_folder):
+			os.makedirs(my_folder)
+		# Other agents may be reading it, swap the whole file in
+		my_temp = "{0}.{1}.tmp".format(path, os.getpid())
+		with open(my_temp, 'w') as f:
+			json.dump(index, f)
+		os.rename(my_temp, path)
+
+	def load(self):
+		"""
+		load: Reads the header, the mtime and the highest. The names are only read by load_entries
+		"""
+		my_index = self.read(self.index_path)
+		if my_index is None:
+			return False
+		try:
+			self.mtime = my_index["mtime"]
+			self.trusted = my_index["trusted"]
+			(my_key, my_name) = my_index["highest"]
+			self.highest_key = self.scheme.load_key(my_key)
+			self.highest_name = None if my_name is None else my_name.encode('latin-1')
+		except (KeyError, TypeError, ValueError, UnicodeError) as e:
+			log.debug("VersionIndex:load: bad header in {0}, {1}".format(self.index_path,e))
+			return False
+		return True
+
+	def load_entries(self):
+		"""
+		load_entries: Reads the names written with the header, an index without them starts empty
+		"""
+		my_index = self.read(self.names_path)
+		self.entries = {}
+		self._version_set = None
+		if my_index is None or my_index.get("mtime") != self.mtime:
+			(self.highest_key, self.highest_name) = (None, None)
+			return False
+		load_key = self.scheme.load_key
+		try:
+			self.entries = dict((name.encode('latin-1'), load_key(key)) for (name, key) in my_index["entries"].items())
+		except (KeyError, AttributeError, UnicodeError) as e:
+			log.debug("VersionIndex:load_entries: bad names in {0}, {1}".format(self.names_path,e))
+			self.entries = {}
+			(self.highest_key, self.highest_name) = (None, None)
+			return False
+		self.complete = True
+		return True
+
+	def save(self):
+		my_path = self.path.decode('latin-1')
+		my_names = {"version": INDEX_VERSION, "path": my_path, "mtime": self.mtime,
+			"entries": dict((name.decode('latin-1'), key) for (name, key) in self.entries.items())}
+		my_header = {"version": INDEX_VERSION, "path": my_path, "mtime": self.mtime, "trusted": self.trusted,
+			"highest": [self.highest_key, None if self.highest_name is None else self.highest_name.decode('latin-1')]}
+		# Names first, a header never points at names that aren't there yet
+		self.write(self.names_path, my_names)
+		self.write(self.index_path, my_header)
+
+	def highest(self):
+		"""
+		highest: Returns (highest version, name), refreshing the index first if the directory changed.
+			Only the header is read when it didn't
+		"""
+		my_mtime = os.stat(self.path).st_mtime
+		my_loaded = self.load()
+		if my_loaded and self.trusted and my_mtime == self.mtime:
+			log.debug("VersionIndex:highest: {0} unchanged, {1} from the index".format(self.path,self.highest_name))
+			return self.answer()
+
+		if my_loaded:
+			self.load_entries()
+		self.refresh(my_mtime)
+		try:
+			self.save()
+		except (IOError, OSError, ValueError, UnicodeError, TypeError) as e:
+			log.error("VersionIndex:highest: could not save {0}, {1}".format(self.index_path,e))
+		return self.answer()
+
+	def refresh(self, mtime=None):
+		"""
+		refresh: Lists the directory and takes in the names that came or went since the last listing
+		"""
+		my_mtime = os.stat(self.path).st_mtime if mtime is None else mtime
+		my_listed = time.time()
+		my_names = set(os.listdir(self.path))
+		my_removed = [name for name in self.entries if name not in my_names]
+		my_added = [name for name in my_names if name not in self.entries]
+		log.debug("VersionIndex:refresh: {0} changed, {1} new and {2} removed names".format(self.path,len(my_added),len(my_removed)))
+		self.update(my_added, my_removed)
+
+		# The directory could change again in the same mtime tick as our listing, a listing
+		# that close isn't trusted and the next call lists again
+		self.mtime = my_mtime
+		self.trusted = my_listed - my_mtime > MTIME_GRANULARITY
+		self.complete = True
+
+	def update(self, added, removed):
+		"""
+		update: Takes in names that came and went, only the new ones are parsed
+		"""
+		for my_name in removed:
+			self.entries.pop(my_name, None)
+		for my_name in added:
+			self.entries[my_name] = self.scheme.key_of(my_name)
+		if added or removed:
+			self._version_set = None
+
+		if self.highest_name not in self.entries:
+			# Start over from the stored keys, no parsing
+			(self.highest_key, self.highest_name) = (None, None)
+			my_candidates = self.entries
+		else:
+			# Only new names could have beaten it
+			my_candidates = added
+		for my_name in my_candidates:
+			my_key = self.entries[my_name]
+			if my_key is not None and (self.highest_key is None or my_key > self.highest_key):
+				(self.highest_key, self.highest_name) = (my_key, my_name)
+
+	def version_set(self):
+		"""
+		version_set: The entries as a VersionSet, sorted again only after a change
+		"""
+		if not self.complete and not self.load_entries():
+			self.refresh()
+		if self._version_set is None:
+			my_names = [name for (name, key) in self.entries.items() if key is not None]
+			self._version_set = VersionSet(self.scheme, [self.entries[name] for name in my_names], my_names)
+		return self._version_set
+
+	def answer(self):
+		if self.highest_key is None:
+			return (None, None)
+		return (self.scheme.decode(self.highest_key, self.highest_name), self.highest_name)
+
+class VersionSet(object):
+	"""
+	VersionSet: Parsed names sorted by their keys once, so each constraint query is a bisect
+	or two instead of a pass over every name. Results are (version, name)
+	"""
+
+	def __init__(self, scheme, keys, names):
+		self.scheme = scheme
+		my_order = sorted(xrange(len(keys)), key=keys.__getitem__)
+		self.keys = [keys[i] for i in my_order]
+		self.names = [names[i] for i in my_order]
+
+	def __len__(self):
+		return len(self.keys)
+
+	def prefix(self, prefix=None):
+		"""
+		prefix: (start, end) positions of the versions that start with prefix, all of them for None
+		"""
+		if prefix is None:
+			return (0, len(self.keys))
+		(my_low, my_high) = self.scheme.prefix_range(prefix)
+		return (bisect.bisect_left(self.keys, my_low), bisect.bisect_left(self.keys, my_high))
+
+	def highest(self, prefix=None):
+		"""
+		highest: The highest (version, name) starting with prefix, (None, None) when there isn't one.
+			The first of equal versions wins
+		"""
+		(my_start, my_end) = self.prefix(prefix)
+		if my_end <= my_start:
+			return (None, None)
+		return self.entry(bisect.bisect_left(self.keys, self.keys[my_end - 1], my_start, my_end))
+
+	def top(self, count, prefix=None):
+		"""
+		top: The count highest (version, name) starting with prefix, highest first
+		"""
+		(my_start, my_end) = self.prefix(prefix)
+		return [self.entry(i) for i in xrange(my_end - 1, max(my_start, my_end - count) - 1, -1)]
+
+	def between(self, low, high):
+		"""
+		between: Every (version, name) from version low to version high, both included, lowest first
+		"""
+		my_start = bisect.bisect_left(self.keys, self.scheme.parse(low))
+		my_end = bisect.bisect_right(self.keys, self.scheme.parse(high))
+		return [self.entry(i) for i in xrange(my_start, my_end)]
+
+	def entry(self, i):
+		return (self.scheme.decode(self.keys[i], self.names[i]), self.names[i])
+
+	def answer(self, request):
+		"""
+		answer: The answer to a server style request, {"query": "highest", "prefix": ...} and so on
+		"""
+		if request["query"] == "highest":
+			(my_version, my_name) = self.highest(request.get("prefix"))
+			return {"version": my_version, "name": my_name}
+		if request["query"] == "top":
+			my_count = int(request["count"])
+			if my_count < 1:
+				raise ValueError("top takes a count of 1 or more")
+			return {"versions": self.top(my_count, request.get("prefix"))}
+		if request["query"] == "between":
+			return {"versions": self.between(request["low"], request["high"])}
+		raise KeyError(request["query"])
+
+class ScanGroup(object):
+	"""
+	ScanGroup: A product/branch folder and the highest version found under it so far
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.pending = 1			# Folders of this group not listed yet
+		self.highest_key = None
+		self.highest_name = None
+		self.highest_folder = None
+
+class ArtifactScanner(object):
+	"""
+	ArtifactScanner: Walks scan roots with a pool of threads, each listing one folder at a
+	time, so the round trips to a network share overlap. The folders group_depth below a
+	root are the groups, everything under a group counts towards its highest version.
+	scan() yields each group once the last folder under it has been listed
+	"""
+
+	def __init__(self, roots, scheme=None, group_depth=GROUP_DEPTH, threads=SCAN_THREADS):
+		self.roots = [os.path.abspath(root) for root in roots]
+		self.scheme = scheme or SCHEMES['apple']
+		self.group_depth = group_depth
+		self.threads = max(1, threads)
+		self._lock = threading.Lock()
+		self._due = Queue.Queue()
+		self._done = Queue.Queue()
+		self._pending = 0			# Folders queued or being listed, all roots
+
+	def scan(self):
+		"""
+		scan: Yields a ScanGroup for each group as it finishes, in no particular order
+		"""
+		my_workers = [threading.Thread(target=self._worker, name="scan-{0}".format(i)) for i in range(self.threads)]
+		for my_worker in my_workers:
+			my_worker.daemon = True
+			my_worker.start()
+		try:
+			self._pending = len(self.roots)
+			if not self.roots:
+				return
+			for my_root in self.roots:
+				self._due.put((my_root, 0, self._group_for(my_root, 0, None)))
+			while True:
+				my_group = self._done.get()
+				if my_group is None:
+					break
+				yield my_group
+		finally:
+			for my_worker in my_workers:
+				self._due.put(None)
+			for my_worker in my_workers:
+				my_worker.join()
+
+	def _group_for(self, folder, depth, group):
+		if group is None and depth == self.group_depth:
+			return ScanGroup(folder)
+		return group
+
+	def _worker(self):
+		while True:
+			my_item = self._due.get()
+			if my_item is None:
+				return
+			(my_folder, my_depth, my_group) = my_item
+			(my_files, my_folders) = self.list_folder(my_folder)
+			if my_group is not None:
+				self._update(my_group, my_folder, my_files)
+			# Count the folders before they're queued, or a fast worker could finish the group first
+			self._count(my_group, len(my_folders))
+			for my_name in my_folders:
+				my_path = os.path.join(my_folder, my_name)
+				self._due.put((my_path, my_depth + 1, self._group_for(my_path, my_depth + 1, my_group)))
+			self._count(my_group, -1)
+
+	def _update(self, group, folder, names):
+		(my_keys, my_names) = self.scheme.keys(names)
+		if not my_keys:
+			return
+		i = max(xrange(len(my_keys)), key=my_keys.__getitem__)
+		with self._lock:
+			if group.highest_key is None or my_keys[i] > group.highest_key:
+				(group.highest_key, group.highest_name, group.highest_folder) = (my_keys[i], my_names[i], folder)
+
+	def _count(self, group, change):
+		with self._lock:
+			self._pending += change
+			my_all_done = self._pending == 0
+			my_group_done = False
+			if group is not None:
+				group.pending += change
+				my_group_done = group.pending == 0
+		if my_group_done:
+			self._done.put(group)
+		if my_all_done:
+			self._done.put(None)
+
+	def list_folder(self, folder):
+		"""
+		list_folder: Returns ([file names], [folder names]). With scandir the type comes with the
+			listing, otherwise only the names without a version are an lstat. Symlinked folders
+			aren't followed, a link back up the tree would loop or count another group's
+			artifacts. Hidden folders are skipped
+		"""
+		my_files = []
+		my_folders = []
+		try:
+			if scandir is not None:
+				for entry in scandir(folder):
+					if entry.is_dir(follow_symlinks=False):
+						my_folders.append(entry.name)
+					else:
+						my_files.append(entry.name)
+			else:
+				my_names = os.listdir(folder)
+				# A name with a version is an artifact, no need to ask
+				my_files = self.scheme.keys(my_names)[1]
+				my_versioned = set(my_files)
+				for name in my_names:
+					if name in my_versioned:
+						continue
+					if stat.S_ISDIR(os.lstat(os.path.join(folder, name)).st_mode):
+						my_folders.append(name)
+					else:
+						my_files.append(name)
+		except OSError as e:
+			log.error("ArtifactScanner:list_folder: Received error {0} listing {1}".format(e,folder))
+		my_folders = [name for name in my_folders if not name.startswith('.')]
+		log.debug("ArtifactScanner:list_folder: {0} has {1} files and {2} folders".format(folder,len(my_files),len(my_folders)))
+		return (my_files, my_folders)
+
+class Inotify(object):
+	"""
+	Inotify: The few inotify calls the server needs, through ctypes. Raises OSError where
+	there is no inotify, macOS and friends, and the server polls instead
+	"""
+	IN_MOVED_FROM	= 0x00000040
+	IN_MOVED_TO	= 0x00000080
+	IN_CREATE	= 0x00000100
+	IN_DELETE	= 0x00000200
+	IN_DELETE_SELF	= 0x00000400
+	IN_MOVE_SELF	= 0x00000800
+	IN_Q_OVERFLOW	= 0x00004000
+	IN_IGNORED	= 0x00008000
+	IN_ONLYDIR	= 0x01000000
+	WATCH_MASK	= IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+	EVENT		= struct.Struct('iIII')	# wd, mask, cookie, name length, then the name
+
+	def __init__(self):
+		try:
+			my_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+			self._init = my_libc.inotify_init
+			self._add_watch = my_libc.inotify_add_watch
+		except (OSError, AttributeError) as e:
+			raise OSError(errno.ENOSYS, "no inotify, {0}".format(e))
+		self.fd = self._init()
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+	def add_watch(self, path):
+		my_wd = self._add_watch(self.fd, path, self.WATCH_MASK)
+		if my_wd < 0:
+			my_errno = ctypes.get_errno()
+			raise OSError(my_errno, os.strerror(my_errno), path)
+		return my_wd
+
+	def read(self, timeout):
+		"""
+		read: [(wd, mask, name)] of the events that came within timeout seconds
+		"""
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return []
+		my_data = os.read(self.fd, 65536)
+		my_events = []
+		my_offset = 0
+		while my_offset < len(my_data):
+			(my_wd, my_mask, my_cookie, my_length) = self.EVENT.unpack_from(my_data, my_offset)
+			my_offset += self.EVENT.size
+			my_name = my_data[my_offset:my_offset + my_length].rstrip('\0')
+			my_offset += my_length
+			my_events.append((my_wd, my_mask, my_name))
+		return my_events
+
+class WatchedDirectory(VersionIndex):
+	"""
+	WatchedDirectory: A version index the server keeps in memory, fed by the watcher
+	"""
+
+	def __init__(self, path, scheme):
+		VersionIndex.__init__(self, path, None, scheme)
+		self.wd = None
+
+class DirectoryWatcher(object):
+	"""
+	DirectoryWatcher: The directories the server has been asked about, kept current from a
+	background thread. inotify events are applied as they come. inotify can't see changes
+	made by other machines on a network share, so every query also checks the directory
+	mtime and lists it again when it moved, and idle directories are checked every
+	RECHECK_INTERVAL
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._directories = {}			# (path, scheme name) -> WatchedDirectory
+		self._watches = {}			# inotify wd -> [WatchedDirectory]
+		try:
+			self.inotify = Inotify()
+			self.interval = RECHECK_INTERVAL
+		except OSError as e:
+			log.info("DirectoryWatcher:__init__: polling every {0}s, {1}".format(POLL_INTERVAL,e))
+			self.inotify = None
+			self.interval = POLL_INTERVAL
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="watcher")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def close(self):
+		self._stop.set()
+		self._thread.join()
+
+	def highest(self, path, scheme):
+		"""
+		highest: (highest version, name) in path, the first call for a directory lists it
+		"""
+		with self._lock:
+			return self._directory(path, scheme).answer()
+
+	def version_set(self, path, scheme):
+		"""
+		version_set: The VersionSet of path. A change makes a new one, so it can be queried
+			without the lock
+		"""
+		with self._lock:
+			return self._directory(path, scheme).version_set()
+
+	def _directory(self, path, scheme):
+		my_id = (os.path.abspath(path), scheme.name)
+		my_directory = self._directories.get(my_id)
+		if my_directory is None:
+			my_directory = self._watch(my_id[0], scheme)
+			self._directories[my_id] = my_directory
+			return my_directory
+		try:
+			my_mtime = os.stat(my_directory.path).st_mtime
+			if my_mtime != my_directory.mtime or not my_directory.trusted:
+				my_directory.refresh(my_mtime)
+		except OSError:
+			self._forget(my_directory)
+			raise
+		return my_directory
+
+	def _watch(self, path, scheme):
+		my_directory = WatchedDirectory(path, scheme)
+		# Watch before listing, a name made in between is then seen twice rather than missed
+		if self.inotify is not None:
+			my_directory.wd = self.inotify.add_watch(path)
+			self._watches.setdefault(my_directory.wd, []).append(my_directory)
+		try:
+			my_directory.refresh()
+		except OSError:
+			self._forget(my_directory)
+			raise
+		log.debug("DirectoryWatcher:_watch: {0} {1}, {2} names".format(path,scheme.name,len(my_directory.entries)))
+		return my_directory
+
+	def _forget(self, directory):
+		self._directories.pop((directory.path, directory.scheme.name), None)
+		my_watchers = self._watches.get(directory.wd, [])
+		if directory in my_watchers:
+			my_watchers.remove(directory)
+		if not my_watchers:
+			self._watches.pop(directory.wd, None)
+
+	def _run(self):
+		my_next_check = time.time() + self.interval
+		while not self._stop.is_set():
+			my_wait = max(0, my_next_check - time.time())
+			if self.inotify is not None:
+				# Short waits so close() is noticed quickly
+				self._apply(self.inotify.read(min(my_wait, 1.0)))
+			else:
+				self._stop.wait(my_wait)
+			if time.time() >= my_next_check:
+				self._check_all()
+				my_next_check = time.time() + self.interval
+
+	def _apply(self, events):
+		my_changed = set()
+		with self._lock:
+			for (my_wd, my_mask, my_name) in events:
+				if my_mask & Inotify.IN_Q_OVERFLOW:
+					log.info("DirectoryWatcher:_apply: inotify queue overflowed, listing everything again")
+					for my_directory in self._directories.values():
+						self._refresh(my_directory)
+					continue
+				for my_directory in list(self._watches.get(my_wd, [])):
+					if my_mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF | Inotify.IN_IGNORED):
+						# Gone, the next question about it starts over
+						self._forget(my_directory)
+					elif my_mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+						my_directory.update([my_name], [])
+						my_changed.add(my_directory)
+					elif my_mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+						my_directory.update([], [my_name])
+						my_changed.add(my_directory)
+			for my_directory in my_changed:
+				self._events_applied(my_directory)
+
+	def _events_applied(self, directory):
+		# The entries are current, take the mtime they go with so the next query doesn't list
+		# again. A later local change comes as an event of its own, so the listing is trusted
+		# even this close to the mtime. A change from another machine in the same tick is
+		# only seen once the mtime moves again
+		if (directory.path, directory.scheme.name) not in self._directories:
+			return
+		try:
+			directory.mtime = os.stat(directory.path).st_mtime
+			directory.trusted = True
+		except OSError:
+			self._forget(directory)
+
+	def _check_all(self):
+		with self._lock:
+			for my_directory in self._directories.values():
+				try:
+					my_mtime = os.stat(my_directory.path).st_mtime
+				except OSError:
+					self._forget(my_directory)
+					continue
+				if my_mtime != my_directory.mtime or not my_directory.trusted:
+					self._refresh(my_directory, my_mtime)
+
+	def _refresh(self, directory, mtime=None):
+		try:
+			directory.refresh(mtime)
+		except OSError as e:
+			log.error("DirectoryWatcher:_refresh: could not list {0}, {1}".format(directory.path,e))
+			self._forget(directory)
+
+class VersionRequestHandler(SocketServer.StreamRequestHandler):
+	"""
+	VersionRequestHandler: One JSON request per line, {"query": "highest", "path": ..., "scheme": ...},
+	and one JSON answer per line, {"version": ..., "name": ...} or {"error": ...}. highest also
+	takes a "prefix", "top" a "count" and a "prefix", "between" a "low" and a "high", the last
+	two answer {"versions": [[version, name], ...]}. Paths and names are bytes sent as latin-1
+	"""
+
+	def handle(self):
+		for my_line in iter(self.rfile.readline, ''):
+			try:
+				my_request = VersionClient.from_wire(json.loads(my_line))
+				my_answer = self.server.answer(my_request)
+			except (ValueError, KeyError, TypeError) as e:
+				my_answer = {"error": "bad request, {0}".format(e)}
+			except (IOError, OSError) as e:
+				my_answer = {"error": str(e)}
+			self.wfile.write(json.dumps(VersionClient.to_wire(my_answer)) + "\n")
+			self.wfile.flush()
+
+class VersionServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	"""
+	VersionServer: Answers version questions over a Unix socket from what the watcher holds
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, socket_path=SOCKET_PATH):
+		self.socket_path = socket_path
+		my_folder = os.path.dirname(os.path.abspath(socket_path))
+		if not os.path.isdir(my_folder):
+			os.makedirs(my_folder)
+		if os.path.exists(socket_path):
+			if VersionClient(socket_path).query("ping") is not None:
+				raise OSError(errno.EADDRINUSE, "a server is already listening", socket_path)
+			os.remove(socket_path)
+		self.watcher = DirectoryWatcher()
+		SocketServer.UnixStreamServer.__init__(self, socket_path, VersionRequestHandler)
+
+	def answer(self, request):
+		if request["query"] == "ping":
+			return {"version": None, "name": None}
+		my_scheme = SCHEMES[request.get("scheme", "apple")]
+		my_path = request["path"]
+		if request["query"] == "highest" and request.get("prefix") is None:
+			(my_version, my_name) = self.watcher.highest(my_path, my_scheme)
+			return {"version": my_version, "name": my_name}
+		return self.watcher.version_set(my_path, my_scheme).answer(request)
+
+	def server_close(self):
+		SocketServer.UnixStreamServer.server_close(self)
+		self.watcher.close()
+		try:
+			os.remove(self.socket_path)
+		except OSError:
+			pass
+
+class VersionClient(object):
+	"""
+	VersionClient: Asks the resident server, None when there isn't one or it didn't answer.
+	A socket another user owns is never asked, its answers could be anything
+	"""
+	WIRE_ENCODING = 'latin-1'		# Any byte string file name survives JSON this way
+
+	def __init__(self, socket_path=SOCKET_PATH, timeout=CLIENT_TIMEOUT):
+		self.socket_path = socket_path
+		self.timeout = timeout
+
+	@classmethod
+	def to_wire(cls, value):
+		# Byte strings in, JSON safe text out
+		if isinstance(value, str):
+			return value.decode(cls.WIRE_ENCODING)
+		if isinstance(value, (list, tuple)):
+			return [cls.to_wire(v) for v in value]
+		if isinstance(value, dict):
+			return dict((k, cls.to_wire(v)) for (k, v) in value.items())
+		return value
+
+	@classmethod
+	def from_wire(cls, value):
+		# And back, the same byte strings on the other side
+		if isinstance(value, unicode):
+			return value.encode(cls.WIRE_ENCODING)
+		if isinstance(value, list):
+			return [cls.from_wire(v) for v in value]
+		if isinstance(value, dict):
+			return dict((k, cls.from_wire(v)) for (k, v) in value.items())
+		return value
+
+	def query(self, query, path=None, scheme=None, **params):
+		my_request = dict(params, query=query)
+		if path is not None:
+			if isinstance(path, unicode):
+				path = path.encode('utf-8')
+			my_request["path"] = os.path.abspath(path)
+		if scheme is not None:
+			my_request["scheme"] = scheme
+		try:
+			if os.stat(self.socket_path).st_uid != os.getuid():
+				log.error("VersionClient:query: {0} belongs to another user, not asking it".format(self.socket_path))
+				return None
+		except OSError:
+			return None
+		my_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		my_socket.settimeout(self.timeout)
+		try:
+			my_socket.connect(self.socket_path)
+			my_socket.sendall(json.dumps(self.to_wire(my_request)) + "\n")
+			my_reply = my_socket.makefile('r').readline()
+		except socket.error:
+			return None
+		finally:
+			my_socket.close()
+		try:
+			my_answer = self.from_wire(json.loads(my_reply))
+		except (ValueError, UnicodeError):
+			return None
+		if "error" in my_answer:
+			log.error("VersionClient:query: server could not answer {0}, {1}".format(my_request,my_answer["error"]))
+			return None
+		return my_answer
+
+# Schemes by the name --scheme takes
+SCHEMES = dict((scheme.name, scheme) for scheme in (AppleScheme(), SemVerScheme(), PEP440Scheme(), BuildNumberScheme(), AutoScheme()))
+
 ################################################################################
 # RUN AS SCRIPT
 ################################################################################
@@ -203,6 +1352,26 @@ if __name__ == "__main__":
 
 	parser.add_argument('-p', '--path',		default="path", help = "Path to the directory")
 	parser.add_argument('-n', '--name',		action="store_true",  help = "Return output as name of file instead of just version")
+	parser.add_argument('-s', '--scheme',		default='apple', choices=sorted(SCHEMES), help = "How versions are written, apple is the 3 tuple .dmg rules")
+	parser.add_argument('--index',			default=INDEX_DIR, help = "Folder for the version indexes")
+	parser.add_argument('--no-index',		action="store_true",  help = "List and parse the whole directory every time")
+	parser.add_argument('--scan',			nargs='+', default=None, metavar='ROOT', help = "Walk these roots and print the highest version of each group under them")
+	parser.add_argument('--group-depth',		type=int, default=GROUP_DEPTH, help = "Folders under a root that make a group, 2 for product/branch")
+	parser.add_argument('--prefix',			default=None, help = "Highest version starting with this, like 10.x or 12.4")
+	parser.add_argument('--top',			type=int, default=None, metavar='N', help = "The N highest versions, highest first, within --prefix if given")
+	parser.add_argument('--between',		nargs=2, default=None, metavar=('LOW', 'HIGH'), help = "Every version from LOW to HIGH, both included, lowest first")
+	parser.add_argument('--serve',			action="store_true",  help = "Stay up and answer lookups over the socket")
+	parser.add_argument('--socket',			default=SOCKET_PATH, help = "Unix socket of the resident server, an empty string to not use one")
+	parser.add_argument('--threads',		type=int, default=SCAN_THREADS, help = "Folders listed at once by --scan")
 	args = parser.parse_args()
+	if args.top is not None and args.top < 1:
+		parser.error("--top takes a count of 1 or more")
 
-	ExecuteScript(args).return_highest_tuple_for_path()
+	if args.serve:
+		ExecuteScript(args).serve()
+	elif args.scan:
+		ExecuteScript(args).return_highest_tuple_per_group()
+	elif args.prefix is not None or args.top is not None or args.between is not None:
+		ExecuteScript(args).return_versions_for_path()
+	else:
+		ExecuteScript(args).return_highest_tuple_for_path()
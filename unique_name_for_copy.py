@@ -17,11 +17,89 @@
 	Added function to rename files in a target directory. This is for
 	items that are already imported and just need renaming.
 
+	10/18/26 -RH
+	Replaced the one ditto per file copy with an in-process copy engine.
+	Files are copied by a bounded pool of threads (--jobs) using the
+	kernel copy calls where they are supported.
+
+	10/18/26 -RH
+	Added an ingest journal in the destination folder. Copies go to a
+	.part file and are checkpointed, so an interrupted import resumes
+	where it stopped and verified files are skipped without reading them.
+
+	10/18/26 -RH
+	Added a content dedup index of the destination folder. Clips that are
+	already in the library are skipped, clips that only share a time
+	stamp name get a _1, _2 suffix instead of being dropped.
+
+	10/18/26 -RH
+	--inplace renames are planned up front. Clashing names get a suffix,
+	rename cycles are broken with a temporary name, and the batch is
+	applied with a rollback log (--undo). --dry-run prints the plan.
+
+	10/18/26 -RH
+	Names are formatted straight from the stat numbers instead of going
+	through a time.ctime string, with one format per second cached. The
+	time used can be the ctime, mtime or birth time (--time-source).
+
+	10/18/26 -RH
+	Added a small MP4/MOV atom reader so clips can be named from the
+	creation time the camera wrote into the moov/mvhd box, which survives
+	copies (--time-source mvhd).
+
+	10/18/26 -RH
+	Cameras are described by profiles (Drift, Bullet HD, GoPro 4 and any
+	from a JSON file) instead of a chain of endswith checks. Sidecar
+	files (THM, LRV) are renamed and copied along with their clip.
+
+	10/18/26 -RH
+	Imports walk the card with scandir, into DCIM/100GOPRO style folders,
+	and start copying while the rest of the card is still being listed.
+	The stat data from the listing is reused instead of asking again.
+
+	10/18/26 -RH
+	Imports keep per phase timings, bytes/s, files/s and an ETA, and can
+	write a JSON summary (--summary). Per file DEBUG lines are off unless
+	--log-files is given, formatting them was measurable on big cards.
+
 ################################################################################
 """
 
-import os.path,time,argparse,logging,datetime,subprocess,sys
-from subprocess import Popen
+import os.path,time,argparse,logging,sys,shutil,threading,Queue,errno,hashlib,sqlite3,json,struct,re,stat,contextlib,ctypes,ctypes.util
+
+# scandir is in os from Python 3.5, the scandir package backports it, listdir does without
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+################################################################################
+# CONSTANTS
+################################################################################
+COPY_CHUNK_SIZE = 8 * 1024 * 1024	# Bytes moved per read/write or kernel copy call
+DEFAULT_JOBS	= 4			# Copy threads, cards and disks rarely like more
+
+STATE_FOLDER	= ".uniquename"			# Journal and index live here, so their writes leave the destination mtime alone
+JOURNAL_NAME	= "journal.db"			# Ingest journal in the state folder
+PARTIAL_SUFFIX	= ".part"			# In flight copies, renamed when complete
+CHECKPOINT_SIZE	= 64 * 1024 * 1024		# Bytes between journal checkpoints of a copy
+JOURNAL_COMMIT_ROWS = 64			# Journal checkpoints batched into one SQLite transaction
+JOURNAL_COMMIT_SECONDS = 2.0			# Longest a journal checkpoint waits for its batch to commit
+INDEX_NAME	= "index.db"			# Dedup index in the state folder
+PARTIAL_HASH_SIZE = 64 * 1024			# Bytes hashed from each end of a file for the dedup prefilter
+RENAME_LOG_NAME	= ".uniquename_rename.log"	# Rollback log of the last --inplace batch
+
+TIME_SOURCES	= ('ctime', 'mtime', 'birthtime', 'mvhd')	# Times a clip can be named from
+MVHD_FALLBACK	= 'mtime'			# Stat time used when a clip has no mvhd time, it survives copies
+MP4_EPOCH_OFFSET = 2082844800			# Seconds from 1904-01-01 (QuickTime epoch) to 1970-01-01
+PROFILES_PATH	= os.path.expanduser("~/.uniquename_profiles.json")	# User camera profiles, loaded when present
+
+# errno values that mean "this kernel copy call can't do this pair of files"
+KERNEL_COPY_UNSUPPORTED = set(getattr(errno, name) for name in
+	('EXDEV', 'EINVAL', 'ENOSYS', 'ENOTSUP', 'EOPNOTSUPP', 'ENOTSOCK', 'EBADF') if hasattr(errno, name))
 
 ################################################################################
 # LOGGING
@@ -35,6 +113,10 @@ logger1.setLevel(logging.DEBUG)
 logger1.setFormatter(formatter)
 log.addHandler(logger1)
 
+# Per file DEBUG lines go through log_file, they're only formatted with --log-files
+file_log = logging.getLogger('uniquename.files')
+file_log.setLevel(logging.INFO)
+
 ################################################################################
 # CLASSES
 ################################################################################
@@ -53,17 +135,22 @@ class ExecutePlan(object):
 			self.usage()
 			sys.exit(0)
 
+		if not self.args.inplace:
+			# The card is walked as it's copied, no snapshot needed
+			ut = MoveCameraFiles(self.args)
+			ut.move_files_with_final_name()
+			return
+
 		# Snapshot source folder
 		self.source_files = os.listdir(self.args.source)
-		log.debug("ExecutePlan:run: self.source_files eq {0}".format(self.source_files))
+		log_file("ExecutePlan:run: self.source_files eq {0}", self.source_files)
 
 		items_count = len(self.source_files)
-		if (self.args.inplace and items_count > 0):
+		if (self.args.undo):
+			RenameCameraFiles(self.args,self.source_files).undo_rename()
+		elif (items_count > 0):
 			rcf = RenameCameraFiles(self.args,self.source_files)
 			rcf.rename_camera_file()
-		elif (items_count > 0):
-			ut = MoveCameraFiles(self.args,self.source_files)
-			ut.move_files_with_final_name()
 
 	def usage(self):
 		if (self.args.inplace):
@@ -75,14 +162,209 @@ class ExecutePlan(object):
 			print("<required> '-d' or '--dest' The path to the destination folder")
 
 
+class CameraProfile(object):
+	"""
+	CameraProfile -- What one camera leaves on a card. Glob patterns pick out its
+			clips, sidecar templates name the files that belong to a clip
+			({stem} is the clip name without its extension), and the naming
+			rules say what extension and time a renamed clip gets
+	"""
+	def __init__(self,name,include,exclude=(),sidecars=(),extension=".mp4",time_source=None):
+		self.name = name
+		self.include = list(include)
+		self.exclude = list(exclude)
+		self.sidecars = list(sidecars)
+		self.extension = extension
+		self.time_source = time_source
+
+	def pattern(self):
+		# One regex for the profile, the excludes are a lookahead in front of the includes
+		my_pattern = "(?:{0})".format("|".join(glob_to_regex(p) for p in self.include))
+		if self.exclude:
+			my_pattern = "(?!(?:{0})$){1}".format("|".join(glob_to_regex(p) for p in self.exclude), my_pattern)
+		return(my_pattern)
+
+	def sidecar_names(self,stem):
+		return([template.format(stem=stem) for template in self.sidecars])
+
+
+class CameraProfileRegistry(object):
+	"""
+	CameraProfileRegistry -- The known camera profiles, compiled into one regex so a
+			file name is classified with a single match. The first profile
+			registered wins when two match
+	"""
+	BUILTIN = (
+		# Drift camera, thumbnails are _thm.mp4 files next to the clip
+		CameraProfile("Drift", ["*.mp4"], ["*_thm.mp4"], ["{stem}_thm.mp4"]),
+		# Bullet HD Camera for motorcycle
+		CameraProfile("Bullet HD", ["*.MOV"]),
+		# GoPro 4, thumbnail and low resolution preview next to the clip
+		CameraProfile("GoPro 4", ["*.MP4"], [], ["{stem}.THM", "{stem}.LRV"]),
+	)
+
+	def __init__(self):
+		self.profiles = []
+		self._matcher = None
+
+	@classmethod
+	def default(cls,config_path=None):
+		"""
+		default: Registry with the user's profiles first, then the built in ones
+		"""
+		registry = cls()
+		config_path = config_path or PROFILES_PATH
+		if os.path.exists(config_path):
+			registry.load(config_path)
+		for profile in cls.BUILTIN:
+			registry.register(profile)
+		return(registry)
+
+	def register(self,profile):
+		self.profiles.append(profile)
+		self._matcher = None
+
+	def load(self,config_path):
+		"""
+		load: Adds the profiles in a JSON file, a list of objects with the CameraProfile arguments
+		"""
+		with open(config_path) as f:
+			for entry in json.load(f):
+				self.register(CameraProfile(**dict((str(k), v) for (k, v) in entry.items())))
+		log.debug("CameraProfileRegistry:load: loaded profiles from {0}".format(config_path))
+
+	def compile(self):
+		groups = ["(?P<p{0}>{1})".format(n, profile.pattern()) for (n, profile) in enumerate(self.profiles)]
+		self._matcher = re.compile("^(?:{0})$".format("|".join(groups)), re.DOTALL)
+		return(self._matcher)
+
+	def classify(self,names):
+		"""
+		classify: Yields a CameraClip for every clip in names, with the sidecars found next to it
+		"""
+		match = (self._matcher or self.compile()).match
+		present = set(names)
+		for name in names:
+			m = match(name)
+			if m is None:
+				continue
+			profile = self.profiles[int(m.lastgroup[1:])]
+			stem = os.path.splitext(name)[0]
+			sidecars = [sidecar for sidecar in profile.sidecar_names(stem) if sidecar in present]
+			yield CameraClip(name, profile, sidecars)
+
+
+class CameraClip(object):
+	"""
+	CameraClip -- A clip, the profile it matched and the sidecar files that go with it.
+			Clips found by SourceWalker also know their folder and carry the
+			stat results from the listing, by file name
+	"""
+	def __init__(self,name,profile,sidecars=(),folder=None,stats=None):
+		self.name = name
+		self.profile = profile
+		self.sidecars = list(sidecars)
+		self.folder = folder
+		self.stats = stats or {}
+
+	@property
+	def path(self):
+		return(os.path.join(self.folder, self.name))
+
+	@property
+	def stat(self):
+		return(self.stat_of(self.name))
+
+	def stat_of(self,name):
+		# Listing stat when we have it, otherwise ask once and keep it
+		if name not in self.stats:
+			self.stats[name] = os.stat(os.path.join(self.folder, name))
+		return(self.stats[name])
+
+	def sidecar_targets(self,new_name):
+		"""
+		sidecar_targets: Returns (sidecar, new sidecar name) pairs for when the clip is called new_name
+		"""
+		old_stem = os.path.splitext(self.name)[0]
+		new_stem = os.path.splitext(new_name)[0]
+		return([(sidecar, new_stem + sidecar[len(old_stem):]) for sidecar in self.sidecars])
+
+
+class SourceWalker(object):
+	"""
+	SourceWalker -- Walks a card with scandir and yields a CameraClip for each clip as
+			each folder is listed, so work can start before the whole card
+			has been read. Camera layouts like DCIM/100GOPRO/ are followed,
+			hidden folders are not
+	"""
+	def __init__(self,root,registry,recursive=True,stats=None):
+		self.root = os.path.abspath(root)
+		self.registry = registry
+		self.recursive = recursive
+		self.stats = stats or IngestStats()
+		self.folder_count = 0
+
+	def __iter__(self):
+		for clip in self.walk(self.root):
+			yield clip
+		self.stats.scan_done = True
+
+	def walk(self,folder):
+		with self.stats.phase('scan'):
+			(files, folders) = self.list_folder(folder)
+		self.folder_count += 1
+		with self.stats.phase('classify'):
+			clips = list(self.registry.classify(sorted(files)))
+		for clip in clips:
+			clip.folder = folder
+			clip.stats = files
+			yield clip
+
+		if self.recursive:
+			for name in sorted(folders):
+				if name.startswith('.'):
+					continue
+				for clip in self.walk(os.path.join(folder, name)):
+					yield clip
+
+	def list_folder(self,folder):
+		"""
+		list_folder: Returns ({file name: stat}, [folder names]). With scandir the file
+			type comes with the listing and stat is only asked for files
+		"""
+		files = {}
+		folders = []
+		try:
+			if scandir is not None:
+				for entry in scandir(folder):
+					if entry.is_dir():
+						folders.append(entry.name)
+					elif entry.is_file():
+						files[entry.name] = entry.stat()
+			else:
+				for name in os.listdir(folder):
+					my_stat = os.stat(os.path.join(folder, name))
+					if stat.S_ISDIR(my_stat.st_mode):
+						folders.append(name)
+					elif stat.S_ISREG(my_stat.st_mode):
+						files[name] = my_stat
+		except OSError as e:
+			log.error("SourceWalker:list_folder: Received error {0} listing {1}".format(e,folder))
+		log_file("SourceWalker:list_folder: {0} has {1} files and {2} folders", folder, len(files), len(folders))
+		return(files, folders)
+
 class CameraFile(object):
 	"""
 	CameraFile -- A class that will validate if a file is supported or not and add
-			the files to a property list
+			the clips to a property list
 	"""
-	def __init__(self,source_files):
+	# Formatted names by whole second, clips from one card share a lot of them
+	_formatted_cache = {}
+
+	def __init__(self,args,source_files):
 		self.args = args
 		self.source_files = source_files
+		self.registry = CameraProfileRegistry.default(args.profiles)
 		self._movie_file = []
 
 	# PROPERTIES
@@ -97,30 +379,129 @@ class CameraFile(object):
 
 	def is_mov_file(self):
 		# Call before using the property getter for movie_files
-		for i in self.source_files:
-			# Drift camera
-			if not i.endswith("_thm.mp4") and i.endswith(".mp4"):
-				log.debug("MoveCameraFiles:is_mov_file: mp4 {0}".format(i))
-				self.movie_files = i
-			# Bullet HD Camera for motorcycle
-			elif i.endswith(".MOV"):
-				log.debug("MoveCameraFiles:is_mov_file: .MOV {0}".format(i))
-				self.movie_files = i
-			# GoPro 4
-			elif i.endswith(".MP4"):
-				log.debug("MoveCameraFiles:is_mov_file: .MP4 {0}".format(i))
-				self.movie_files = i
+		for clip in self.registry.classify(self.source_files):
+			self.movie_files = clip
+		log.debug("CameraFile:is_mov_file: {0} clips in {1} files".format(len(self._movie_file),len(self.source_files)))
+
+	def walk(self,source,recursive=True,stats=None):
+		"""
+		walk: Yields the clips under source as they are found
+		"""
+		return(SourceWalker(source, self.registry, recursive, stats))
+
+	def clip_name(self,path,clip,my_stat=None):
+		"""
+		clip_name: The new name for a clip, using its profile's naming rules
+		"""
+		time_source = self.args.time_source or clip.profile.time_source or 'ctime'
+		return(self.format_date_time(self.file_time(path, time_source, my_stat), clip.profile.extension))
+
+	def file_time(self,path,time_source='ctime',my_stat=None):
+		"""
+		file_time: Returns the time the clip is named from, as seconds since the epoch.
+			my_stat saves a stat call when the caller already has one
+		"""
+		if time_source == 'mvhd':
+			my_time = MovieAtomReader(path).creation_time()
+			if my_time is not None:
+				return(my_time)
+			log_file("CameraFile:file_time: no mvhd time in {0}, using {1}", path, MVHD_FALLBACK)
+			return(stat_time(my_stat or os.stat(path), MVHD_FALLBACK))
+		return(stat_time(my_stat or os.stat(path), time_source))
 
 	@staticmethod	
-	def format_date_time(the_ctime):
-		# Get the create time for the files in the mov_list
-		my_date_time = datetime.datetime.strptime(the_ctime, "%a %b %d %H:%M:%S %Y")
-		my_format = "%m%d%Y_%H%M%S"
-		my_final_date_time = my_date_time.strftime(my_format)
-		my_final_formatted = "{0}.mp4".format(my_final_date_time)
-		log.debug("MoveCameraFiles:format_date_time: final formatted time is {0}".format(my_final_formatted))
+	def format_date_time(the_time,extension=".mp4"):
+		# Name for a time in seconds, MMDDYYYY_HHMMSS.mp4 in local time
+		second = int(the_time)
+		try:
+			return(CameraFile._formatted_cache[second] + extension)
+		except KeyError:
+			pass
+		t = time.localtime(second)
+		# Numbers only, so no locale can change the name
+		my_final_date_time = "%02d%02d%04d_%02d%02d%02d" % (t.tm_mon, t.tm_mday, t.tm_year, t.tm_hour, t.tm_min, t.tm_sec)
+		CameraFile._formatted_cache[second] = my_final_date_time
+		my_final_formatted = my_final_date_time + extension
+		log_file("MoveCameraFiles:format_date_time: final formatted time is {0}", my_final_formatted)
 		return(my_final_formatted)
 
+class MovieAtomReader(object):
+	"""
+	MovieAtomReader -- Reads the creation time out of the moov/mvhd box of an MP4 or
+			MOV file. Only box headers are read, everything else (mdat, the
+			actual video) is skipped with a seek, so a multi-GB clip costs
+			a handful of small reads wherever the moov box sits
+	"""
+	MAX_BOXES = 64		# A real clip has a few top level boxes, stop on garbage
+
+	def __init__(self,path):
+		self.path = path
+
+	def creation_time(self):
+		"""
+		creation_time: Returns the mvhd creation time as seconds since the epoch, or
+			None when the file has no usable mvhd box
+		"""
+		try:
+			with open(self.path, 'rb') as f:
+				size = os.fstat(f.fileno()).st_size
+				moov = self._find_box(f, 'moov', 0, size)
+				if moov is None:
+					return(None)
+				mvhd = self._find_box(f, 'mvhd', moov[0], moov[1])
+				if mvhd is None:
+					return(None)
+				f.seek(mvhd[0])
+				data = f.read(12)
+		except (IOError, OSError) as e:
+			log.error("MovieAtomReader:creation_time: Received error {0} reading {1}".format(e,self.path))
+			return(None)
+
+		if len(data) < 8:
+			return(None)
+		# FullBox header, version 1 has 64 bit times
+		if ord(data[0:1]) == 1:
+			if len(data) < 12:
+				return(None)
+			(created,) = struct.unpack(">Q", data[4:12])
+		else:
+			(created,) = struct.unpack(">I", data[4:8])
+
+		# Cameras with no clock set write zero
+		if created == 0:
+			return(None)
+		return(created - MP4_EPOCH_OFFSET)
+
+	def _find_box(self,f,box_type,start,end):
+		# Returns (payload start, payload end) of the first box_type between start and end
+		position = start
+		for i in range(self.MAX_BOXES):
+			if position + 8 > end:
+				return(None)
+			f.seek(position)
+			header = f.read(8)
+			if len(header) < 8:
+				return(None)
+			(box_size, my_type) = struct.unpack(">I4s", header)
+			header_size = 8
+			if box_size == 1:
+				# 64 bit size follows the type, mdat of a long clip needs it
+				large = f.read(8)
+				if len(large) < 8:
+					return(None)
+				(box_size,) = struct.unpack(">Q", large)
+				header_size = 16
+			elif box_size == 0:
+				# Box runs to the end of its parent
+				box_size = end - position
+			if box_size < header_size:
+				log.debug("MovieAtomReader:_find_box: bad box size {0} at {1} in {2}".format(box_size,position,self.path))
+				return(None)
+			if my_type == box_type:
+				return((position + header_size, min(position + box_size, end)))
+			position += box_size
+		return(None)
+
 class RenameCameraFiles(object):
 	"""
 	RenameCameraFiles -- A class to rename the files instead of copy
@@ -130,91 +511,953 @@ class RenameCameraFiles(object):
 		self.source_files = source_files
 
 	def rename_camera_file(self):
-		cf = CameraFile(self.source_files)
+		cf = CameraFile(self.args,self.source_files)
 
 		# Creates the list of movie files from the source files list
 		cf.is_mov_file()
 
-		original_count = len(cf.movie_files)
-		current_count = original_count
-		print("Working on {0} files".format(original_count))
+		print("Working on {0} files".format(len(cf.movie_files)))
 
-		for i in cf.movie_files:
-			os.chdir(self.args.source)
-			my_date_time = time.ctime(os.path.getctime(i))
-			formatted_time = cf.format_date_time(my_date_time)
-			log.debug("MoveCameraFiles:formatted_time:  {0}".format(formatted_time))
+		# Work out every new name before anything is touched
+		planner = RenamePlanner(self.args.source, self.source_files)
+		for clip in cf.movie_files:
+			formatted_time = cf.clip_name(os.path.join(self.args.source, clip.name), clip)
+			log_file("MoveCameraFiles:formatted_time:  {0}", formatted_time)
+			planner.add(clip.name, formatted_time, clip.sidecar_targets)
+		plan = planner.plan()
 
+		original_count = len(plan)
+		current_count = original_count
+		for (my_source, my_dest) in plan:
 			print("\nWorking on {0} of {1}.".format(current_count,original_count))
-			print("Will rename file from {0} to {1}".format(i,formatted_time))
-
-			os.rename(i, formatted_time)
+			print("Will rename file from {0} to {1}".format(my_source,my_dest))
 			current_count -= 1
 
+		if self.args.dry_run:
+			print("\nDry run, {0} renames planned, {1} files already named.".format(original_count,planner.unchanged_count))
+			return
+
+		if not plan:
+			# Nothing to undo, --undo would revert an older batch from its log
+			print("\nNothing to rename, {0} files already named.".format(planner.unchanged_count))
+			return
+
+		planner.apply(plan)
+		print("\nRenamed {0} files, {1} already named. Undo with --undo.".format(original_count,planner.unchanged_count))
+
+	def undo_rename(self):
+		reverted = RenamePlanner(self.args.source, self.source_files).undo()
+		print("Reverted {0} renames.".format(reverted))
+
+class RenamePlanner(object):
+	"""
+	RenamePlanner -- Plans a batch of renames in one folder. Names that clash get a
+			_N suffix in a fixed order, renames that would land on a file
+			that is itself being renamed are ordered so nothing is ever
+			overwritten, and cycles go through a temporary name
+	"""
+	def __init__(self,folder,folder_files):
+		self.folder = folder
+		self.folder_files = set(folder_files)
+		self.targets = {}
+		self.sidecars = {}
+		self.unchanged_count = 0
+		self.log_path = os.path.join(folder, RENAME_LOG_NAME)
+
+	def add(self,name,target,sidecar_targets=None):
+		# sidecar_targets maps a name for the clip to the (sidecar, new name) pairs that follow it
+		self.targets[name] = target
+		if sidecar_targets:
+			self.sidecars[name] = sidecar_targets
+
+	def _group(self,name,candidate):
+		# The renames that go with calling name candidate
+		group = [(name, candidate)]
+		if name in self.sidecars:
+			group.extend(self.sidecars[name](candidate))
+		return(group)
+
+	def plan(self):
+		"""
+		plan: Returns the list of (source, dest) renames in a safe order
+		"""
+		moving = set(self.targets)
+		for name in self.sidecars:
+			moving.update(sidecar for (sidecar, dest) in self._group(name, self.targets[name])[1:])
+
+		# Files we don't rename keep their names, and clips already named right keep theirs first
+		claimed = set(self.folder_files - moving)
+		moves = {}
+		for (name, target) in self.targets.items():
+			if name == target:
+				self._claim(self._group(name, name), claimed, moves)
+		self.unchanged_count = len([name for (name, target) in self.targets.items() if name == target])
+
+		# The next suffix to try for each name, so each clash is resolved in one step
+		next_suffix = {}
+		for name in sorted(self.targets, key=lambda n: (self.targets[n], n)):
+			target = self.targets[name]
+			if name == target:
+				continue
+			candidate = target
+			while any(dest in claimed for (source, dest) in self._group(name, candidate)):
+				next_suffix[target] = next_suffix.get(target, 0) + 1
+				candidate = suffixed_name(target, next_suffix[target])
+			self._claim(self._group(name, candidate), claimed, moves)
+			if candidate == name:
+				# Already carries its suffixed name from an earlier run
+				self.unchanged_count += 1
+
+		return(self._order(moves))
+
+	@staticmethod
+	def _claim(group,claimed,moves):
+		for (source, dest) in group:
+			claimed.add(dest)
+			if source != dest:
+				moves[source] = dest
+
+	def _order(self,moves):
+		# A rename is ready once nothing still waiting to move sits on its target
+		ordered = []
+		waiting_on = dict((dest, source) for (source, dest) in moves.items())
+		ready = sorted(source for (source, dest) in moves.items() if dest not in moves)
+		while ready:
+			source = ready.pop()
+			ordered.append((source, moves.pop(source)))
+			# source is free now, whoever wanted it can go
+			if source in waiting_on:
+				ready.append(waiting_on.pop(source))
+
+		# What is left are cycles, park one file to the side to open each one
+		while moves:
+			start = min(moves)
+			temp = "{0}{1}".format(start, PARTIAL_SUFFIX)
+			while temp in self.folder_files or temp in moves:
+				temp += PARTIAL_SUFFIX
+			log.debug("RenamePlanner:_order: breaking rename cycle at {0} with {1}".format(start,temp))
+			ordered.append((start, temp))
+			final = moves.pop(start)
+			current = waiting_on.pop(start)
+			while current != start:
+				ordered.append((current, moves.pop(current)))
+				current = waiting_on.pop(current)
+			ordered.append((temp, final))
+		return(ordered)
+
+	def apply(self,plan):
+		"""
+		apply: Runs the plan, logging each rename before it happens. If a rename
+			fails, the ones already done are reverted
+		"""
+		done = []
+		with open(self.log_path, 'w') as rename_log:
+			try:
+				for (source, dest) in plan:
+					if os.path.exists(os.path.join(self.folder, dest)):
+						raise OSError(errno.EEXIST, "rename target already exists", dest)
+					rename_log.write(json.dumps([source, dest]) + "\n")
+					rename_log.flush()
+					os.rename(os.path.join(self.folder, source), os.path.join(self.folder, dest))
+					done.append((source, dest))
+			except OSError as e:
+				log.error("RenamePlanner:apply: Received error {0}, rolling back {1} renames".format(e,len(done)))
+				print("Rename failed ({0}), rolling back.".format(e))
+				self._revert(done)
+				raise
+		log.debug("RenamePlanner:apply: renamed {0} files, log in {1}".format(len(done),self.log_path))
+
+	def undo(self):
+		"""
+		undo: Reverts the renames recorded in the rollback log of the last batch
+		"""
+		if not os.path.exists(self.log_path):
+			print("No rename log found in {0}.".format(self.folder))
+			return(0)
+		with open(self.log_path) as rename_log:
+			logged = [tuple(json.loads(line)) for line in rename_log if line.strip()]
+		# A crash can leave the last logged rename undone, only revert what happened
+		done = [(source, dest) for (source, dest) in logged
+			if os.path.exists(os.path.join(self.folder, dest)) and not os.path.exists(os.path.join(self.folder, source))]
+		self._revert(done)
+		os.remove(self.log_path)
+		return(len(done))
+
+	def _revert(self,done):
+		for (source, dest) in reversed(done):
+			log.debug("RenamePlanner:_revert: {0} back to {1}".format(dest,source))
+			os.rename(os.path.join(self.folder, dest), os.path.join(self.folder, source))
+
 class MoveCameraFiles(object):
 	"""
 	MoveCameraFiles -- A class to copy and name the file 
 	"""
-	def __init__(self,args,source_files):
+	def __init__(self,args):
 		self.args = args
-		self.source_files = source_files
-		self.mov_list = []
 
 	def move_files_with_final_name(self):
-		cf = CameraFile(self.source_files)
+		cf = CameraFile(self.args,[])
+		print("Working on {0}".format(self.args.source))
 
-		# Creates the list of movie files from the source files list
-		cf.is_mov_file()
+		journal = None
+		if not self.args.no_journal:
+			journal = IngestJournal(self.args.dest)
 
-		original_count = len(cf.movie_files)
-		current_count = original_count
-		print("Working on {0} files".format(original_count))
+		index = None
+		if not self.args.no_dedup:
+			index = DedupIndex(self.args.dest)
+			index.refresh()
+
+		stats = IngestStats()
+		engine = CopyEngine(self.args.jobs, journal, stats, verify=self.args.verify)
+		if index:
+			engine.on_copied = index.add
+		engine.start()
 
-		# Change dir to source folder
-		os.chdir(self.args.source)
+		# itterate over the clips as the card is walked
+		current_count = 0
+		for clip in cf.walk(self.args.source, stats=stats):
+			i = clip.name
+			my_source_path = clip.path
+			my_stat = clip.stat
+			current_count += 1
+			stats.found()
 
-		# itterate over the mov list
-		for i in cf.movie_files:
-			my_date_time = time.ctime(os.path.getctime(i))
-			formatted_time = cf.format_date_time(my_date_time)
-			log.debug("MoveCameraFiles:formatted_time:  {0}".format(formatted_time))
+			# The journal knows about files a previous run started or finished
+			if journal:
+				with stats.phase('verify'):
+					my_plan = self.plan_from_journal(journal, my_source_path, my_stat)
+				if my_plan is not None:
+					(my_dest_path, my_offset) = my_plan
+					if my_offset is not None:
+						if index:
+							index.reserve(os.path.basename(my_dest_path))
+						print("\nWorking on {0}, item {1}.".format(i,current_count))
+						if my_offset:
+							print("Resuming {0} at {1}.".format(my_dest_path,format_bytes(my_offset)))
+						else:
+							print("Will save file as {0}.".format(my_dest_path))
+						engine.submit(my_source_path, my_dest_path, my_offset, my_stat.st_size)
+					else:
+						stats.skipped()
+					self.queue_sidecars(clip, my_dest_path, journal, engine)
+					continue
 
-			# Ditto results to final destination
-			my_ditto_cmd = "/usr/bin/ditto '{0}/{1}' '{2}/{3}'".format(self.args.source,i,self.args.dest,formatted_time)
-			log.debug("MoveCameraFiles:move_files_with_final_name: executing cmd {0}".format(my_ditto_cmd))
+			with stats.phase('name'):
+				formatted_time = cf.clip_name(my_source_path, clip, my_stat)
+			log_file("MoveCameraFiles:formatted_time:  {0}", formatted_time)
+
+			if index:
+				# Same content already in the library, no matter what it was named
+				with stats.phase('verify'):
+					my_duplicate = index.find_duplicate(my_source_path, my_stat.st_size)
+				if my_duplicate:
+					stats.skipped()
+					print("{0} is already in the library as {1}, skipping!".format(i,my_duplicate))
+					continue
+				# Same time stamp but different content, give it a name of its own
+				with stats.phase('name'):
+					formatted_time = index.unique_name(formatted_time)
 
 			# Check destination name and create a destination path
 			my_dest_path = os.path.abspath("{0}/{1}".format(self.args.dest,formatted_time))
 
 			# Maybe the user is trying to run this on the same files? 
 			if os.path.exists(my_dest_path):
-				current_count -= 1
+				stats.skipped()
 				print("Duplicate destination file found {0}, skipping!".format(my_dest_path))
 			else:
-				# Execute the copy
-				print("\nWorking on {0}, item {1} of {2}.".format(i,current_count,original_count))
+				# Queue the copy, the engine reports when it is done
+				print("\nWorking on {0}, item {1}.".format(i,current_count))
 				print("Will save file as {0} in destination {1}.".format(formatted_time,self.args.dest))
-				current_count -= 1 
-				self.execute_cmd(my_ditto_cmd)
+				if journal:
+					journal.begin(my_source_path, my_stat.st_size, my_stat.st_mtime, my_dest_path)
+				engine.submit(my_source_path, my_dest_path, size=my_stat.st_size)
+				self.queue_sidecars(clip, my_dest_path, journal, engine)
+
+		print("\nFound {0} clips.".format(current_count))
+		engine.finish()
+		if journal:
+			journal.close()
+		if index:
+			index.close()
+
+		log.info("MoveCameraFiles:move_files_with_final_name: {0}".format(stats.progress_line()))
+		if self.args.summary:
+			stats.write_summary(self.args.summary, source=self.args.source, dest=self.args.dest)
+		return(stats)
+
+	def queue_sidecars(self,clip,dest_path,journal,engine):
+		"""
+		queue_sidecars: Copies the clip's sidecar files next to dest_path, named after it
+		"""
+		for (sidecar, new_name) in clip.sidecar_targets(os.path.basename(dest_path)):
+			my_source_path = os.path.join(clip.folder, sidecar)
+			my_dest_path = os.path.join(os.path.dirname(dest_path), new_name)
+			my_stat = clip.stat_of(sidecar)
+			if journal:
+				my_plan = self.plan_from_journal(journal, my_source_path, my_stat)
+				if my_plan is not None:
+					if my_plan[1] is not None:
+						engine.submit(my_source_path, my_plan[0], my_plan[1], my_stat.st_size)
+					continue
+			if os.path.exists(my_dest_path):
+				continue
+			print("Will save sidecar {0} as {1}.".format(sidecar,new_name))
+			if journal:
+				journal.begin(my_source_path, my_stat.st_size, my_stat.st_mtime, my_dest_path)
+			engine.submit(my_source_path, my_dest_path, size=my_stat.st_size)
+
+	def plan_from_journal(self,journal,source,my_stat):
+		"""
+		plan_from_journal: Returns None when the journal has nothing for this source,
+			(dest, None) when it is already imported, or (dest, offset) for a copy to run
+		"""
+		entry = journal.lookup(source)
+		if entry is None:
+			return(None)
+
+		if entry['size'] != my_stat.st_size or entry['mtime'] != my_stat.st_mtime:
+			# Not the file we copied before (card reformatted, file edited)
+			log.debug("MoveCameraFiles:plan_from_journal: {0} changed since it was journaled".format(source))
+			journal.forget(source)
+			return(None)
+
+		dest = entry['dest']
+		if entry['state'] == IngestJournal.VERIFIED:
+			if not os.path.exists(dest) or os.path.getsize(dest) != entry['size']:
+				print("Destination file {0} is missing or truncated, copying again.".format(dest))
+				journal.begin(source, entry['size'], entry['mtime'], dest)
+				return((dest, 0))
+			# Copies made without --verify have no checksum, check those against the source
+			if self.args.verify and hash_file(dest) != (entry['digest'] or hash_file(source)):
+				print("Destination file {0} does not match its checksum, copying again.".format(dest))
+				journal.begin(source, entry['size'], entry['mtime'], dest)
+				return((dest, 0))
+			print("Already imported {0} as {1}, skipping!".format(source,dest))
+			return((dest, None))
+
+		# Interrupted copy, only trust what was checkpointed and is still on disk
+		partial = dest + PARTIAL_SUFFIX
+		offset = 0
+		if os.path.exists(partial):
+			offset = min(entry['copied'], os.path.getsize(partial))
+		elif os.path.exists(dest) and os.path.getsize(dest) == entry['size']:
+			# Renamed into place but the verified row never got committed, check it against the source
+			digest = hash_file(dest)
+			if digest == hash_file(source):
+				print("Already imported {0} as {1}, skipping!".format(source,dest))
+				journal.verified(source, digest)
+				return((dest, None))
+			print("Destination file {0} does not match its source, copying again.".format(dest))
+		return((dest, offset))
 
 	# Add a remove sources command at some point
 
-	def execute_cmd(self,cmd,terminal=None):
+
+class LibcCopy(object):
+	"""
+	LibcCopy -- copy_file_range and sendfile through ctypes, with the same arguments
+			as the os module calls Python 2.7 does not have. Only bound on Linux,
+			the macOS sendfile is for sockets and takes other arguments. A call
+			libc does not have is left as None
+	"""
+	def __init__(self):
+		self.copy_file_range = None
+		self.sendfile = None
+		if not sys.platform.startswith('linux'):
+			return
 		try:
-			output = Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-			# Capture out and err in case we need to handle a issue
-			if (terminal):
-				for line in iter(output.stdout.readline, ''):
-					print line.rstrip()
-			(stdout,sterr) = output.communicate()
-			log.debug("RunCommand:execute_cmd: Output from {0} is {1}".format(cmd, stdout))
+			my_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		except OSError as e:
+			log.debug("LibcCopy:__init__: no libc, {0}".format(e))
+			return
+
+		# sendfile64 takes a 64 bit offset on 32 bit systems too
+		my_sendfile = getattr(my_libc, 'sendfile64', None) or getattr(my_libc, 'sendfile', None)
+		if my_sendfile is not None:
+			my_sendfile.restype = ctypes.c_ssize_t
+			my_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+			self._sendfile = my_sendfile
+			self.sendfile = self.call_sendfile
+
+		# glibc 2.27 and later
+		my_copy_file_range = getattr(my_libc, 'copy_file_range', None)
+		if my_copy_file_range is not None:
+			my_copy_file_range.restype = ctypes.c_ssize_t
+			my_copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+				ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]
+			self._copy_file_range = my_copy_file_range
+			self.copy_file_range = self.call_copy_file_range
+
+	def call_sendfile(self,out_fd,in_fd,offset,count):
+		my_offset = ctypes.c_int64(offset)
+		return(self._check(self._sendfile(out_fd, in_fd, ctypes.byref(my_offset), count)))
+
+	def call_copy_file_range(self,src_fd,dst_fd,count,offset_src,offset_dst):
+		my_offset_src = ctypes.c_int64(offset_src)
+		my_offset_dst = ctypes.c_int64(offset_dst)
+		return(self._check(self._copy_file_range(src_fd, ctypes.byref(my_offset_src),
+			dst_fd, ctypes.byref(my_offset_dst), count, 0)))
+
+	@staticmethod
+	def _check(result):
+		if result < 0:
+			my_errno = ctypes.get_errno()
+			raise OSError(my_errno, os.strerror(my_errno))
+		return(result)
+
+
+class CopyEngine(object):
+	"""
+	CopyEngine -- A bounded pool of threads that copy files in process. Data is
+			moved in large chunks with copy_file_range or sendfile when the
+			platform supports it, from the os module or from libc through
+			ctypes, and with a buffered copy otherwise
+	"""
+	def __init__(self,jobs=DEFAULT_JOBS,journal=None,stats=None,chunk_size=COPY_CHUNK_SIZE,verify=False):
+		self.jobs = max(1, jobs)
+		self.journal = journal
+		self.verify = verify		# Checksum journaled copies once they're written
+		self.stats = stats or IngestStats()
+		self.chunk_size = chunk_size
+		self.on_copied = None		# Called with (dest, digest) for every finished copy
+		self._libc = LibcCopy()
+		self._queue = Queue.Queue(maxsize=self.jobs * 2)
+		self._threads = []
+		self._lock = threading.Lock()
+
+	def start(self):
+		for i in range(self.jobs):
+			t = threading.Thread(target=self._worker, name="copy-{0}".format(i))
+			t.daemon = True
+			t.start()
+			self._threads.append(t)
+
+	def submit(self,source,dest,offset=0,size=None):
+		# Blocks when the queue is full, so a large card is never listed far ahead of the copies
+		if size is None:
+			size = os.path.getsize(source)
+		self.stats.queued(size - offset)
+		self._queue.put((source, dest, offset))
+
+	def finish(self):
+		for t in self._threads:
+			self._queue.put(None)
+		for t in self._threads:
+			t.join()
+		self._threads = []
+
+		stats = self.stats
+		elapsed = stats.elapsed()
+		print("\nCopied {0} files, {1} in {2:.1f}s ({3}), {4} failed.".format(stats.files_copied,
+			format_bytes(stats.bytes_copied), elapsed, format_rate(stats.bytes_copied, elapsed), stats.files_failed))
+		log.debug("CopyEngine:finish: copied {0} files, {1} bytes in {2}s, {3} failed".format(stats.files_copied,stats.bytes_copied,elapsed,stats.files_failed))
+		return(stats.files_copied, stats.bytes_copied, elapsed)
+
+	def _worker(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break
+			(source, dest, offset) = item
+			start = time.time()
+			try:
+				digest = None
+				with self.stats.phase('copy'):
+					if self.journal:
+						(copied, digest) = self.journaled_copy(source, dest, offset)
+					else:
+						copied = self.copy_file(source, dest)
+				if self.on_copied:
+					self.on_copied(dest, digest)
+			except (IOError, OSError) as e:
+				log.error("CopyEngine:_worker: Received error {0} copying {1} to {2}".format(e,source,dest))
+				self.stats.failed()
+				with self._lock:
+					print("Failed to copy {0}: {1}".format(source,e))
+				continue
+
+			elapsed = time.time() - start
+			self.stats.copied(copied)
+			with self._lock:
+				print("Copied {0} ({1}) in {2:.1f}s ({3}). {4}".format(os.path.basename(dest),
+					format_bytes(copied), elapsed, format_rate(copied, elapsed), self.stats.progress_line()))
+
+	def journaled_copy(self,source,dest,offset=0):
+		"""
+		journaled_copy: Copies into a .part file with checkpoints, the file only gets its
+			final name once the journal marks it verified. The copy is hashed afterwards
+			with verify, so the kernel copy still does the work. Returns the bytes
+			copied and the checksum, None without verify
+		"""
+		partial = dest + PARTIAL_SUFFIX
+		journal = self.journal
+		copied = self.copy_file(source, partial, offset, lambda n: journal.checkpoint(source, n))
+
+		size = os.path.getsize(source)
+		if os.path.getsize(partial) != size:
+			raise IOError("copy of {0} is {1} bytes, expected {2}".format(source,os.path.getsize(partial),size))
+		digest = None
+		if self.verify:
+			with self.stats.phase('verify'):
+				digest = hash_file(partial)
+		os.rename(partial, dest)
+		journal.verified(source, digest)
+		return(copied, digest)
+
+	def copy_file(self,source,dest,offset=0,checkpoint=None):
+		"""
+		copy_file: Copies source to dest starting at offset and returns the number of bytes copied.
+			checkpoint is called with the synced length every CHECKPOINT_SIZE bytes.
+		"""
+		with open(source, 'rb') as src:
+			with open(dest, 'r+b' if offset else 'wb') as dst:
+				size = os.fstat(src.fileno()).st_size
+				if offset:
+					dst.truncate(offset)
+				position = self._kernel_copy(src, dst, size, offset, checkpoint)
+				if position < size:
+					src.seek(position)
+					dst.seek(position)
+					position += self._buffered_copy(src, dst, checkpoint, position)
+
+		# ditto kept the dates, keep doing that
+		shutil.copystat(source, dest)
+		log_file("CopyEngine:copy_file: copied {0} bytes from {1} to {2}", position - offset, source, dest)
+		return(position - offset)
+
+	def _kernel_copy(self,src,dst,size,offset=0,checkpoint=None):
+		# Returns how far we got, the caller finishes with a buffered copy
+		start = offset
+		synced = offset
+		for name in ('copy_file_range', 'sendfile'):
+			call = getattr(os, name, None) or getattr(self._libc, name)
+			if call is None:
+				continue
+			try:
+				if name == 'sendfile':
+					# sendfile writes at the current position of dst, not at an offset
+					os.lseek(dst.fileno(), offset, os.SEEK_SET)
+				while offset < size:
+					count = min(self.chunk_size, size - offset)
+					if name == 'sendfile':
+						sent = call(dst.fileno(), src.fileno(), offset, count)
+					else:
+						sent = call(src.fileno(), dst.fileno(), count, offset, offset)
+					if sent == 0:
+						break
+					offset += sent
+					if checkpoint and offset - synced >= CHECKPOINT_SIZE:
+						# Only journal what has actually reached the disk
+						os.fsync(dst.fileno())
+						checkpoint(offset)
+						synced = offset
+				log_file("CopyEngine:_kernel_copy: {0} moved {1} bytes", name, offset - start)
+				return(offset)
+			except OSError as e:
+				# Not supported for this pair of files (cross device, macOS sendfile, old kernel)
+				if e.errno not in KERNEL_COPY_UNSUPPORTED:
+					raise
+				log.debug("CopyEngine:_kernel_copy: {0} not usable ({1}), trying next".format(name,e))
+		return(offset)
+
+	def _buffered_copy(self,src,dst,checkpoint=None,position=0):
+		copied = 0
+		unsynced = 0
+		while True:
+			buf = src.read(self.chunk_size)
+			if not buf:
+				break
+			dst.write(buf)
+			copied += len(buf)
+			unsynced += len(buf)
+			if checkpoint and unsynced >= CHECKPOINT_SIZE:
+				# Only journal what has actually reached the disk
+				dst.flush()
+				os.fsync(dst.fileno())
+				checkpoint(position + copied)
+				unsynced = 0
+		return(copied)
+
+
+class IngestJournal(object):
+	"""
+	IngestJournal -- A SQLite journal in the destination folder. Keyed by source
+			path with the size and mtime the source had, it records how far a
+			copy got and the checksum of a finished copy
+	"""
+	COPYING	= "copying"
+	VERIFIED = "verified"
+
+	def __init__(self,dest):
+		self.path = state_path(dest, JOURNAL_NAME)
+		self._lock = threading.Lock()
+		# Copy threads share the connection, the lock keeps them apart
+		self._db = sqlite3.connect(self.path, check_same_thread=False)
+		self._db.row_factory = sqlite3.Row
+		# WAL with NORMAL sync, a commit is an append to the log and not an fsync of the database
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute("PRAGMA synchronous=NORMAL")
+		self._db.execute("CREATE TABLE IF NOT EXISTS journal (source TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+			"dest TEXT, copied INTEGER, digest TEXT, state TEXT)")
+		self._db.commit()
+		self._pending = 0
+		self._committed = time.time()
+		log.debug("IngestJournal:__init__: using journal {0}".format(self.path))
+
+	def lookup(self,source):
+		with self._lock:
+			row = self._db.execute("SELECT * FROM journal WHERE source = ?", (source,)).fetchone()
+		return(row)
+
+	def begin(self,source,size,mtime,dest):
+		with self._lock:
+			self._db.execute("INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, 0, NULL, ?)",
+				(source, size, mtime, dest, self.COPYING))
+			# Committed before the copy starts, so a .part on disk always has its row
+			self._commit()
+
+	def checkpoint(self,source,copied):
+		with self._lock:
+			self._db.execute("UPDATE journal SET copied = ? WHERE source = ?", (copied, source))
+			self._checkpointed()
+
+	def verified(self,source,digest):
+		with self._lock:
+			self._db.execute("UPDATE journal SET copied = size, digest = ?, state = ? WHERE source = ?",
+				(digest, self.VERIFIED, source))
+			self._commit()
+
+	def forget(self,source):
+		with self._lock:
+			self._db.execute("DELETE FROM journal WHERE source = ?", (source,))
+			self._commit()
+
+	def flush(self):
+		with self._lock:
+			self._commit()
+
+	def close(self):
+		self.flush()
+		self._db.close()
 
-		except TypeError as e:
-			log.error("RunCommand:execute_cmd: Received error {0} from cmd {1}".format(e,cmd))
-		except NSURLErrorDomain as e:
-			log.error("RunCommand:execute_cmd: Received error {0} from cmd {1}".format(e,cmd))
+	def _checkpointed(self):
+		# Called with the lock held. Checkpoints are committed in batches, losing a
+		# batch to a crash only makes the resume start from an earlier offset
+		self._pending += 1
+		if self._pending >= JOURNAL_COMMIT_ROWS or time.time() - self._committed >= JOURNAL_COMMIT_SECONDS:
+			self._commit()
 
-		return(stdout,sterr)
+	def _commit(self):
+		self._db.commit()
+		self._pending = 0
+		self._committed = time.time()
+
+
+class DedupIndex(object):
+	"""
+	DedupIndex -- A SQLite index of the files in the destination folder. Files
+			are matched on size first, then on a hash of their first and last
+			blocks, and only then on a full hash. Hashes are worked out the
+			first time they are needed and kept, and the folder is only
+			listed again when its mtime changed
+	"""
+	def __init__(self,dest):
+		self.dest = dest
+		self.path = state_path(dest, INDEX_NAME)
+		self._lock = threading.Lock()
+		self._reserved = set()
+		self._db = sqlite3.connect(self.path, check_same_thread=False)
+		self._db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+			"partial TEXT, digest TEXT)")
+		self._db.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size)")
+		self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+		self._db.commit()
+		log.debug("DedupIndex:__init__: using index {0}".format(self.path))
+
+	def refresh(self):
+		"""
+		refresh: Brings the index up to date with the destination folder. Only stat
+			data is read here, hashes of new files are left for find_duplicate
+		"""
+		dir_mtime = os.stat(self.dest).st_mtime
+		row = self._db.execute("SELECT value FROM meta WHERE key = 'dir_mtime'").fetchone()
+		if row is not None and row[0] == dir_mtime:
+			log.debug("DedupIndex:refresh: {0} unchanged, using index as is".format(self.dest))
+			return
+
+		known = dict((r[0], (r[1], r[2])) for r in self._db.execute("SELECT name, size, mtime FROM files"))
+		seen = set()
+		for name in os.listdir(self.dest):
+			if not self.is_library_file(name):
+				continue
+			path = os.path.join(self.dest, name)
+			if not os.path.isfile(path):
+				continue
+			seen.add(name)
+			my_stat = os.stat(path)
+			if known.get(name) != (my_stat.st_size, my_stat.st_mtime):
+				# New or changed, any hashes we had are stale
+				self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, NULL, NULL)",
+					(name, my_stat.st_size, my_stat.st_mtime))
+		removed = [(name,) for name in known if name not in seen]
+		self._db.executemany("DELETE FROM files WHERE name = ?", removed)
+		self._save_dir_mtime(dir_mtime)
+		log.debug("DedupIndex:refresh: {0} files indexed, {1} removed".format(len(seen),len(removed)))
+
+	@staticmethod
+	def is_library_file(name):
+		return not (name.startswith('.') or name.endswith(PARTIAL_SUFFIX))
+
+	def find_duplicate(self,source,size):
+		"""
+		find_duplicate: Returns the name of a library file with the same content as source, or None
+		"""
+		with self._lock:
+			candidates = self._db.execute("SELECT name, partial, digest FROM files WHERE size = ?", (size,)).fetchall()
+		if not candidates:
+			return(None)
+
+		source_partial = partial_hash_file(source)
+		source_digest = None
+		for (name, partial, digest) in candidates:
+			path = os.path.join(self.dest, name)
+			if partial is None:
+				partial = partial_hash_file(path)
+				self._update(name, 'partial', partial)
+			if partial != source_partial:
+				continue
+
+			# Prefilter matched, it takes a full read of both to be sure
+			if source_digest is None:
+				source_digest = hash_file(source)
+			if digest is None:
+				digest = hash_file(path)
+				self._update(name, 'digest', digest)
+			if digest == source_digest:
+				return(name)
+		return(None)
+
+	def unique_name(self,name):
+		"""
+		unique_name: Returns name, or name with a _N suffix when it's taken by a library
+			file or a copy still in flight, and reserves it
+		"""
+		candidate = name
+		suffix = 0
+		with self._lock:
+			while (candidate in self._reserved or os.path.exists(os.path.join(self.dest, candidate))
+				or os.path.exists(os.path.join(self.dest, candidate + PARTIAL_SUFFIX))):
+				suffix += 1
+				candidate = suffixed_name(name, suffix)
+			self._reserved.add(candidate)
+		if suffix:
+			log_file("DedupIndex:unique_name: {0} is taken, using {1}", name, candidate)
+		return(candidate)
+
+	def reserve(self,name):
+		with self._lock:
+			self._reserved.add(name)
+
+	def add(self,path,digest=None):
+		# Called from the copy threads as each file lands
+		my_stat = os.stat(path)
+		with self._lock:
+			self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, NULL, ?)",
+				(os.path.basename(path), my_stat.st_size, my_stat.st_mtime, digest))
+			self._db.commit()
+
+	def close(self):
+		# Everything we copied was added as it landed, the folder listing is current.
+		# The database is in the state folder, committing this doesn't move the mtime
+		self._save_dir_mtime(os.stat(self.dest).st_mtime)
+		self._db.close()
+
+	def _update(self,name,column,value):
+		with self._lock:
+			self._db.execute("UPDATE files SET {0} = ? WHERE name = ?".format(column), (value, name))
+			self._db.commit()
+
+	def _save_dir_mtime(self,dir_mtime):
+		with self._lock:
+			self._db.execute("INSERT OR REPLACE INTO meta VALUES ('dir_mtime', ?)", (dir_mtime,))
+			self._db.commit()
+
+
+class IngestStats(object):
+	"""
+	IngestStats -- Timings and counters for one import. Phase times are summed over
+			every thread, so copy time can be more than the wall clock when
+			--jobs is above one
+	"""
+	PHASES = ('scan', 'classify', 'name', 'copy', 'verify')
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.start_time = time.time()
+		self.phase_times = dict((phase, 0.0) for phase in self.PHASES)
+		self.scan_done = False
+		self.files_found = 0
+		self.files_queued = 0
+		self.bytes_queued = 0
+		self.files_copied = 0
+		self.bytes_copied = 0
+		self.files_skipped = 0
+		self.files_failed = 0
+
+	@contextlib.contextmanager
+	def phase(self,name):
+		start = time.time()
+		try:
+			yield
+		finally:
+			elapsed = time.time() - start
+			with self._lock:
+				self.phase_times[name] += elapsed
+
+	def found(self):
+		self.files_found += 1
+
+	def skipped(self):
+		with self._lock:
+			self.files_skipped += 1
+
+	def queued(self,size):
+		with self._lock:
+			self.files_queued += 1
+			self.bytes_queued += size
+
+	def copied(self,size):
+		with self._lock:
+			self.files_copied += 1
+			self.bytes_copied += size
+
+	def failed(self):
+		with self._lock:
+			self.files_failed += 1
+
+	def elapsed(self):
+		return(time.time() - self.start_time)
+
+	def eta(self):
+		"""
+		eta: Seconds left for the copies queued so far, None until there's a rate
+		"""
+		elapsed = self.elapsed()
+		if self.bytes_copied == 0 or elapsed <= 0:
+			return(None)
+		return(max(0, self.bytes_queued - self.bytes_copied) / (self.bytes_copied / elapsed))
+
+	def progress_line(self):
+		elapsed = self.elapsed()
+		eta = self.eta()
+		if eta is None:
+			my_eta = "--:--"
+		else:
+			my_eta = "{0}:{1:02d}".format(int(eta) // 60, int(eta) % 60)
+		if not self.scan_done:
+			# More of the card is still to be listed
+			my_eta += "+"
+		files_per_second = self.files_copied / elapsed if elapsed > 0 else 0
+		return("[{0}/{1} files, {2}, {3:.1f} files/s, ETA {4}]".format(self.files_copied, self.files_queued,
+			format_rate(self.bytes_copied, elapsed), files_per_second, my_eta))
+
+	def summary(self,**extra):
+		elapsed = self.elapsed()
+		summary = {
+			'elapsed': round(elapsed, 3),
+			'files_found': self.files_found,
+			'files_copied': self.files_copied,
+			'files_skipped': self.files_skipped,
+			'files_failed': self.files_failed,
+			'bytes_copied': self.bytes_copied,
+			'bytes_per_second': round(self.bytes_copied / elapsed, 1) if elapsed > 0 else 0,
+			'files_per_second': round(self.files_copied / elapsed, 3) if elapsed > 0 else 0,
+			'phases': dict((phase, round(seconds, 3)) for (phase, seconds) in self.phase_times.items()),
+		}
+		summary.update(extra)
+		return(summary)
+
+	def write_summary(self,path,**extra):
+		"""
+		write_summary: Writes the JSON summary to path, - for stdout
+		"""
+		my_summary = json.dumps(self.summary(**extra), sort_keys=True)
+		if path == '-':
+			print(my_summary)
+		else:
+			with open(path, 'w') as f:
+				f.write(my_summary + "\n")
+		log.debug("IngestStats:write_summary: {0}".format(my_summary))
+
+
+################################################################################
+# FUNCTIONS
+################################################################################
+def format_bytes(count):
+	for unit in ('B', 'KB', 'MB', 'GB'):
+		if count < 1024.0:
+			return("{0:.1f} {1}".format(count, unit))
+		count /= 1024.0
+	return("{0:.1f} TB".format(count))
+
+def hash_file(path,chunk_size=COPY_CHUNK_SIZE):
+	hasher = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for buf in iter(lambda: f.read(chunk_size), b''):
+			hasher.update(buf)
+	return(hasher.hexdigest())
+
+def log_file(message,*args):
+	# Skip the formatting unless someone will read it
+	if file_log.isEnabledFor(logging.DEBUG):
+		file_log.debug(message.format(*args))
+
+def glob_to_regex(pattern):
+	# * and ? only, case sensitive like the suffix checks this replaced
+	return("".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in pattern))
+
+def stat_time(my_stat,time_source):
+	if time_source == 'mtime':
+		return(my_stat.st_mtime)
+	if time_source == 'birthtime':
+		# Only some file systems (HFS+, APFS) keep a birth time, ctime is the closest
+		return(getattr(my_stat, 'st_birthtime', my_stat.st_ctime))
+	return(my_stat.st_ctime)
+
+def suffixed_name(name,suffix):
+	(base, ext) = os.path.splitext(name)
+	return("{0}_{1}{2}".format(base, suffix, ext))
+
+def partial_hash_file(path,block_size=PARTIAL_HASH_SIZE):
+	# Size plus the first and last blocks, enough to tell most clips apart
+	hasher = hashlib.sha1()
+	with open(path, 'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		hasher.update(str(size))
+		hasher.update(f.read(block_size))
+		if size > block_size:
+			f.seek(max(block_size, size - block_size))
+			hasher.update(f.read(block_size))
+	return(hasher.hexdigest())
+
+def state_path(dest,name):
+	# Path of a database in the state folder of dest, made on first use
+	folder = os.path.join(dest, STATE_FOLDER)
+	if not os.path.isdir(folder):
+		os.mkdir(folder)
+	path = os.path.join(folder, name)
+	# Earlier versions kept it as .uniquename_<name> in dest itself
+	old_path = os.path.join(dest, "{0}_{1}".format(STATE_FOLDER, name))
+	if os.path.exists(old_path) and not os.path.exists(path):
+		os.rename(old_path, path)
+	return(path)
+
+def format_rate(count,elapsed):
+	if elapsed <= 0:
+		return("-- /s")
+	return("{0}/s".format(format_bytes(count / elapsed)))
 
 
 ################################################################################
@@ -228,6 +1471,19 @@ if __name__ == "__main__":
 	parser.add_argument('-s', '--source',	default="source", help = "The path to the source mov files")
 	parser.add_argument('-d', '--dest',	default="dest", help = "The path to the destination folder")
 	parser.add_argument('-p', '--inplace',	action="store_true", help = "Change the files in place, this is for an already imported item you just want to change the name of")
+	parser.add_argument('-t', '--time-source', choices=TIME_SOURCES, default=None, help = "Which file time the new name comes from, ctime unless the camera profile says otherwise")
+	parser.add_argument('--profiles',	default=None, help = "JSON file of extra camera profiles, defaults to {0}".format(PROFILES_PATH))
+	parser.add_argument('--dry-run',	action="store_true", help = "With --inplace, print the rename plan without renaming anything")
+	parser.add_argument('--undo',		action="store_true", help = "With --inplace, revert the last batch of renames in the source folder")
+	parser.add_argument('-j', '--jobs',	type=int, default=DEFAULT_JOBS, help = "Number of files to copy at the same time")
+	parser.add_argument('--no-journal',	action="store_true", help = "Don't keep an ingest journal in the destination, interrupted copies can't be resumed")
+	parser.add_argument('--no-dedup',	action="store_true", help = "Don't check the destination for clips with the same content, only for the same name")
+	parser.add_argument('--verify',		action="store_true", help = "Checksum each copy once it's written, re-read already imported files and copy them again if their checksum doesn't match")
+	parser.add_argument('--summary',	default=None, help = "Write a JSON summary of the import to this file, - for stdout")
+	parser.add_argument('--log-files',	action="store_true", help = "Log a DEBUG line for every file, slow on big cards")
 	args = parser.parse_args()
 
+	if args.log_files:
+		file_log.setLevel(logging.DEBUG)
+
 	ExecutePlan(args).run()